@@ -0,0 +1,108 @@
+"""ポーリングの間隔の提案と、混んでいるときのポーリングの受付制限
+
+/room/wait, /room/result は次にポーリングするまでの秒数 (poll_interval と Retry-After) を返す。
+間隔はルームの状態で決めた基準値を、サーバーの負荷(処理中のリクエスト数と
+コネクションプールの待ち時間)に応じて POLL_INTERVAL_MAX まで延ばしたもの。
+プールが全て貸し出し中で待ちが長いときは、ポーリングを 503 で断って
+/room/join, /room/end などの状態を変えるリクエストにコネクションを譲る。
+"""
+
+import math
+import threading
+
+from fastapi import HTTPException
+
+from . import config, metrics
+from .db import async_engine
+from .model import WaitRoomStatus
+
+
+class LoadMonitor:
+    """処理中のリクエスト数とコネクションプールの待ち時間から負荷を見積もる"""
+
+    # プールの待ち時間の指数移動平均の重み
+    ALPHA = 0.1
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._lock = threading.Lock()
+        self.pool_wait = 0.0
+
+    def observe_pool_wait(self, seconds: float) -> None:
+        with self._lock:
+            self.pool_wait += self.ALPHA * (seconds - self.pool_wait)
+
+    def pressure(self) -> float:
+        """0 (空いている) から 1 (POLL_HIGH_* に達している)"""
+        in_flight = metrics.http_requests_in_flight.total()
+        return min(
+            1.0,
+            max(
+                in_flight / config.POLL_HIGH_IN_FLIGHT,
+                self.pool_wait / config.POLL_HIGH_POOL_WAIT,
+            ),
+        )
+
+    def saturated(self) -> bool:
+        """プールのコネクションが全て貸し出し中で、借りるのに待たされている"""
+        pool = self._pool
+        # QueuePool 以外(テスト用の SQLite など)と、上限のないプールは飽和しない
+        max_overflow = getattr(pool, "_max_overflow", -1)
+        if not hasattr(pool, "checkedout") or max_overflow < 0:
+            return False
+        return (
+            pool.checkedout() >= pool.size() + max_overflow
+            and self.pool_wait >= config.POLL_SHED_POOL_WAIT
+        )
+
+
+monitor = LoadMonitor(async_engine.pool)
+
+polls_shed = metrics.registry.register(
+    metrics.Counter(
+        "gameserver_polls_shed_total",
+        "プールが飽和していて 503 で断ったポーリングの数",
+        ("endpoint",),
+    )
+)
+metrics.registry.register(
+    metrics.Gauge(
+        "gameserver_poll_pressure",
+        "ポーリング間隔の計算に使う負荷 (0-1)",
+        callback=lambda: {(): monitor.pressure()},
+    )
+)
+
+
+def _stretch(base: float) -> float:
+    return round(base + (config.POLL_INTERVAL_MAX - base) * monitor.pressure(), 2)
+
+
+def wait_interval(status, idle: float) -> float:
+    """/room/wait の次のポーリングまでの秒数。idle はルームが最後に変わってからの秒数
+
+    人の出入りがあった直後は開始が近いので短く、Waiting のまま変化がなければ長くする。
+    """
+    if status != WaitRoomStatus.Waiting.value or idle < config.POLL_IDLE_AFTER:
+        return _stretch(config.POLL_INTERVAL_MIN)
+    return _stretch(config.POLL_INTERVAL_IDLE)
+
+
+def result_interval() -> float:
+    """/room/result の次のポーリングまでの秒数"""
+    return _stretch(config.POLL_INTERVAL_MIN)
+
+
+def retry_after(seconds: float) -> str:
+    """Retry-After ヘッダーの値。整数の秒数しか書けないので切り上げる"""
+    return str(max(1, math.ceil(seconds)))
+
+
+def admit_poll(endpoint: str) -> None:
+    """プールが飽和していればポーリングを 503 で断る"""
+    if monitor.saturated():
+        polls_shed.inc(endpoint)
+        raise HTTPException(
+            status_code=503,
+            headers={"Retry-After": retry_after(config.POLL_SHED_RETRY_AFTER)},
+        )
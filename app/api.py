@@ -1,13 +1,29 @@
+import asyncio
+import hmac
 import json
+import uuid
 from calendar import c
 from enum import Enum
-
-from fastapi import Depends, FastAPI, HTTPException
+from typing import Optional
+
+from fastapi import (
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Request,
+    Response,
+    WebSocket,
+)
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import PlainTextResponse
 from fastapi.security.http import HTTPAuthorizationCredentials, HTTPBearer
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
-from . import model
-from .model import SafeUser
+from . import admission, async_model, bus, config, metrics, model, replica, responses
+from .db import async_engine, async_replica_engine, engine, replica_engine
+from .events import room_events
+from .model import SafeUser, UserRef
 
 import datetime
 
@@ -15,6 +31,51 @@ import datetime
 # from lib2to3.pytree import Base
 
 app = FastAPI()
+app.add_middleware(metrics.MetricsMiddleware, routes=app.routes)
+
+
+sweeper = None
+heartbeat = None
+
+
+@app.on_event("startup")
+async def startup():
+    global sweeper, heartbeat
+    event_bus = bus.create(config.EVENT_BUS)
+    if event_bus is not None:
+        replica.router.connect_bus(event_bus)
+        model.connect_bus(event_bus)
+    if replica.router.enabled:
+        heartbeat = replica.Heartbeat(engine, replica_engine, replica.router)
+        heartbeat.start()
+    try:
+        async with async_model.connection() as db:
+            await async_model.load_leaderboard(db)
+    except Exception:
+        model.logger.exception("Failed to load leaderboard.")
+    if config.SWEEPER_ENABLED:
+        from .sweeper import Sweeper
+
+        sweeper = Sweeper(engine)
+        sweeper.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if sweeper is not None:
+        sweeper.close()
+    if heartbeat is not None:
+        heartbeat.close()
+    if bus.current is not None:
+        bus.current.close()
+    if model.room_registry is not None:
+        model.room_registry.close()
+    if model.end_buffer is not None:
+        model.end_buffer.close()
+    await async_engine.dispose()
+    if async_replica_engine is not None:
+        await async_replica_engine.dispose()
+
 
 # Sample APIs
 
@@ -25,6 +86,14 @@ async def root():
     return {"message": "Hello World"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics_endpoint():
+    """Prometheus のテキスト形式でメトリクスを返す"""
+    return PlainTextResponse(
+        metrics.registry.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
 # User APIs
 
 
@@ -41,18 +110,33 @@ class UserCreateResponse(BaseModel):
     user_token: str
 
 
+async def get_db():
+    """リクエストごとのコネクション
+
+    1リクエストの SQL は全て同じコネクション・トランザクションで実行する。
+    コネクションは最初の SQL の実行時に借り、レスポンスの後に返す。
+    更新するエンドポイントはレスポンスを返す前に `await db.commit()` する。
+    """
+    db = async_model.RequestConnection()
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
 @app.post("/user/create", response_model=UserCreateResponse)
-def user_create(req: UserCreateRequest):
+async def user_create(req: UserCreateRequest, db=Depends(get_db)):
     """新規ユーザー作成"""
     model.logger.info("Called /user/create")
-    token = model.create_user(req.user_name, req.leader_card_id)
+    token = await async_model.create_user(db, req.user_name, req.leader_card_id)
+    await db.commit()
     return UserCreateResponse(user_token=token)
 
 
 bearer = HTTPBearer()
 
 
-def get_auth_token(cred: HTTPAuthorizationCredentials = Depends(bearer)) -> str:
+async def get_auth_token(cred: HTTPAuthorizationCredentials = Depends(bearer)) -> str:
     """トークンの取得"""
     assert cred is not None
     if not cred.credentials:
@@ -60,13 +144,27 @@ def get_auth_token(cred: HTTPAuthorizationCredentials = Depends(bearer)) -> str:
     return cred.credentials
 
 
+async def get_current_user(
+    token: str = Depends(get_auth_token), db=Depends(get_db)
+) -> UserRef:
+    """トークンのユーザー。署名つきトークンなら DB を読まずに検証し、id しか持たない"""
+    return await async_model.identify(db, token)
+
+
+async def get_current_profile(
+    token: str = Depends(get_auth_token), db=Depends(get_db)
+) -> SafeUser:
+    """名前などまで読んだトークンのユーザー。エンドポイントと同じコネクションで引く"""
+    user = await async_model.get_user_by_token(db, token)
+    if user is None:
+        raise HTTPException(status_code=404)
+    return user
+
+
 @app.get("/user/me", response_model=SafeUser)
-def user_me(token: str = Depends(get_auth_token)):
+async def user_me(user: SafeUser = Depends(get_current_profile)):
     model.logger.info("Called /user./me")
     """トークンから自身の情報を取得"""
-    user = model.get_user_by_token(token)
-    if user is None:
-        raise HTTPException(status_code=404)
     return user
 
 
@@ -77,17 +175,83 @@ class Empty(BaseModel):
 
 
 @app.post("/user/update", response_model=Empty)
-def update(req: UserCreateRequest, token: str = Depends(get_auth_token)):
+async def update(
+    req: UserCreateRequest, token: str = Depends(get_auth_token), db=Depends(get_db)
+):
     """Update user attributes"""
     model.logger.info("Called /user/update")
-    model.update_user(token, req.user_name, req.leader_card_id)
+    await async_model.update_user(db, token, req.user_name, req.leader_card_id)
+    await db.commit()
     return {}
 
 
+async def require_admin(token: str = Depends(get_auth_token)) -> None:
+    """管理用 API のトークンを確かめる"""
+    if config.ADMIN_TOKEN is None or not hmac.compare_digest(
+        token.encode(), config.ADMIN_TOKEN.encode()
+    ):
+        raise HTTPException(status_code=403)
+
+
+class UserBulkCreateRequest(BaseModel):
+    users: list[UserCreateRequest] = Field(..., max_items=config.BULK_CREATE_MAX_USERS)
+
+
+class UserBulkCreateResponse(BaseModel):
+    # users と同じ順
+    user_tokens: list[str]
+
+
+@app.post(
+    "/admin/user/bulk_create",
+    response_model=UserBulkCreateResponse,
+    dependencies=[Depends(require_admin)],
+    include_in_schema=False,
+)
+async def user_bulk_create(req: UserBulkCreateRequest, db=Depends(get_db)):
+    """ユーザーを1トランザクションでまとめて作る(負荷試験の準備・事前登録用)"""
+    model.logger.info("Called /admin/user/bulk_create")
+    tokens = await async_model.create_users(
+        db, [(u.user_name, u.leader_card_id) for u in req.users]
+    )
+    await db.commit()
+    return UserBulkCreateResponse(user_tokens=tokens)
+
+
 """
 room関連のプログラム
 """
 
+# /room/list の ETag はプロセス内の索引のバージョンなので、他のワーカーや再起動前の ETag と区別する
+_etag_epoch = uuid.uuid4().hex[:8]
+
+
+def _not_modified(
+    endpoint: str,
+    if_none_match: Optional[str],
+    etag: Optional[str],
+    headers: Optional[dict] = None,
+) -> Optional[Response]:
+    """If-None-Match が etag と一致すれば 304 のレスポンスを返す"""
+    if etag is None or if_none_match is None:
+        return None
+    if etag not in (tag.strip() for tag in if_none_match.split(",")):
+        return None
+    metrics.http_not_modified.inc(endpoint)
+    return Response(status_code=304, headers={"ETag": etag, **(headers or {})})
+
+
+def _with_headers(content, response: Response, headers: dict):
+    """content が Response ならそのまま、pydantic なら FastAPI が作るレスポンスにヘッダーをつける"""
+    target = content if isinstance(content, Response) else response
+    target.headers.update(headers)
+    return content
+
+
+async def admit_poll(request: Request) -> None:
+    """ポーリングのエンドポイント用。プールが飽和していれば 503 で断る"""
+    admission.admit_poll(request.url.path)
+
 
 class RoomCreateRequest(BaseModel):
     """RoomCreateのリクエストのスキーマ定義"""
@@ -103,10 +267,13 @@ class RoomCreateResponse(BaseModel):
 
 
 @app.post("/room/create", response_model=RoomCreateResponse)
-def room_create(req: RoomCreateRequest, token: str = Depends(get_auth_token)):
+async def room_create(
+    req: RoomCreateRequest, token: str = Depends(get_auth_token), db=Depends(get_db)
+):
     """新規のルーム作成"""
     model.logger.info("Called /room/create")
-    id = model.create_room(token, req.live_id, req.select_difficulty)
+    id = await async_model.create_room(db, token, req.live_id, req.select_difficulty)
+    await db.commit()
     return RoomCreateResponse(room_id=id)
 
 
@@ -137,14 +304,35 @@ class RoomInfo(BaseModel):
     max_user_count: int
 
 
-@app.post("/room/list", response_model=RoomListResponse)
-def room_list(req: RoomListRequest):
-    """入れるルームのリストの取得"""
+@app.post(
+    "/room/list",
+    response_model=RoomListResponse,
+    dependencies=[Depends(admit_poll)],
+)
+async def room_list(
+    req: RoomListRequest,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    db=Depends(get_db),
+):
+    """入れるルームのリストの取得
+
+    ETag を返す。If-None-Match が一致すれば、入れるルームが変わっていないので 304 を返す。
+    """
     model.logger.info("Called /room/list")
-    results = model.list_room(req.live_id)
-    response = []
+    # 中身より先にバージョンを読む。間に変わっても次のリクエストで取り直すだけで済む
+    version = model.list_version(req.live_id)
+    etag = f'"{_etag_epoch}-{req.live_id}-{version}"' if version is not None else None
+    headers = {"ETag": etag} if etag is not None else {}
+    not_modified = _not_modified("/room/list", if_none_match, etag)
+    if not_modified is not None:
+        return not_modified
+    results = await async_model.list_room(db, req.live_id)
+    if config.FAST_RESPONSE:
+        return _with_headers(responses.room_list(results), response, headers)
+    rooms = []
     for result in results:
-        response.append(
+        rooms.append(
             RoomInfo(
                 room_id=result.room_id,
                 live_id=result.live_id,
@@ -152,7 +340,7 @@ def room_list(req: RoomListRequest):
                 max_user_count=result.max_user_count,
             )
         )
-    return RoomListResponse(room_info_list=response)
+    return _with_headers(RoomListResponse(room_info_list=rooms), response, headers)
 
 
 class RoomJoinRequest(BaseModel):
@@ -169,18 +357,51 @@ class RoomJoinResponse(BaseModel):
 
 
 @app.post("/room/join", response_model=RoomJoinResponse)
-def room_join(req: RoomJoinRequest, token: str = Depends(get_auth_token)):
+async def room_join(
+    req: RoomJoinRequest,
+    user: UserRef = Depends(get_current_user),
+    db=Depends(get_db),
+):
     """ルームへの入室を行う"""
     model.logger.info("Called /room/join")
-    user = model.get_user_by_token(token)
-    if user is None:
-        raise HTTPException(status_code=404)
-    response = model.join_room(
-        room_id=req.room_id, select_difficulty=req.select_difficulty, user=user
+    response = await async_model.join_room(
+        db, room_id=req.room_id, select_difficulty=req.select_difficulty, user=user
     )
+    await db.commit()
     return RoomJoinResponse(join_room_result=response)
 
 
+class RoomQuickJoinRequest(BaseModel):
+    """RoomQuickJoinのリクエストのスキーマ定義"""
+
+    live_id: int = Field(..., gt=0)
+    select_difficulty: model.LiveDifficulty
+
+
+class RoomQuickJoinResponse(BaseModel):
+    """RoomQuickJoinのレスポンスのスキーマ定義"""
+
+    room_id: int
+    # 入れるルームがなく、新しく作ってホストになった
+    created: bool
+
+
+@app.post("/room/quickjoin", response_model=RoomQuickJoinResponse)
+async def room_quickjoin(
+    req: RoomQuickJoinRequest,
+    token: str = Depends(get_auth_token),
+    user: UserRef = Depends(get_current_user),
+    db=Depends(get_db),
+):
+    """入れるルームを選んで入室する。なければルームを作る"""
+    model.logger.info("Called /room/quickjoin")
+    room_id, created = await async_model.quick_join_room(
+        db, token, req.live_id, req.select_difficulty, user
+    )
+    await db.commit()
+    return RoomQuickJoinResponse(room_id=room_id, created=created)
+
+
 class RoomWaitRequest(BaseModel):
     room_id: int
 
@@ -188,16 +409,168 @@ class RoomWaitRequest(BaseModel):
 class RoomWaitResponse(BaseModel):
     status: model.WaitRoomStatus
     room_user_list: list[model.RoomUser]
+    # 次にポーリングするまでの秒数。Retry-After ヘッダーにも切り上げて入れる
+    poll_interval: float
+
+
+@app.post(
+    "/room/wait",
+    response_model=RoomWaitResponse,
+    dependencies=[Depends(admit_poll)],
+)
+async def room_wait(
+    req: RoomWaitRequest,
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    user: UserRef = Depends(get_current_user),
+    db=Depends(get_db),
+):
+    """ルーム待機中
+
+    ETag を返す。If-None-Match が一致すれば、バージョンを1行読むだけで 304 を返す。
+    次のポーリングまでの秒数を poll_interval と Retry-After ヘッダーで返す。
+    """
+    version = await async_model.room_version(db, req.room_id)
+    etag = f'"{req.room_id}-{version}"' if version is not None else None
+    idle = room_events.idle(req.room_id)
+    not_modified = _not_modified(
+        "/room/wait",
+        if_none_match,
+        etag,
+        {
+            "Retry-After": admission.retry_after(
+                admission.wait_interval(model.WaitRoomStatus.Waiting.value, idle)
+            )
+        },
+    )
+    if not_modified is not None:
+        return not_modified
+    # バージョンと同じトランザクションで読むので、中身はバージョンと食い違わない
+    status, room_user_list = await async_model.wait_room(
+        db, room_id=req.room_id, user=user, version=version
+    )
+    poll_interval = admission.wait_interval(status, idle)
+    headers = {"Retry-After": admission.retry_after(poll_interval)}
+    if etag is not None:
+        headers["ETag"] = etag
+    if config.FAST_RESPONSE:
+        return _with_headers(
+            responses.room_wait(status, room_user_list, poll_interval),
+            response,
+            headers,
+        )
+    return _with_headers(
+        RoomWaitResponse(
+            status=status, room_user_list=room_user_list, poll_interval=poll_interval
+        ),
+        response,
+        headers,
+    )
 
 
-@app.post("/room/wait", response_model=RoomWaitResponse)
-def room_wait(req: RoomWaitRequest, token: str = Depends(get_auth_token)):
-    """ルーム待機中"""
-    user = model.get_user_by_token(token)
-    if user is None:
-        raise HTTPException(status_code=404)
-    response = model.wait_room(room_id=req.room_id, user=user)
-    return RoomWaitResponse(status=response[0], room_user_list=response[1])
+class RoomWaitLongPollRequest(BaseModel):
+    room_id: int
+    # 前回受け取った version。None なら待たずに現在の状態を返す
+    version: Optional[int] = None
+    timeout: float = config.ROOM_WAIT_LONGPOLL_TIMEOUT
+
+
+class RoomWaitLongPollResponse(BaseModel):
+    status: model.WaitRoomStatus
+    room_user_list: list[model.RoomUser]
+    version: int
+
+
+@app.post(
+    "/room/wait/longpoll",
+    response_model=RoomWaitLongPollResponse,
+    responses={204: {"description": "timeout までにルームの状態が変わらなかった"}},
+)
+async def room_wait_longpoll(
+    req: RoomWaitLongPollRequest, token: str = Depends(get_auth_token)
+):
+    """ルーム待機中(ロングポーリング)
+
+    version が最新のままの間はDBに触らずに待ち、変化したら最新の状態を返す。
+    待っている間はコネクションを持たない。
+    """
+    async with async_model.connection() as db:
+        user = await async_model.identify(db, token)
+    version = room_events.version(req.room_id)
+    if req.version is not None:
+        timeout = min(max(req.timeout, 0), config.ROOM_WAIT_LONGPOLL_TIMEOUT)
+        version = await room_events.wait(req.room_id, req.version, timeout)
+        if version == req.version:
+            return Response(status_code=204)
+    async with async_model.connection() as db:
+        response = await async_model.wait_room(db, room_id=req.room_id, user=user)
+    return RoomWaitLongPollResponse(
+        status=response[0], room_user_list=response[1], version=version
+    )
+
+
+@app.websocket("/room/wait/ws")
+async def room_wait_ws(websocket: WebSocket, room_id: int):
+    """ルーム待機中(WebSocket)
+
+    接続したら最初のメッセージでトークンを送る。URL に入れるとアクセスログなどに残るので
+    クエリパラメータでは受け取らない。
+    接続時と状態が変わるたびに RoomWaitLongPollResponse を送る。
+    ライブ開始か解散で閉じる。
+    """
+    await websocket.accept()
+    try:
+        message = await asyncio.wait_for(
+            websocket.receive(), config.ROOM_WAIT_WS_AUTH_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        await websocket.close(code=1008)
+        return
+    if message["type"] == "websocket.disconnect":
+        return
+    try:
+        async with async_model.connection() as db:
+            user = await async_model.identify(db, message.get("text") or "")
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    receive = asyncio.ensure_future(websocket.receive())
+    try:
+        version = room_events.version(room_id)
+        while True:
+            async with async_model.connection() as db:
+                status, room_user_list = await async_model.wait_room(db, room_id, user)
+            await websocket.send_json(
+                jsonable_encoder(
+                    RoomWaitLongPollResponse(
+                        status=status, room_user_list=room_user_list, version=version
+                    )
+                )
+            )
+            if status != model.WaitRoomStatus.Waiting.value:
+                break
+            # 変化があるかクライアントが切断するまで待つ
+            while True:
+                changed = asyncio.ensure_future(
+                    room_events.wait(
+                        room_id, version, config.ROOM_WAIT_LONGPOLL_TIMEOUT
+                    )
+                )
+                done, _ = await asyncio.wait(
+                    {receive, changed}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if receive in done:
+                    changed.cancel()
+                    if receive.result()["type"] == "websocket.disconnect":
+                        return
+                    receive = asyncio.ensure_future(websocket.receive())
+                    continue
+                if changed.result() != version:
+                    version = changed.result()
+                    break
+        await websocket.close()
+    finally:
+        receive.cancel()
 
 
 class RoomStartRequest(BaseModel):
@@ -205,13 +578,15 @@ class RoomStartRequest(BaseModel):
 
 
 @app.post("/room/start", response_model=Empty)
-def room_start(req: RoomStartRequest, token: str = Depends(get_auth_token)):
+async def room_start(
+    req: RoomStartRequest,
+    user: UserRef = Depends(get_current_user),
+    db=Depends(get_db),
+):
     """ライブ開始"""
     model.logger.info("Called /room/start")
-    user = model.get_user_by_token(token)
-    if user is None:
-        raise HTTPException(status_code=404)
-    _ = model.start_room(room_id=req.room_id, user=user)
+    _ = await async_model.start_room(db, room_id=req.room_id, user=user)
+    await db.commit()
     return {}
 
 
@@ -222,18 +597,21 @@ class RoomEndRequest(BaseModel):
 
 
 @app.post("/room/end", response_model=Empty)
-def room_end(req: RoomEndRequest, token: str = Depends(get_auth_token)):
+async def room_end(
+    req: RoomEndRequest,
+    user: UserRef = Depends(get_current_user),
+    db=Depends(get_db),
+):
     """ライブ終了時"""
     model.logger.info("Called /room/end")
-    user = model.get_user_by_token(token)
-    if user is None:
-        raise HTTPException(status_code=404)
-    _ = model.end_room(
+    _ = await async_model.end_room(
+        db,
         room_id=req.room_id,
         judge_count_list=req.judge_count_list,
         score=req.score,
         user=user,
     )
+    await db.commit()
     return {}
 
 
@@ -243,14 +621,32 @@ class RoomResultRequest(BaseModel):
 
 class RoomResultResponse(BaseModel):
     result_user_list: list[model.ResultUser]
+    # 次にポーリングするまでの秒数。Retry-After ヘッダーにも切り上げて入れる
+    poll_interval: float
 
 
-@app.post("/room/result", response_model=RoomResultResponse)
-def room_result(req: RoomResultRequest):
+@app.post(
+    "/room/result",
+    response_model=RoomResultResponse,
+    dependencies=[Depends(admit_poll)],
+)
+async def room_result(req: RoomResultRequest, response: Response, db=Depends(get_db)):
     """ライブのリザルト"""
     model.logger.info("Called /room/result")
-    result = model.result_room(room_id=req.room_id)
-    return RoomResultResponse(result_user_list=result)
+    result = await async_model.result_room(db, room_id=req.room_id)
+    # 締め切りを過ぎたリザルトはこのリクエストで確定させて書き込む
+    await db.commit()
+    poll_interval = admission.result_interval()
+    headers = {"Retry-After": admission.retry_after(poll_interval)}
+    if config.FAST_RESPONSE:
+        return _with_headers(
+            responses.room_result(result, poll_interval), response, headers
+        )
+    return _with_headers(
+        RoomResultResponse(result_user_list=result, poll_interval=poll_interval),
+        response,
+        headers,
+    )
 
 
 class RoomLeaveRequest(BaseModel):
@@ -258,11 +654,66 @@ class RoomLeaveRequest(BaseModel):
 
 
 @app.post("/room/leave", response_model=Empty)
-def room_leave(req: RoomLeaveRequest, token: str = Depends(get_auth_token)):
+async def room_leave(
+    req: RoomLeaveRequest,
+    user: UserRef = Depends(get_current_user),
+    db=Depends(get_db),
+):
     """ライブの待機画面からの退出"""
     model.logger.info("Called /room/leave")
-    user = model.get_user_by_token(token)
-    if user is None:
-        raise HTTPException(status_code=404)
-    _ = model.leave_room(room_id=req.room_id, user=user)
+    _ = await async_model.leave_room(db, room_id=req.room_id, user=user)
+    await db.commit()
     return {}
+
+
+"""
+ランキング
+"""
+
+
+class LeaderboardEntry(BaseModel):
+    rank: int
+    user_id: int
+    score: int
+
+
+class LeaderboardTopRequest(BaseModel):
+    # 0 なら全楽曲を通したランキング
+    live_id: int
+    limit: int = Field(10, gt=0, le=config.LEADERBOARD_MAX_LIMIT)
+
+
+class LeaderboardTopResponse(BaseModel):
+    ranking: list[LeaderboardEntry]
+
+
+@app.post("/leaderboard/top", response_model=LeaderboardTopResponse)
+async def leaderboard_top(req: LeaderboardTopRequest):
+    """上位のランキング"""
+    entries = model.leaderboard.top(req.live_id, req.limit)
+    return LeaderboardTopResponse(
+        ranking=[LeaderboardEntry(**e._asdict()) for e in entries]
+    )
+
+
+class LeaderboardMeRequest(BaseModel):
+    live_id: int
+    neighbours: int = Field(5, ge=0, le=config.LEADERBOARD_MAX_NEIGHBOURS)
+
+
+class LeaderboardMeResponse(BaseModel):
+    # まだ記録がなければ None
+    me: Optional[LeaderboardEntry]
+    ranking: list[LeaderboardEntry]
+
+
+@app.post("/leaderboard/me", response_model=LeaderboardMeResponse)
+async def leaderboard_me(
+    req: LeaderboardMeRequest, user: UserRef = Depends(get_current_user)
+):
+    """自分の順位と、その上下のランキング"""
+    me, entries = model.leaderboard.around(req.live_id, user.id, req.neighbours)
+    return LeaderboardMeResponse(
+        me=LeaderboardEntry(**me._asdict()) if me is not None else None,
+        ranking=[LeaderboardEntry(**e._asdict()) for e in entries],
+    )
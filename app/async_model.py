@@ -0,0 +1,335 @@
+"""model の asyncio 版
+
+SQL 本体は model の `_xxx(conn, ...)` を共有し、AsyncConnection.run_sync で実行する。
+スレッドプールを使わずにイベントループ上で DB を待つ。
+各関数は RequestConnection を受け取り、1リクエストの中では同じコネクションとトランザクションを使う。
+読み取りだけの関数はリードレプリカで読むことがある (app.replica)。
+"""
+
+import asyncio
+from contextlib import asynccontextmanager, suppress
+from hashlib import sha256
+from time import perf_counter
+from typing import Any, Callable, List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from . import admission, config, events, metrics, model, replica, singleflight
+from .db import async_engine, async_replica_engine
+from .model import JoinRoomResult, LiveDifficulty, ResultUser, SafeUser, UserRef
+
+
+class RequestConnection:
+    """1リクエストで使うコネクションとトランザクション
+
+    最初に SQL を実行するときにプールから1つだけ借りる。キャッシュやメモリ上の
+    ルームだけで済むリクエストはコネクションを借りない。
+    commit で確定してからルームの変更イベントなどを配信し、commit せずに close したら rollback する。
+
+    read で実行する読み取りだけの SQL は、使えればリードレプリカのコネクションで実行する。
+    user_key (ハッシュしたトークン) のユーザーが書き込んだリクエストを commit したら、
+    そのユーザーの読み込みをしばらく primary に向ける。
+    """
+
+    def __init__(self):
+        self._conn: Optional[AsyncConnection] = None
+        self._replica: Optional[AsyncConnection] = None
+        self._after_commit: list[Callable[[], Any]] = []
+        self._wrote = False
+        self.user_key: Optional[str] = None
+
+    async def _primary(self) -> AsyncConnection:
+        if self._conn is None:
+            start = perf_counter()
+            self._conn = await async_engine.connect()
+            wait = perf_counter() - start
+            metrics.pool_checkout_wait.observe(wait, "async")
+            admission.monitor.observe_pool_wait(wait)
+        return self._conn
+
+    async def run(self, fn: Callable, *args):
+        """fn(conn, *args) をこのリクエストのコネクション上で実行する"""
+        self._wrote = True
+        return await (await self._primary()).run_sync(fn, *args)
+
+    def on_replica(self) -> bool:
+        """次の read がレプリカで読むか。一度 primary を使ったリクエストは primary で読み続ける"""
+        return self._conn is None and replica.router.use_replica(self.user_key)
+
+    async def read(self, fn: Callable, *args, primary: bool = False):
+        """読み取りだけの fn(conn, *args) を実行する
+
+        レプリカが使えないときと primary=True のときは primary で実行する。
+        """
+        if primary or not self.on_replica():
+            replica.reads.inc("primary")
+            return await (await self._primary()).run_sync(fn, *args)
+        replica.reads.inc("replica")
+        if self._replica is None:
+            self._replica = await async_replica_engine.connect()
+        return await self._replica.run_sync(fn, *args)
+
+    def after_commit(self, fn: Callable[[], Any]) -> None:
+        self._after_commit.append(fn)
+
+    async def commit(self) -> None:
+        if self._conn is not None:
+            await self._conn.commit()
+            events.publish_all(events.take(self._conn.sync_connection))
+            if self._wrote and self.user_key is not None:
+                replica.router.wrote(self.user_key)
+        callbacks, self._after_commit = self._after_commit, []
+        for fn in callbacks:
+            fn()
+
+    async def close(self) -> None:
+        self._after_commit = []
+        if self._replica is not None:
+            conn, self._replica = self._replica, None
+            await conn.close()
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            events.take(conn.sync_connection)
+            await conn.close()
+
+
+@asynccontextmanager
+async def connection():
+    """リクエストの外(ロングポーリングやベンチマーク)で使う。抜けるときに commit する"""
+    db = RequestConnection()
+    try:
+        yield db
+        await db.commit()
+    finally:
+        await db.close()
+
+
+def _user_key(token: str) -> str:
+    return sha256(token.encode()).hexdigest()
+
+
+async def create_user(db: RequestConnection, name: str, leader_card_id: int) -> str:
+    token = await db.run(model._create_user, name, leader_card_id)
+    db.user_key = _user_key(token)
+    return token
+
+
+async def create_users(
+    db: RequestConnection, users: list[tuple[str, int]]
+) -> list[str]:
+    return await db.run(model._create_users, users)
+
+
+async def get_user_by_token(db: RequestConnection, token: str) -> Optional[SafeUser]:
+    db.user_key = _user_key(token)
+    user = model.cached_user(token)
+    if user is not None:
+        return user
+    if db.on_replica():
+        try:
+            return await db.read(model._load_user, token)
+        except HTTPException as e:
+            if e.status_code != 404:
+                raise
+            # 他のワーカーで作ったばかりのユーザーがまだレプリカに届いていない
+    return await db.read(model._load_user, token, primary=True)
+
+
+async def identify(db: RequestConnection, token: str) -> UserRef:
+    """トークンのユーザー。署名つきトークンなら DB を読まず、id しか持たない
+
+    名前などが要るエンドポイント (/user/me) は get_user_by_token を使う。
+    """
+    db.user_key = _user_key(token)
+    user = model.signed_user(token)
+    if user is not None:
+        return user
+    return await get_user_by_token(db, token)
+
+
+async def _profile(db: RequestConnection, user: UserRef) -> SafeUser:
+    """memory バックエンドは参加者の名前などもメモリに持つので、参加するときに読む"""
+    if isinstance(user, SafeUser):
+        return user
+    return await db.read(model._profile, user, primary=True)
+
+
+async def update_user(
+    db: RequestConnection, token: str, name: str, leader_card_id: int
+) -> None:
+    db.user_key = _user_key(token)
+    user = None
+    if model.room_registry is not None:
+        user = await get_user_by_token(db, token)
+    await db.run(model._update_user, token, name, leader_card_id)
+    db.after_commit(lambda: model._user_updated(token, user, name, leader_card_id))
+
+
+async def create_room(
+    db: RequestConnection, token: str, live_id: int, select_difficulty: int
+) -> int:
+    return await db.run(model._create_room, token, live_id, select_difficulty)
+
+
+async def list_room(db: RequestConnection, live_id: int) -> List:
+    if model.room_registry is not None:
+        return model.room_registry.list_room(live_id)
+    rooms = model.room_index.lookup(live_id)
+    if rooms is not None:
+        return rooms
+    on_replica = db.on_replica()
+    lag = replica.router.max_lag if on_replica else 0.0
+    # 索引が使えない間 (起動直後など) に来た /room/list は、同じ live_id なら1回の読み込みにまとめる
+    return await singleflight.flights.do(
+        "list",
+        (live_id, on_replica),
+        model.room_index.version,
+        lambda: db.read(model._list_room, live_id, lag),
+    )
+
+
+async def join_room(
+    db: RequestConnection,
+    room_id: int,
+    select_difficulty: LiveDifficulty,
+    user: UserRef,
+) -> JoinRoomResult:
+    registry = model.room_registry
+    if registry is not None and registry.owns(room_id):
+        with suppress(model.RoomNotOwned):
+            user = await _profile(db, user)
+            return registry.join_room(room_id, select_difficulty, user)
+    return await db.run(model._join_room, room_id, select_difficulty, user)
+
+
+async def quick_join_room(
+    db: RequestConnection,
+    token: str,
+    live_id: int,
+    select_difficulty: LiveDifficulty,
+    user: UserRef,
+) -> tuple[int, bool]:
+    registry = model.room_registry
+    if registry is not None:
+        user = await _profile(db, user)
+        room_id = registry.quick_join_room(live_id, select_difficulty, user)
+        if room_id is not None:
+            return room_id, False
+        return await create_room(db, token, live_id, select_difficulty), True
+    for retries in range(config.QUICKJOIN_LOCK_RETRIES, -1, -1):
+        joined = await db.run(
+            model._quick_join_room, token, live_id, select_difficulty, user, retries > 0
+        )
+        if joined is not None:
+            return joined
+        # 飛ばしたルームのロックが外れるのを待つ間、試したルームのロックを持たない
+        await db.commit()
+        await asyncio.sleep(config.QUICKJOIN_LOCK_RETRY_INTERVAL)
+
+
+async def room_version(db: RequestConnection, room_id: int) -> Optional[int]:
+    registry = model.room_registry
+    if registry is not None and registry.owns(room_id):
+        with suppress(model.RoomNotOwned):
+            return registry.room_version(room_id)
+    on_replica = db.on_replica()
+    version = await db.read(model._room_version, room_id)
+    if version is None and on_replica:
+        # 作ったばかりのルームがまだレプリカに届いていない。続く wait_room も primary で読む
+        version = await db.read(model._room_version, room_id, primary=True)
+    return version
+
+
+async def wait_room(
+    db: RequestConnection,
+    room_id: int,
+    user: UserRef,
+    version: Optional[int] = None,
+):
+    """同じルームを同時に待っている人の読み込みは1回にまとめ、is_me だけ各自で埋める
+
+    version を渡したら、そのバージョンのルームを返す (ETag と中身を食い違わせない)。
+    まとめた読み込みが別のバージョンを読んでいたら、このリクエストのトランザクションで読み直す。
+    """
+    registry = model.room_registry
+    if registry is not None and registry.owns(room_id):
+        with suppress(model.RoomNotOwned):
+            return registry.wait_room(room_id, user)
+    # primary で読むべきリクエストがレプリカの結果に相乗りしないよう、読む先もキーに入れる
+    snapshot = await singleflight.flights.do(
+        "wait",
+        (room_id, db.on_replica()),
+        events.room_events.version(room_id),
+        lambda: db.read(model._wait_room_snapshot, room_id),
+    )
+    if version is not None and snapshot[0] != version:
+        snapshot = await db.read(model._wait_room_snapshot, room_id)
+    _, is_start, rows = snapshot
+    return is_start, model._room_users(rows, user)
+
+
+async def start_room(db: RequestConnection, room_id: int, user: UserRef) -> None:
+    registry = model.room_registry
+    if registry is not None and registry.owns(room_id):
+        with suppress(model.RoomNotOwned):
+            return registry.start_room(room_id, user)
+    return await db.run(model._start_room, room_id, user)
+
+
+async def end_room(
+    db: RequestConnection,
+    room_id: int,
+    score: int,
+    user: UserRef,
+    judge_count_list: list[int],
+) -> None:
+    registry = model.room_registry
+    if registry is not None and registry.owns(room_id):
+        with suppress(model.RoomNotOwned):
+            return registry.end_room(room_id, score, user, judge_count_list)
+    if model.end_buffer is not None:
+        # 他の end とまとめてコミットされるまで待つ。このリクエストのコネクションは使わない
+        return await asyncio.wrap_future(
+            model.end_buffer.submit(room_id, score, user, judge_count_list)
+        )
+    results = await db.run(model._end_room, room_id, score, user, judge_count_list)
+    if results is not None:
+        db.after_commit(lambda: model.result_snapshots.set(room_id, results))
+
+
+async def result_room(db: RequestConnection, room_id: int) -> list[ResultUser]:
+    registry = model.room_registry
+    if registry is not None and registry.owns(room_id):
+        with suppress(model.RoomNotOwned):
+            return registry.result_room(room_id)
+    results = model.result_snapshots.get(room_id)
+    if results is not None:
+        return results
+    on_replica = db.on_replica()
+    # 終了直後は同じルームの全員が同時にポーリングするので、読み込みを1回にまとめる。
+    # 確定させる(書き込む)のは共有できないので、まとめた読み込みでは確定させない
+    results = await singleflight.flights.do(
+        "result",
+        (room_id, on_replica),
+        events.room_events.version(room_id),
+        lambda: db.read(model._result_room, room_id, False),
+    )
+    if results is None:
+        # 締め切りを過ぎていて確定させる。書き込むので primary で
+        results = await db.run(model._result_room, room_id)
+    if results:
+        db.after_commit(lambda: model.result_snapshots.set(room_id, results))
+    return results
+
+
+async def leave_room(db: RequestConnection, room_id: int, user: UserRef) -> None:
+    registry = model.room_registry
+    if registry is not None and registry.owns(room_id):
+        with suppress(model.RoomNotOwned):
+            return registry.leave_room(room_id, user)
+    return await db.run(model._leave_room, room_id, user)
+
+
+async def load_leaderboard(db: RequestConnection) -> None:
+    await db.run(model._load_leaderboard)
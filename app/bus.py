@@ -0,0 +1,313 @@
+"""ワーカー間のイベントバス
+
+uvicorn を複数ワーカーで動かすと、ルームのイベント (RoomEventHub) や token -> user のキャッシュは
+ワーカーごとにある。あるワーカーでの join/leave を他のワーカーの索引・ロングポーリング・
+ランキングに届け、キャッシュの無効化を配るためにメッセージを全ワーカーに送る。
+
+- "unix": 同じホストのワーカー同士。ディレクトリに置いた Unix ドメインソケット(データグラム)で送る
+- "redis": 複数ホスト。Redis の pub/sub で送る (redis パッケージが必要)
+- LocalBroker: テスト用。1プロセス内の複数のバスをつなぐ
+
+メッセージは届けばよいものに限る。取りこぼしても索引の突き合わせや TTL で直る。
+"""
+
+import abc
+import json
+import os
+import queue
+import socket
+import threading
+import uuid
+from collections import defaultdict
+from contextlib import suppress
+from time import monotonic
+from typing import Callable, Optional
+
+from . import config, log, metrics
+
+logger = log.get_logger(__name__)
+
+
+class EventBus(abc.ABC):
+    """publish したメッセージを自分以外の全ワーカーの handler に届ける"""
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex
+        self._handlers: dict[str, list[Callable[[dict], None]]] = defaultdict(list)
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    def subscribe(self, kind: str, handler: Callable[[dict], None]) -> None:
+        self._handlers[kind].append(handler)
+
+    def publish(self, kind: str, **payload) -> None:
+        message = dict(payload, kind=kind, origin=self.worker_id)
+        self._send(json.dumps(message, separators=(",", ":")).encode())
+        self.sent += 1
+
+    def _deliver(self, data: bytes) -> None:
+        message = json.loads(data)
+        if message.get("origin") == self.worker_id:
+            return
+        self.received += 1
+        for handler in self._handlers.get(message["kind"], ()):
+            try:
+                handler(message)
+            except Exception:
+                logger.exception("Event bus handler failed: {}".format(message))
+
+    @abc.abstractmethod
+    def _send(self, data: bytes) -> None:
+        pass
+
+    def start(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class LocalBroker:
+    """テスト用。connect したバス同士で、publish したスレッドからそのまま届ける"""
+
+    def __init__(self):
+        self.buses: list["LocalBus"] = []
+
+    def connect(self) -> "LocalBus":
+        bus = LocalBus(self)
+        self.buses.append(bus)
+        return bus
+
+
+class LocalBus(EventBus):
+    def __init__(self, broker: LocalBroker):
+        super().__init__()
+        self._broker = broker
+
+    def _send(self, data: bytes) -> None:
+        for bus in self._broker.buses:
+            if bus is not self:
+                bus._deliver(data)
+
+
+class QueuedBus(EventBus):
+    """publish はキューに積むだけにし、送るのは送信用のスレッドで行う
+
+    publish はコミットの後にイベントループの上から呼ばれるので、ソケットやネットワークを待てない。
+    キューがいっぱいなら捨てて dropped に数える。
+    """
+
+    QUEUE_SIZE = 10000
+    STOP_TIMEOUT = 1.0
+
+    def __init__(self):
+        super().__init__()
+        self._queue: queue.Queue = queue.Queue(self.QUEUE_SIZE)
+        self._sender: Optional[threading.Thread] = None
+
+    def _send(self, data: bytes) -> None:
+        try:
+            self._queue.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self) -> None:
+        self._sender = threading.Thread(
+            target=self._run_sender, name="event-bus-send", daemon=True
+        )
+        self._sender.start()
+
+    def _run_sender(self) -> None:
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            try:
+                self._write(data)
+            except Exception:
+                logger.exception("Failed to send event bus message.")
+
+    def _stop_sender(self) -> None:
+        """積んであるメッセージを送り終えるのを STOP_TIMEOUT 秒まで待つ"""
+        if self._sender is None:
+            return
+        with suppress(queue.Full):
+            self._queue.put(None, timeout=self.STOP_TIMEOUT)
+        self._sender.join(self.STOP_TIMEOUT)
+        self._sender = None
+
+    @abc.abstractmethod
+    def _write(self, data: bytes) -> None:
+        """送信用のスレッドから呼ばれる"""
+
+
+class UnixSocketBus(QueuedBus):
+    """同じホストのワーカー同士。directory にワーカーごとのソケットを置き、全員に送る
+
+    送り先の一覧は PEER_REFRESH 秒ごとに directory から読み直す。
+    送信用のスレッドで、受け手のキュー (net.unix.max_dgram_qlen) が空くのを SEND_TIMEOUT 秒まで待ち、
+    それでも送れなければ捨てて dropped に数える。
+    """
+
+    PEER_REFRESH = 1.0
+    SEND_TIMEOUT = 0.05
+    MAX_MESSAGE = 65536
+
+    def __init__(self, directory: str):
+        super().__init__()
+        self.directory = directory
+        self.path = os.path.join(directory, self.worker_id + ".sock")
+        self._sock: Optional[socket.socket] = None
+        # 送信用。受信用のソケットにタイムアウトをつけないように分ける
+        self._send_sock: Optional[socket.socket] = None
+        self._peers: list[str] = []
+        self._peers_at: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._send_sock.settimeout(self.SEND_TIMEOUT)
+        self._thread = threading.Thread(target=self._run, name="event-bus", daemon=True)
+        self._thread.start()
+        super().start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                data = self._sock.recv(self.MAX_MESSAGE)
+            except OSError:
+                # close された
+                return
+            if not data:
+                # shutdown された
+                return
+            try:
+                self._deliver(data)
+            except Exception:
+                logger.exception("Broken event bus message.")
+
+    def _refresh_peers(self) -> list[str]:
+        now = monotonic()
+        if self._peers_at is None or now - self._peers_at > self.PEER_REFRESH:
+            self._peers = [
+                os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith(".sock")
+                and os.path.join(self.directory, name) != self.path
+            ]
+            self._peers_at = now
+        return self._peers
+
+    def _write(self, data: bytes) -> None:
+        for peer in self._refresh_peers():
+            try:
+                self._send_sock.sendto(data, peer)
+            except (BlockingIOError, socket.timeout):
+                self.dropped += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 終了したワーカーのソケット
+                self._peers_at = None
+                try:
+                    os.unlink(peer)
+                except FileNotFoundError:
+                    pass
+
+    def close(self) -> None:
+        if self._sock is not None:
+            self._stop_sender()
+            self._send_sock.close()
+            try:
+                # recv で待っているスレッドを起こす
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class RedisBus(QueuedBus):
+    """複数ホスト。Redis の channel に publish し、全ワーカーが subscribe する"""
+
+    def __init__(self, url: str, channel: str):
+        super().__init__()
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self._channel = channel
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._pubsub.subscribe(self._channel)
+        self._thread = threading.Thread(target=self._run, name="event-bus", daemon=True)
+        self._thread.start()
+        super().start()
+
+    def _run(self) -> None:
+        try:
+            for message in self._pubsub.listen():
+                self._deliver(message["data"])
+        except Exception:
+            # close された
+            return
+
+    def _write(self, data: bytes) -> None:
+        try:
+            self._redis.publish(self._channel, data)
+        except Exception:
+            self.dropped += 1
+            logger.exception("Failed to publish to event bus.")
+
+    def close(self) -> None:
+        self._stop_sender()
+        self._pubsub.close()
+        self._redis.close()
+
+
+def create(kind: str) -> Optional[EventBus]:
+    """config.EVENT_BUS からバスを作る。"" なら使わない"""
+    if not kind:
+        return None
+    if kind == "unix":
+        return UnixSocketBus(config.EVENT_BUS_DIR)
+    if kind == "redis":
+        return RedisBus(config.EVENT_BUS_REDIS_URL, config.EVENT_BUS_CHANNEL)
+    raise ValueError("Unknown EVENT_BUS: {}".format(kind))
+
+
+def relay_room_events(bus: EventBus, hub) -> None:
+    """hub で publish したルームのイベントを他のワーカーの hub にも publish する"""
+    hub.relay = lambda room_id, event, data: bus.publish(
+        "room", room_id=room_id, event=event, data=data
+    )
+    bus.subscribe(
+        "room",
+        lambda m: hub.publish(m["room_id"], m["event"], m["data"], remote=True),
+    )
+
+
+current: Optional[EventBus] = None
+
+metrics.registry.register(
+    metrics.Counter(
+        "gameserver_event_bus_messages_total",
+        "ワーカー間のイベントバスで送った・受け取った・捨てたメッセージの数",
+        ("direction",),
+        callback=lambda: (
+            {}
+            if current is None
+            else {
+                ("sent",): current.sent,
+                ("received",): current.received,
+                ("dropped",): current.dropped,
+            }
+        ),
+    )
+)
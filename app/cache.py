@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """サイズ上限とTTLつきのLRUキャッシュ
+
+    maxsize: 保持する最大エントリ数。超えた場合は最も古く使われたものから捨てる
+    ttl: エントリの有効期間(秒)
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # invalidate が呼ばれるたびに進む。読み込み中に無効化が走った値を捨てるのに使う
+        self._stamp = 0
+
+    def stamp(self) -> int:
+        """DBから読み込む前に取得し、set に渡す"""
+        return self._stamp
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires < monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, stamp: Optional[int] = None) -> None:
+        with self._lock:
+            # 読み込み開始後に無効化されていたら古い値の可能性があるので入れない
+            if stamp is not None and stamp != self._stamp:
+                return
+            self._data[key] = (monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._stamp += 1
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._stamp += 1
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(
+                size=len(self._data),
+                maxsize=self.maxsize,
+                hits=self.hits,
+                misses=self.misses,
+            )
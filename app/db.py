@@ -1,5 +1,45 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
 
-from . import config
+from . import config, metrics, statements
 
-engine = create_engine(config.DATABASE_URI, future=True, echo=True)
+# SQL のエコーは app.log.set_sql_echo で切り替える
+engine = create_engine(config.DATABASE_URI, future=True)
+
+# リクエスト処理用の asyncio ネイティブなエンジン
+async_engine = create_async_engine(config.ASYNC_DATABASE_URI, future=True)
+
+metrics.instrument_engine(engine)
+metrics.instrument_engine(async_engine.sync_engine)
+statements.instrument_engine(engine)
+statements.instrument_engine(async_engine.sync_engine)
+
+# 読み取りだけのリクエスト用のリードレプリカ (app.replica)。設定しなければ None
+replica_engine = None
+async_replica_engine = None
+if config.REPLICA_DATABASE_URI and config.ASYNC_REPLICA_DATABASE_URI:
+    replica_engine = create_engine(config.REPLICA_DATABASE_URI, future=True)
+    async_replica_engine = create_async_engine(
+        config.ASYNC_REPLICA_DATABASE_URI, future=True
+    )
+    for e in (replica_engine, async_replica_engine.sync_engine):
+        metrics.instrument_engine(e)
+        statements.instrument_engine(e)
+
+
+def _checked_out(pool) -> int:
+    # QueuePool 以外(テスト用の SQLite など)は数えない
+    return pool.checkedout() if hasattr(pool, "checkedout") else 0
+
+
+metrics.registry.register(
+    metrics.Gauge(
+        "gameserver_db_pool_checked_out",
+        "貸し出し中のコネクション数",
+        ("engine",),
+        callback=lambda: {
+            ("sync",): _checked_out(engine.pool),
+            ("async",): _checked_out(async_engine.pool),
+        },
+    )
+)
@@ -0,0 +1,134 @@
+import asyncio
+import math
+import threading
+from collections import defaultdict
+from time import monotonic
+from typing import Callable, Optional, Union
+
+from . import config
+
+
+class RoomEventHub:
+    """ルームの状態バージョンを管理し、変更を待っているクライアントを起こす
+
+    ルームが変更されるたびにバージョンが1つ進む。
+    publish はスレッドプール上の同期処理からも呼ばれるので、待機側の
+    イベントループには call_soon_threadsafe で通知する。
+    retention 秒変化のないルームのバージョンは捨てる (0 からやり直しになる)。
+    """
+
+    def __init__(self, retention: float = math.inf):
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._versions: dict[int, int] = {}
+        # 最後に変わった時刻 (monotonic)。古い順に並べておく
+        self._changed_at: dict[int, float] = {}
+        self._waiters: dict[int, list] = defaultdict(list)
+        self._listeners: list[Callable[[int, str, int, dict], None]] = []
+        # relay(room_id, event, data) でこのプロセスのイベントを他のワーカーに送る (app.bus)
+        self.relay: Optional[Callable[[int, str, dict], None]] = None
+
+    def version(self, room_id: int) -> int:
+        return self._versions.get(room_id, 0)
+
+    def idle(self, room_id: int) -> float:
+        """最後に変わってからの秒数。このプロセスで変更を見ていなければ inf"""
+        changed_at = self._changed_at.get(room_id)
+        return monotonic() - changed_at if changed_at is not None else math.inf
+
+    def subscribe(self, listener: Callable[[int, str, int, dict], None]) -> None:
+        """listener(room_id, event, version, data) を publish のたびに呼ぶ"""
+        self._listeners.append(listener)
+
+    def publish(
+        self, room_id: int, event: str, data: Optional[dict] = None, remote=False
+    ) -> int:
+        """data には変更後のルームの状態のうち分かっているもの(live_id など)を入れる
+
+        remote は他のワーカーから届いたイベント。送り返さない。
+        """
+        now = monotonic()
+        with self._lock:
+            version = self._versions.get(room_id, 0) + 1
+            self._versions[room_id] = version
+            self._changed_at.pop(room_id, None)
+            self._changed_at[room_id] = now
+            self._expire(now)
+            waiters = self._waiters.pop(room_id, [])
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future, version)
+        for listener in self._listeners:
+            listener(room_id, event, version, data or {})
+        if self.relay is not None and not remote:
+            self.relay(room_id, event, data or {})
+        return version
+
+    def _expire(self, now: float) -> None:
+        while self._changed_at:
+            room_id, changed_at = next(iter(self._changed_at.items()))
+            if now - changed_at <= self.retention:
+                break
+            del self._changed_at[room_id]
+            self._versions.pop(room_id, None)
+
+    async def wait(self, room_id: int, version: int, timeout: float) -> int:
+        """バージョンが version から進むか timeout 秒経つまで待ち、最新のバージョンを返す"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self._lock:
+            current = self._versions.get(room_id, 0)
+            if current != version:
+                return current
+            self._waiters[room_id].append(waiter)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return self.version(room_id)
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(room_id)
+                if waiters is not None and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._waiters[room_id]
+
+    def forget(self, room_id: int) -> None:
+        """片付けたルームのバージョンを捨てる"""
+        with self._lock:
+            self._versions.pop(room_id, None)
+            self._changed_at.pop(room_id, None)
+
+
+def _wake(future: asyncio.Future, version: int) -> None:
+    if not future.done():
+        future.set_result(version)
+
+
+# コミット後にすること。(room_id, event, data) のイベントか、呼び出す関数
+Deferred = Union[tuple[int, str, dict], Callable[[], object]]
+
+
+def defer(conn, room_id: int, event: str, **data) -> None:
+    """トランザクション中の変更を記録する。コミット後に publish_all で配信する"""
+    conn.info.setdefault("room_events", []).append((room_id, event, data))
+
+
+def defer_call(conn, fn: Callable[[], object]) -> None:
+    """コミットできたら publish_all で fn() を呼ぶ。rollback したら呼ばない"""
+    conn.info.setdefault("room_events", []).append(fn)
+
+
+def take(conn) -> list[Deferred]:
+    return conn.info.pop("room_events", [])
+
+
+def publish_all(events: list[Deferred]) -> None:
+    for deferred in events:
+        if callable(deferred):
+            deferred()
+        else:
+            room_events.publish(*deferred)
+
+
+room_events = RoomEventHub(retention=config.ROOM_EVENT_RETENTION)
@@ -0,0 +1,133 @@
+"""/room/end のグループコミット
+
+曲が終わると、一緒に始めたルームの全員がほぼ同時に /room/end を呼ぶ。
+1リクエスト1トランザクションだと end の数だけコミット(と redo log の fsync)が走るので、
+END_ROOM_GROUP_COMMIT_WINDOW 秒の間に来た end を1つのトランザクションにまとめ、
+model._end_rooms の複数行の UPDATE で書いてコミットする。
+各リクエストにはそのコミットが終わってから応答する。
+
+まとめたトランザクションが失敗したら(デッドロックなど)、1件ずつのトランザクションでやり直す。
+"""
+
+import queue
+import threading
+from concurrent.futures import Future
+from time import monotonic
+from typing import Optional
+
+from . import config, log, metrics, model
+
+logger = log.get_logger(__name__)
+
+batch_size = metrics.registry.register(
+    metrics.Histogram(
+        "gameserver_end_room_batch_size",
+        "1回のコミットにまとめた /room/end の数",
+        buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+    )
+)
+fallbacks = metrics.registry.register(
+    metrics.Counter(
+        "gameserver_end_room_batch_fallbacks_total",
+        "まとめたトランザクションが失敗して1件ずつやり直したバッチの数",
+    )
+)
+
+
+class EndRoomBuffer:
+    """end_room を受け付けてまとめて書くスレッド
+
+    submit が返す Future は、その end がコミットされたら None、失敗したら例外で完了する。
+    """
+
+    def __init__(
+        self,
+        window: float = config.END_ROOM_GROUP_COMMIT_WINDOW,
+        max_batch: int = config.END_ROOM_GROUP_COMMIT_MAX_BATCH,
+    ):
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self.batches = 0
+        self._thread = threading.Thread(
+            target=self._run, name="end-room-group-commit", daemon=True
+        )
+        self._thread.start()
+
+    def submit(
+        self,
+        room_id: int,
+        score: int,
+        user: model.UserRef,
+        judge_count_list: list[int],
+    ) -> Future:
+        future: Future = Future()
+        self._queue.put((room_id, score, user, list(judge_count_list), future))
+        return future
+
+    def _collect(self) -> Optional[list[tuple]]:
+        """最初の1件を待ち、そこから window 秒か max_batch 件まで集める。close されたら None"""
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # 集めた分を書いてから終わる
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def flush(self, batch: list[tuple]) -> None:
+        submissions = [item[:4] for item in batch]
+        try:
+            with model.transaction() as conn:
+                finalized = model._end_rooms(conn, submissions)
+        except Exception:
+            logger.exception(
+                "Failed to end {} submissions at once. Retry one by one.".format(
+                    len(batch)
+                )
+            )
+            fallbacks.inc()
+            for room_id, score, user, judge_count_list, future in batch:
+                self._flush_one(room_id, score, user, judge_count_list, future)
+            return
+        self.batches += 1
+        batch_size.observe(len(batch))
+        for room_id, results in finalized.items():
+            model.result_snapshots.set(room_id, results)
+        for item in batch:
+            item[-1].set_result(None)
+
+    def _flush_one(self, room_id, score, user, judge_count_list, future) -> None:
+        try:
+            with model.transaction() as conn:
+                results = model._end_room(conn, room_id, score, user, judge_count_list)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        if results is not None:
+            model.result_snapshots.set(room_id, results)
+        future.set_result(None)
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            self.flush(batch)
+
+    def close(self) -> None:
+        """受け付け済みの end を書いてから止める"""
+        self._queue.put(None)
+        self._thread.join()
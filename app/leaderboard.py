@@ -0,0 +1,196 @@
+import random
+import threading
+from typing import Iterable, NamedTuple, Optional
+
+# live_id がこの値のランキングは全楽曲をまとめたもの
+GLOBAL = 0
+
+
+class RankedEntry(NamedTuple):
+    rank: int
+    user_id: int
+    score: int
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, level: int):
+        self.key = key
+        self.next: list[Optional["_Node"]] = [None] * level
+        # next[i] までに進む順位の数
+        self.width = [0] * level
+
+
+class RankedScores:
+    """スコアの高い順に (score, user_id) を並べた、順位つきのスキップリスト
+
+    追加・削除・順位・n 位の取得が O(log n)。同点は user_id の小さい方が上になる。
+    """
+
+    MAX_LEVEL = 32
+    P = 0.25
+
+    def __init__(self):
+        self._head = _Node(None, self.MAX_LEVEL)
+        self._level = 1
+        self._head.width[0] = 1
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @staticmethod
+    def _key(score: int, user_id: int) -> tuple:
+        return (-score, user_id)
+
+    def _random_level(self) -> int:
+        level = 1
+        while level < self.MAX_LEVEL and random.random() < self.P:
+            level += 1
+        return level
+
+    def add(self, score: int, user_id: int) -> None:
+        key = self._key(score, user_id)
+        update: list[_Node] = [self._head] * self.MAX_LEVEL
+        ranks = [0] * self.MAX_LEVEL
+        node = self._head
+        pos = 0
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.next[i].key < key:
+                pos += node.width[i]
+                node = node.next[i]
+            update[i] = node
+            ranks[i] = pos
+        level = self._random_level()
+        if level > self._level:
+            for i in range(self._level, level):
+                # 末尾(None)は size + 1 位にあるとみなす
+                self._head.width[i] = self._size + 1
+            self._level = level
+        new = _Node(key, level)
+        for i in range(level):
+            new.next[i] = update[i].next[i]
+            update[i].next[i] = new
+            new.width[i] = update[i].width[i] - (pos - ranks[i])
+            update[i].width[i] = pos - ranks[i] + 1
+        for i in range(level, self._level):
+            update[i].width[i] += 1
+        self._size += 1
+
+    def remove(self, score: int, user_id: int) -> bool:
+        key = self._key(score, user_id)
+        update: list[_Node] = [self._head] * self.MAX_LEVEL
+        node = self._head
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.next[i].key < key:
+                node = node.next[i]
+            update[i] = node
+        target = node.next[0]
+        if target is None or target.key != key:
+            return False
+        for i in range(self._level):
+            if update[i].next[i] is target:
+                update[i].width[i] += target.width[i] - 1
+                update[i].next[i] = target.next[i]
+            else:
+                update[i].width[i] -= 1
+        while self._level > 1 and self._head.next[self._level - 1] is None:
+            self._level -= 1
+        self._size -= 1
+        return True
+
+    def rank(self, score: int, user_id: int) -> Optional[int]:
+        """1 始まりの順位。無ければ None"""
+        key = self._key(score, user_id)
+        node = self._head
+        pos = 0
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.next[i].key <= key:
+                pos += node.width[i]
+                node = node.next[i]
+        return pos if node.key == key else None
+
+    def from_rank(self, start: int, count: int) -> list[RankedEntry]:
+        """start 位から count 件"""
+        start = max(start, 1)
+        if count <= 0 or start > self._size:
+            return []
+        node = self._head
+        pos = 0
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and pos + node.width[i] <= start:
+                pos += node.width[i]
+                node = node.next[i]
+        entries = []
+        while node is not None and len(entries) < count:
+            entries.append(RankedEntry(pos, node.key[1], -node.key[0]))
+            node = node.next[0]
+            pos += 1
+        return entries
+
+
+class Leaderboard:
+    """live_id ごとと全体のランキング
+
+    ユーザーごとに自己ベストだけを持つ。全体のランキングは全楽曲を通した自己ベスト。
+    /room/end のイベントで更新し、起動時に MySQL から作り直す。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._boards: dict[int, RankedScores] = {}
+        # (live_id, user_id) -> 自己ベスト
+        self._best: dict[tuple[int, int], int] = {}
+
+    def _record(self, live_id: int, user_id: int, score: int) -> None:
+        best = self._best.get((live_id, user_id))
+        if best is not None and best >= score:
+            return
+        board = self._boards.setdefault(live_id, RankedScores())
+        if best is not None:
+            board.remove(best, user_id)
+        board.add(score, user_id)
+        self._best[(live_id, user_id)] = score
+
+    def record(self, live_id: int, user_id: int, score: int) -> None:
+        if score <= 0:
+            return
+        with self._lock:
+            self._record(live_id, user_id, score)
+            self._record(GLOBAL, user_id, score)
+
+    def on_event(self, room_id: int, event: str, version: int, data: dict) -> None:
+        """RoomEventHub の listener"""
+        if event == "end" and "score" in data:
+            self.record(data["live_id"], data["user_id"], data["score"])
+
+    def rebuild(self, rows: Iterable) -> None:
+        """(live_id, user_id, score) の行から作り直す"""
+        with self._lock:
+            self._boards = {}
+            self._best = {}
+            for row in rows:
+                self._record(row.live_id, row.user_id, row.score)
+                self._record(GLOBAL, row.user_id, row.score)
+
+    def top(self, live_id: int, limit: int) -> list[RankedEntry]:
+        with self._lock:
+            board = self._boards.get(live_id)
+            return board.from_rank(1, limit) if board is not None else []
+
+    def around(
+        self, live_id: int, user_id: int, neighbours: int
+    ) -> tuple[Optional[RankedEntry], list[RankedEntry]]:
+        """user_id の順位と、その上下 neighbours 人ずつ"""
+        with self._lock:
+            score = self._best.get((live_id, user_id))
+            if score is None:
+                return None, []
+            board = self._boards[live_id]
+            rank = board.rank(score, user_id)
+            start = max(rank - neighbours, 1)
+            return (
+                RankedEntry(rank, user_id, score),
+                board.from_rank(start, rank + neighbours - start + 1),
+            )
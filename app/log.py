@@ -0,0 +1,115 @@
+import atexit
+import logging
+import os
+import queue
+import random
+import signal
+from logging import FileHandler, Formatter, Logger, StreamHandler, getLogger
+from logging.handlers import QueueHandler, QueueListener
+
+from . import config, metrics
+
+FILE_FORMAT = (
+    "%(asctime)s - %(levelname)s - %(filename)s - %(name)s - %(funcName)s - %(message)s"
+)
+STREAM_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+dropped_records = metrics.registry.register(
+    metrics.Counter(
+        "gameserver_log_dropped_total",
+        "キューが溢れた・間引いたために捨てたログの数",
+        ("reason",),
+    )
+)
+
+
+class SamplingFilter(logging.Filter):
+    """level 以下のログを rate の割合だけ通す。WARN 以上は常に通す"""
+
+    def __init__(self, rate: float, level: int = logging.INFO):
+        super().__init__()
+        self.rate = rate
+        self.level = level
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.level or self.rate >= 1.0:
+            return True
+        if random.random() < self.rate:
+            return True
+        dropped_records.inc("sampled")
+        return False
+
+
+class DroppingQueueHandler(QueueHandler):
+    """キューが一杯ならリクエストを待たせずにログを捨てる"""
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records.inc("queue_full")
+
+
+def _build_handlers() -> list[logging.Handler]:
+    os.makedirs(config.LOG_DIR, exist_ok=True)
+
+    # ログをファイルへ
+    fh = FileHandler(os.path.join(config.LOG_DIR, "debug.log"))
+    fh.setLevel(config.LOG_DEBUG_FILE_LEVEL)
+    fh.setFormatter(Formatter(FILE_FORMAT))
+
+    # WARN以上のログは別で保管する
+    fh2 = FileHandler(os.path.join(config.LOG_DIR, "warn.log"))
+    fh2.setLevel(config.LOG_WARN_FILE_LEVEL)
+    fh2.setFormatter(Formatter(FILE_FORMAT))
+
+    # ログを標準出力へ
+    sh = StreamHandler()
+    sh.setLevel(config.LOG_STREAM_LEVEL)
+    sh.setFormatter(Formatter(STREAM_FORMAT))
+    return [fh, fh2, sh]
+
+
+# リクエストを処理するスレッドはキューに積むだけで、書き込みは専用のスレッドが行う
+_queue: queue.Queue = queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+queue_handler = DroppingQueueHandler(_queue)
+queue_handler.addFilter(SamplingFilter(config.LOG_SAMPLE_RATE))
+_handlers = _build_handlers()
+_listener = QueueListener(_queue, *_handlers, respect_handler_level=True)
+_listener.start()
+atexit.register(_listener.stop)
+
+
+def get_logger(name: str) -> Logger:
+    """キュー経由で書き込むロガーを返す"""
+    logger = getLogger(name)
+    # ログが複数回表示されるのを防止
+    logger.propagate = False
+    # どの出力先でも使わないレベルのログは、キューに積む前に捨てる
+    logger.setLevel(min(h.level for h in _handlers))
+    if queue_handler not in logger.handlers:
+        logger.addHandler(queue_handler)
+    return logger
+
+
+# SQLAlchemy のエコー(実行した SQL とパラメータ)も同じパイプラインに流す
+_sql_logger = get_logger("sqlalchemy.engine")
+
+
+def set_sql_echo(enabled: bool) -> None:
+    """実行中に SQL のエコーを切り替える"""
+    _sql_logger.setLevel(logging.INFO if enabled else logging.WARN)
+
+
+def toggle_sql_echo(*_) -> None:
+    set_sql_echo(_sql_logger.level > logging.INFO)
+
+
+set_sql_echo(config.SQL_ECHO)
+if hasattr(signal, "SIGUSR1"):
+    # kill -USR1 <pid> で SQL のエコーを切り替える
+    try:
+        signal.signal(signal.SIGUSR1, toggle_sql_echo)
+    except ValueError:
+        # メインスレッド以外で import された
+        pass
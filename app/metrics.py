@@ -0,0 +1,292 @@
+import abc
+import re
+import threading
+from bisect import bisect_left
+from time import perf_counter
+from typing import Callable, Optional
+
+from sqlalchemy import event
+
+# 秒単位のレイテンシ用のバケット
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for n, v in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric(abc.ABC):
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        return [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ] + self._samples()
+
+    @abc.abstractmethod
+    def _samples(self) -> list[str]:
+        pass
+
+
+class Counter(_Metric):
+    """callback を渡すと、描画時にその戻り値 {ラベルのタプル: 値} を使う"""
+
+    kind = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple = (),
+        callback: Optional[Callable[[], dict]] = None,
+    ):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+        self._callback = callback
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def total(self) -> float:
+        """全てのラベルの合計"""
+        with self._lock:
+            return sum(self._values.values())
+
+    def _samples(self) -> list[str]:
+        if self._callback is not None:
+            with self._lock:
+                self._values = dict(self._callback())
+        with self._lock:
+            items = list(self._values.items())
+        return [
+            "{}{} {}".format(self.name, _format_labels(self.label_names, k), v)
+            for k, v in items
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value: float) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labels: tuple = (), buckets=LATENCY_BUCKETS
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # ラベル -> [各バケットの件数..., +Inf の件数, 合計]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def count(self, *labels) -> int:
+        counts = self._values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        lines = []
+        for k, counts in items:
+            cumulative = 0
+            for le, c in zip(self.buckets + ("+Inf",), counts[:-1]):
+                cumulative += c
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        self.name,
+                        _format_labels(self.label_names, k, 'le="{}"'.format(le)),
+                        cumulative,
+                    )
+                )
+            labels = _format_labels(self.label_names, k)
+            lines.append("{}_sum{} {}".format(self.name, labels, counts[-1]))
+            lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_request_duration = registry.register(
+    Histogram(
+        "gameserver_http_request_duration_seconds",
+        "エンドポイントごとのレイテンシ",
+        ("endpoint", "method"),
+    )
+)
+http_requests_in_flight = registry.register(
+    Gauge(
+        "gameserver_http_requests_in_flight",
+        "処理中のリクエスト数",
+        ("endpoint",),
+    )
+)
+http_errors = registry.register(
+    Counter(
+        "gameserver_http_errors_total",
+        "4xx/5xx を返したリクエスト数",
+        ("endpoint", "status"),
+    )
+)
+http_not_modified = registry.register(
+    Counter(
+        "gameserver_http_not_modified_total",
+        "If-None-Match が一致して 304 を返したリクエスト数",
+        ("endpoint",),
+    )
+)
+sql_duration = registry.register(
+    Histogram(
+        "gameserver_sql_duration_seconds",
+        "SQL のラベル(種類とテーブル)ごとのレイテンシ",
+        ("query",),
+    )
+)
+sql_errors = registry.register(
+    Counter("gameserver_sql_errors_total", "失敗した SQL の数", ("query",))
+)
+pool_checkout_wait = registry.register(
+    Histogram(
+        "gameserver_db_pool_checkout_wait_seconds",
+        "コネクションプールからコネクションを借りるまでの待ち時間",
+        ("engine",),
+    )
+)
+
+
+_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+`?(\w+)`?", re.IGNORECASE)
+_labels: dict[str, str] = {}
+
+
+def query_label(statement: str) -> str:
+    """SQL 文から "動詞 テーブル" のラベルを作る。同じ文は結果をキャッシュする"""
+    label = _labels.get(statement)
+    if label is None:
+        verb = statement.split(None, 1)[0].upper() if statement.strip() else "-"
+        table = _TABLE.search(statement)
+        label = "{} {}".format(verb, table.group(1)) if table else verb
+        if len(_labels) < 10000:
+            _labels[statement] = label
+    return label
+
+
+def instrument_engine(engine) -> None:
+    """SQL のレイテンシとエラーを集計する。AsyncEngine は sync_engine を渡す"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, params, context, many):
+        context._metrics_start = perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, params, context, many):
+        sql_duration.observe(
+            perf_counter() - context._metrics_start, query_label(statement)
+        )
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        sql_errors.inc(query_label(context.statement or ""))
+
+
+class MetricsMiddleware:
+    """エンドポイントごとのレイテンシ・処理中の数・エラー数を集計する ASGI ミドルウェア"""
+
+    def __init__(self, app, routes: list):
+        self.app = app
+        # 登録されているパスだけをラベルにして、存在しないパスでラベルが増えないようにする
+        self._routes = routes
+        self._route_count = 0
+        self._paths: set[str] = set()
+
+    def _endpoint(self, path: str) -> str:
+        if self._route_count != len(self._routes):
+            self._paths = {route.path for route in self._routes}
+            self._route_count = len(self._routes)
+        return path if path in self._paths else "other"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        endpoint = self._endpoint(scope["path"])
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc(endpoint)
+        start = perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_request_duration.observe(
+                perf_counter() - start, endpoint, scope["method"]
+            )
+            http_requests_in_flight.dec(endpoint)
+            if status >= 400:
+                http_errors.inc(endpoint, str(status))
@@ -1,11 +1,11 @@
 import json
 import uuid
+from contextlib import contextmanager, suppress
 from distutils.log import WARN
 from email.policy import HTTP
 from enum import Enum, IntEnum
-from logging import DEBUG, WARN, FileHandler, Formatter, StreamHandler, getLogger
 from os import path, stat
-from time import perf_counter, time
+from time import perf_counter, sleep, time
 from typing import List, Optional
 from urllib import response
 from hashlib import sha256
@@ -14,44 +14,72 @@ from anyio import current_time
 from fastapi import HTTPException
 from pydantic import BaseModel
 from sqlalchemy import false, text, true
-from sqlalchemy.exc import MultipleResultsFound, NoResultFound
+from sqlalchemy.exc import IntegrityError, MultipleResultsFound, NoResultFound
 
+from . import bus, config, events, log, metrics, statements, tokens
+from .cache import TTLCache
 from .db import engine
+from .leaderboard import Leaderboard
+from .room_index import JoinableRoomIndex
 
-# ロガーオブジェクト
-logger = getLogger(__name__)
-# ログが複数回表示されるのを防止
-logger.propagate = False
-# ロガー自体のロギングレベル
-logger.setLevel(DEBUG)
-
-# ログをファイルへ
-fh = FileHandler("log/debug.log")
-fh.setLevel(DEBUG)
-fh.setFormatter(
-    Formatter(
-        "%(asctime)s - %(levelname)s - %(filename)s - %(name)s - %(funcName)s - %(message)s"
-    )
+# ロガーオブジェクト。書き込みはバックグラウンドのスレッドで行う
+logger = log.get_logger(__name__)
+
+# hashed_token -> SafeUser のキャッシュ
+user_cache = TTLCache(maxsize=config.USER_CACHE_SIZE, ttl=config.USER_CACHE_TTL)
+
+# room_id -> 確定したリザルト。確定後は変わらないので、消えるのは容量と期限だけ
+result_snapshots = TTLCache(
+    maxsize=config.RESULT_SNAPSHOT_CACHE_SIZE, ttl=config.RESULT_SNAPSHOT_TTL
 )
 
-# WARN以上のログは別で保管する
-fh2 = FileHandler("log/warn.log")
-fh2.setLevel(WARN)
-fh2.setFormatter(
-    Formatter(
-        "%(asctime)s - %(levelname)s - %(filename)s - %(name)s - %(funcName)s - %(message)s"
+# /room/list 用の入室可能なルームの索引。ルームの変更イベントで更新する
+room_index = JoinableRoomIndex(max_staleness=config.ROOM_INDEX_MAX_STALENESS)
+events.room_events.subscribe(room_index.on_event)
+
+# live_id ごとと全体のランキング。end のイベントで更新する
+leaderboard = Leaderboard()
+events.room_events.subscribe(leaderboard.on_event)
+
+metrics.registry.register(
+    metrics.Counter(
+        "gameserver_user_cache_requests_total",
+        "token -> user キャッシュの参照数",
+        ("result",),
+        callback=lambda: {("hit",): user_cache.hits, ("miss",): user_cache.misses},
+    )
+)
+metrics.registry.register(
+    metrics.Counter(
+        "gameserver_result_snapshot_requests_total",
+        "/room/result のリザルトのキャッシュの参照数",
+        ("result",),
+        callback=lambda: {
+            ("hit",): result_snapshots.hits,
+            ("miss",): result_snapshots.misses,
+        },
+    )
+)
+metrics.registry.register(
+    metrics.Counter(
+        "gameserver_room_index_divergences_total",
+        "/room/list の索引と DB の食い違いが見つかったルーム数",
+        callback=lambda: {(): room_index.divergences},
     )
 )
 
-# ログを標準出力へ
-sh = StreamHandler()
-sh.setFormatter(Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
-sh.setLevel(DEBUG)
 
-# ロガーにハンドラを追加
-logger.addHandler(fh)
-logger.addHandler(fh2)
-logger.addHandler(sh)
+@contextmanager
+def transaction():
+    """engine.begin() と同じ。コミットできたらルームの変更イベントを配信する"""
+    start = perf_counter()
+    with engine.begin() as conn:
+        metrics.pool_checkout_wait.observe(perf_counter() - start, "sync")
+        try:
+            yield conn
+        finally:
+            pending = events.take(conn)
+    events.publish_all(pending)
 
 
 # User関連
@@ -88,10 +116,19 @@ class InvalidToken(Exception):
     """指定されたtokenが不正だったときに投げる"""
 
 
-class SafeUser(BaseModel):
-    """token を含まないUser"""
+class UserRef(BaseModel):
+    """トークンを検証しただけのユーザー。名前などの表示用の項目は読んでいない"""
 
     id: int
+
+
+class RoomNotOwned(Exception):
+    """room_registry が owns と答えたルームを、処理する前に片付けていたときに投げる。DB で処理し直す"""
+
+
+class SafeUser(UserRef):
+    """token を含まないUser"""
+
     name: str
     leader_card_id: int
 
@@ -99,119 +136,316 @@ class SafeUser(BaseModel):
         orm_mode = True
 
 
-def create_user(name: str, leader_card_id: int) -> str:
+# MySQL の ER_DUP_ENTRY
+DUPLICATE_KEY = 1062
+
+
+def _is_duplicate_key(e: IntegrityError) -> bool:
+    return bool(e.orig.args) and e.orig.args[0] == DUPLICATE_KEY
+
+
+def _new_token() -> tuple[str, str]:
+    """(token, hashed_token) を作る"""
+    token = str(uuid.uuid4())
+    return token, sha256(token.encode()).hexdigest()
+
+
+def _create_user(conn, name: str, leader_card_id: int) -> str:
     logger.info("Enter create_user")
     """Create new user and returns their token"""
-    with engine.begin() as conn:
-        # トークンが既存のものと衝突しなくなるまでトークンを生成する
-        while True:
-            token = str(uuid.uuid4())
-            hashed_token = sha256(token.encode()).hexdigest()
+    # トークンの衝突は hashed_token の UNIQUE KEY に任せ、衝突したときだけ作り直す
+    for _ in range(config.TOKEN_RETRIES):
+        token, hashed_token = _new_token()
+        try:
             result = conn.execute(
-                text("SELECT * FROM `user` WHERE `user`.hashed_token=:hashed_token"),
-                {"hashed_token": hashed_token},
-            ).first()
-            if result is None:
-                break
-        hashed_token = sha256(token.encode()).hexdigest()
-        # for _ in range(4):
-        #    hashed_token = sha256(hashed_token.encode()).hexdigest()
-        logger.info('hashed_token={}'.format(hashed_token))
-        _ = conn.execute(
-            text(
-                "INSERT INTO `user` (name, hashed_token, leader_card_id) VALUES (:name, :hashed_token, :leader_card_id)"
-            ),
-            {"name": name, "hashed_token": hashed_token, "leader_card_id": leader_card_id},
-        )
-    return token
+                statements.INSERT_USER,
+                {
+                    "name": name,
+                    "hashed_token": hashed_token,
+                    "leader_card_id": leader_card_id,
+                },
+            )
+        except IntegrityError as e:
+            if not _is_duplicate_key(e):
+                raise
+            logger.warning("hashed_token collided. Retry.")
+            continue
+        if tokens.signer.current is not None:
+            # UUID のトークンは渡さず、user_id を署名したトークンを渡す
+            return tokens.signer.sign(result.lastrowid)
+        return token
+    raise HTTPException(status_code=500)
+
+
+def create_user(name: str, leader_card_id: int) -> str:
+    with transaction() as conn:
+        return _create_user(conn, name, leader_card_id)
+
+
+def _create_users(conn, users: list[tuple[str, int]]) -> list[str]:
+    """(name, leader_card_id) のリストからユーザーをまとめて作り、同じ順でトークンを返す
+
+    BULK_INSERT_SIZE 件ずつ1つの INSERT 文にする(executemany を DBAPI が複数行の INSERT に書き換える)。
+    署名つきトークンを発行するときは、塊ごとに hashed_token から id を引いて署名する。
+    """
+    logger.info("Enter create_users: {} users".format(len(users)))
+    user_tokens = []
+    for i in range(0, len(users), config.BULK_INSERT_SIZE):
+        chunk = users[i : i + config.BULK_INSERT_SIZE]
+        for _ in range(config.TOKEN_RETRIES):
+            issued = [_new_token() for _ in chunk]
+            try:
+                _ = conn.execute(
+                    statements.INSERT_USER,
+                    [
+                        dict(
+                            name=name,
+                            hashed_token=hashed_token,
+                            leader_card_id=leader_card_id,
+                        )
+                        for (name, leader_card_id), (_, hashed_token) in zip(
+                            chunk, issued
+                        )
+                    ],
+                )
+            except IntegrityError as e:
+                # 文単位でロールバックされるので、この塊だけトークンを作り直す
+                if not _is_duplicate_key(e):
+                    raise
+                logger.warning("hashed_token collided. Retry the chunk.")
+                continue
+            if tokens.signer.current is not None:
+                ids = {
+                    row.hashed_token: row.id
+                    for row in conn.execute(
+                        statements.SELECT_USER_IDS_BY_TOKENS,
+                        dict(
+                            hashed_tokens=[hashed_token for _, hashed_token in issued]
+                        ),
+                    )
+                }
+                user_tokens.extend(
+                    tokens.signer.sign(ids[hashed_token]) for _, hashed_token in issued
+                )
+            else:
+                user_tokens.extend(token for token, _ in issued)
+            break
+        else:
+            raise HTTPException(status_code=500)
+    return user_tokens
+
+
+def create_users(users: list[tuple[str, int]]) -> list[str]:
+    with transaction() as conn:
+        return _create_users(conn, users)
 
 
 def _get_user_by_token(conn, token: str) -> Optional[SafeUser]:
-    # start = perf_counter()
+    user = cached_user(token)
+    if user is not None:
+        return user
+    return _load_user(conn, token)
+
+
+def signed_user(token: str) -> Optional[UserRef]:
+    """署名つきトークンなら DB を読まずに検証してユーザーを返す。UUID のトークンなら None"""
+    if not tokens.is_signed(token):
+        return None
+    user_id = tokens.signer.verify(token)
+    if user_id is None:
+        logger.warning("Invalid signed token")
+        raise HTTPException(status_code=404)
+    return UserRef(id=user_id)
+
+
+def _identify(conn, token: str) -> UserRef:
+    """トークンのユーザー。署名つきトークンなら DB を読まず、id しか持たない"""
+    user = signed_user(token)
+    if user is not None:
+        return user
+    return _get_user_by_token(conn, token)
+
+
+def _profile(conn, user: UserRef) -> SafeUser:
+    """id しか持たないユーザーの名前などを読む"""
+    if isinstance(user, SafeUser):
+        return user
+    try:
+        result = conn.execute(statements.SELECT_USER_BY_ID, dict(user_id=user.id)).one()
+    except NoResultFound:
+        logger.exception("User Not Found")
+        raise HTTPException(status_code=404)
+    return SafeUser.from_orm(result)
+
+
+def _load_user(conn, token: str) -> SafeUser:
+    """キャッシュを見ずに DB から読み、キャッシュに入れる"""
     hashed_token = sha256(token.encode()).hexdigest()
+    stamp = user_cache.stamp()
+    signed = signed_user(token)
     try:
-        result = conn.execute(
-            text("SELECT * FROM `user` WHERE `hashed_token`=:hashed_token"), dict(hashed_token=hashed_token)
-        ).one()
+        if signed is not None:
+            result = conn.execute(
+                statements.SELECT_USER_BY_ID, dict(user_id=signed.id)
+            ).one()
+        else:
+            result = conn.execute(
+                statements.SELECT_USER_BY_TOKEN, dict(hashed_token=hashed_token)
+            ).one()
     except NoResultFound:
         logger.exception("User Not Found")
         raise HTTPException(status_code=404)
     except MultipleResultsFound:
         logger.exception("Multiple Users Found")
         raise HTTPException(status_code=500)
-    # end = perf_counter()
-    # logger.debug("SQL: Time={}".format(end-start))
-    return SafeUser.from_orm(result)
+    user = SafeUser.from_orm(result)
+    user_cache.set(hashed_token, user, stamp)
+    return user
+
+
+def cached_user(token: str) -> Optional[SafeUser]:
+    """キャッシュにあればコネクションを使わずに返す"""
+    return user_cache.get(sha256(token.encode()).hexdigest())
 
 
 def get_user_by_token(token: str) -> Optional[SafeUser]:
-    with engine.begin() as conn:
-        return _get_user_by_token(conn, token)
+    user = cached_user(token)
+    if user is not None:
+        return user
+    with transaction() as conn:
+        return _load_user(conn, token)
 
 
-def update_user(token: str, name: str, leader_card_id: int) -> None:
+def _update_user(conn, token: str, name: str, leader_card_id: int) -> None:
     logger.info("Enter update_user")
-    with engine.begin() as conn:
-        hashed_token = sha256(token.encode()).hexdigest()
-        start = perf_counter()
+    signed = signed_user(token)
+    if signed is not None:
         _ = conn.execute(
-            text(
-                "UPDATE `user` SET `name`=:name, `leader_card_id`=:leader_card_id WHERE `hashed_token`=:hashed_token"
-            ),
-            dict(name=name, hashed_token=hashed_token, leader_card_id=leader_card_id),
+            statements.UPDATE_USER_BY_ID,
+            dict(name=name, user_id=signed.id, leader_card_id=leader_card_id),
+        )
+        _ = conn.execute(
+            statements.BUMP_WAITING_ROOMS_OF_USER_ID,
+            dict(user_id=signed.id, is_start=WaitRoomStatus.Waiting.value),
         )
-        end = perf_counter()
-        logger.debug("SQL: Time={}".format(end - start))
+        return
+    hashed_token = sha256(token.encode()).hexdigest()
+    _ = conn.execute(
+        statements.UPDATE_USER,
+        dict(name=name, hashed_token=hashed_token, leader_card_id=leader_card_id),
+    )
+    # 待機中のルームの /room/wait に出る名前が変わるので、ルームのバージョンを進める
+    _ = conn.execute(
+        statements.BUMP_WAITING_ROOMS_OF_USER,
+        dict(hashed_token=hashed_token, is_start=WaitRoomStatus.Waiting.value),
+    )
     return
 
 
-# room関連のプログラム
+def update_user(token: str, name: str, leader_card_id: int) -> None:
+    with transaction() as conn:
+        user = _get_user_by_token(conn, token) if room_registry is not None else None
+        _update_user(conn, token, name, leader_card_id)
+    _user_updated(token, user, name, leader_card_id)
 
 
-def create_room(token: str, live_id: int, select_difficulty: int) -> int:
-    logger.info("Enter create_room")
-    with engine.begin() as conn:
-        start = perf_counter()
-        response = conn.execute(
-            text(
-                "INSERT INTO `room` SET `live_id`=:live_id, `joined_user_count`=:joined_user_count, `max_user_count`=:max_user_count, `is_start`=:is_start, `time`=:time"
-            ),
-            dict(
-                live_id=live_id,
-                joined_user_count=1,
-                max_user_count=4,
-                is_start=1,
-                time=0,
-            ),
+def _user_updated(
+    token: str, user: Optional[SafeUser], name: str, leader_card_id: int
+) -> None:
+    """update_user のコミット後に呼ぶ"""
+    # /room/wait に古い名前が出ないようにする
+    hashed_token = sha256(token.encode()).hexdigest()
+    user_cache.invalidate(hashed_token)
+    profile = None
+    if user is not None:
+        profile = SafeUser(id=user.id, name=name, leader_card_id=leader_card_id)
+        if room_registry is not None:
+            room_registry.update_profile(profile)
+    if bus.current is not None:
+        bus.current.publish(
+            "user",
+            hashed_token=hashed_token,
+            profile=profile.dict() if profile is not None else None,
         )
-        end = perf_counter()
-        logger.debug("SQL(INSERT INTO `room`): Time={}".format(end - start))
 
-        user = get_user_by_token(token)
 
-        start = perf_counter()
-        _ = conn.execute(
-            text(
-                "INSERT INTO `room_member` SET `room_id`=:room_id, `user_id`=:user_id, `select_difficulty`=:select_difficulty, `is_host`=:is_host, `judge_miss`=:judge_miss, `judge_bad`=:judge_bad, `judge_good`=:judge_good, `judge_great`=:judge_great, `judge_perfect`=:judge_perfect, `score`=:score"
-            ),
-            dict(
-                room_id=response.lastrowid,
-                user_id=user.id,
-                select_difficulty=select_difficulty.value,
-                is_host=True,
-                judge_miss=0,
-                judge_bad=0,
-                judge_good=0,
-                judge_great=0,
-                judge_perfect=0,
-                score=0,
+def _on_user_updated(message: dict) -> None:
+    """他のワーカーで update_user されたときに呼ぶ"""
+    user_cache.invalidate(message["hashed_token"])
+    if room_registry is not None and message["profile"] is not None:
+        room_registry.update_profile(SafeUser(**message["profile"]))
+
+
+def connect_bus(event_bus: "bus.EventBus") -> None:
+    """他のワーカーとルームのイベントとキャッシュの無効化をやり取りする"""
+    bus.current = event_bus
+    bus.relay_room_events(event_bus, events.room_events)
+    event_bus.subscribe("user", _on_user_updated)
+    event_bus.start()
+
+
+# room関連のプログラム
+
+
+def _create_room(conn, token: str, live_id: int, select_difficulty: int) -> int:
+    logger.info("Enter create_room")
+    response = conn.execute(
+        statements.INSERT_ROOM,
+        dict(
+            live_id=live_id,
+            joined_user_count=1,
+            max_user_count=4,
+            is_start=1,
+            time=0,
+        ),
+    )
+
+    if room_registry is not None:
+        user = _get_user_by_token(conn, token)
+        # 以降の状態はメモリで持ち、room_member は終わったときにまとめて書き込む。
+        # `room` の行がコミットされてから登録する
+        room_id = response.lastrowid
+        events.defer_call(
+            conn,
+            lambda: room_registry.create_room(
+                room_id, live_id, select_difficulty, user
             ),
         )
-        end = perf_counter()
-        logger.debug("SQL(INSERT INTO `room_member`): Time={}".format(end - start))
+        return room_id
+
+    user = _identify(conn, token)
+    _ = conn.execute(
+        statements.INSERT_ROOM_MEMBER,
+        dict(
+            room_id=response.lastrowid,
+            user_id=user.id,
+            select_difficulty=select_difficulty.value,
+            is_host=True,
+            judge_miss=0,
+            judge_bad=0,
+            judge_good=0,
+            judge_great=0,
+            judge_perfect=0,
+            score=0,
+        ),
+    )
+    events.defer(
+        conn,
+        response.lastrowid,
+        "create",
+        live_id=live_id,
+        joined_user_count=1,
+        max_user_count=4,
+        version=0,
+    )
     return response.lastrowid
 
 
+def create_room(token: str, live_id: int, select_difficulty: int) -> int:
+    with transaction() as conn:
+        return _create_room(conn, token, live_id, select_difficulty)
+
+
 class RoomList(BaseModel):
     room_id: int
     live_id: int
@@ -222,206 +456,297 @@ class RoomList(BaseModel):
         orm_mode = True
 
 
-def list_room(live_id: int) -> List:
+def _list_room(conn, live_id: int, lag: float = 0.0) -> List:
+    """lag はリードレプリカで読むときの遅れの上限(秒)"""
     logger.info("Enter list_room")
-    with engine.begin() as conn:
-        if live_id == 0:
-            start = perf_counter()
-            # live_idが0のときは入室できる全てのライブを取得する
-            response = conn.execute(
-                text("SELECT * FROM `room` WHERE `is_start`=:is_start"),
-                dict(is_start=WaitRoomStatus.Waiting.value),
-            )
-            end = perf_counter()
-            logger.debug("SQL(live_id == 0): Time={}".format(end - start))
-        else:
-            # 指定したライブIDでかつ入室できるライブを取得する
-            start = perf_counter()
-            response = conn.execute(
-                text(
-                    "SELECT * FROM `room` WHERE live_id=:live_id AND `is_start`=:is_start"
-                ),
-                dict(live_id=live_id, is_start=WaitRoomStatus.Waiting.value),
-            )
-            end = perf_counter()
-            logger.debug("SQL(live_id != 0): Time={}".format(end - start))
-    return response.all()
+    # 入室できる全てのルームを取得して索引と突き合わせる
+    response = conn.execute(
+        statements.SELECT_JOINABLE_ROOMS,
+        dict(is_start=WaitRoomStatus.Waiting.value),
+    ).all()
+    diverged = room_index.reconcile(response, lag)
+    if diverged:
+        logger.info("room_index diverged from DB: rooms={}".format(diverged))
+    return room_index.rooms(live_id)
 
 
-def join_room(
-    room_id: int, select_difficulty: LiveDifficulty, user: SafeUser
+def list_room(live_id: int) -> List:
+    if room_registry is not None:
+        return room_registry.list_room(live_id)
+    rooms = room_index.lookup(live_id)
+    if rooms is not None:
+        return rooms
+    with transaction() as conn:
+        return _list_room(conn, live_id)
+
+
+def _join_room(
+    conn, room_id: int, select_difficulty: LiveDifficulty, user: UserRef
 ) -> JoinRoomResult:
     logger.info("Enter join_room")
-    with engine.begin() as conn:
-        try:
-            start = perf_counter()
-            response = conn.execute(
-                text(
-                    "SELECT `joined_user_count`, `max_user_count`, `is_start` FROM `room` WHERE `room_id`=:room_id FOR UPDATE"
-                ),
-                dict(room_id=room_id),
-            ).one()
-            end = perf_counter()
-            logger.debug("SQL(SELECT): Time={}".format(end - start))
-        except NoResultFound:
-            logger.exception("Room Not Found.")
-            raise HTTPException(status_code=404)
-        except MultipleResultsFound:
-            logger.exception("Multi Room Found.")
-            raise HTTPException(status_code=500)
+    # 空きがあるときだけ人数を増やす。SELECT ... FOR UPDATE で読んでから書くより、ロックを持つ時間が短い
+    joined = conn.execute(
+        statements.JOIN_ROOM,
+        dict(room_id=room_id, user_id=user.id, is_start=WaitRoomStatus.Waiting.value),
+    ).rowcount
+    try:
+        response = conn.execute(
+            statements.SELECT_ROOM,
+            dict(room_id=room_id),
+        ).one()
+    except NoResultFound:
+        logger.exception("Room Not Found.")
+        raise HTTPException(status_code=404)
+    except MultipleResultsFound:
+        logger.exception("Multi Room Found.")
+        raise HTTPException(status_code=500)
 
+    if not joined:
         if response.is_start != WaitRoomStatus.Waiting.value:
             return JoinRoomResult.Disbanded
-        if response.joined_user_count >= response.max_user_count:
-            return JoinRoomResult.RoomFull
         if response.joined_user_count == 0:
             return JoinRoomResult.Disbanded
-        if response.joined_user_count < response.max_user_count:
-            start = perf_counter()
-            _ = conn.execute(
-                text(
-                    "INSERT INTO `room_member` SET `room_id`=:room_id, `user_id`=:user_id, `select_difficulty`=:select_difficulty, `is_host`=:is_host, `judge_miss`=:judge_miss, `judge_bad`=:judge_bad, `judge_good`=:judge_good, `judge_great`=:judge_great, `judge_perfect`=:judge_perfect, `score`=:score"
-                ),
-                dict(
-                    room_id=room_id,
-                    user_id=user.id,
-                    select_difficulty=select_difficulty.value,
-                    is_host=False,
-                    judge_miss=0,
-                    judge_bad=0,
-                    judge_good=0,
-                    judge_great=0,
-                    judge_perfect=0,
-                    score=0,
-                ),
-            )
-            end = perf_counter()
-            logger.debug("SQL(INSERT): Time={}".format(end - start))
-
-            start = perf_counter()
-            _ = conn.execute(
-                text(
-                    "UPDATE `room` SET `joined_user_count`=:joined_user_count WHERE `room_id`=room_id"
-                ),
-                dict(joined_user_count=response.joined_user_count + 1, room_id=room_id),
-            )
-            end = perf_counter()
-            logger.debug("SQL(UPDATE): Time={}".format(end - start))
+        # 既に参加しているときは memory バックエンドと同じく OtherError
+        if (
+            conn.execute(
+                statements.SELECT_IS_HOST, dict(room_id=room_id, user_id=user.id)
+            ).first()
+            is not None
+        ):
+            return JoinRoomResult.OtherError
+        if response.joined_user_count >= response.max_user_count:
+            return JoinRoomResult.RoomFull
+        return JoinRoomResult.OtherError
+
+    _ = conn.execute(
+        statements.INSERT_ROOM_MEMBER,
+        dict(
+            room_id=room_id,
+            user_id=user.id,
+            select_difficulty=select_difficulty.value,
+            is_host=False,
+            judge_miss=0,
+            judge_bad=0,
+            judge_good=0,
+            judge_great=0,
+            judge_perfect=0,
+            score=0,
+        ),
+    )
+    events.defer(
+        conn,
+        room_id,
+        "join",
+        live_id=response.live_id,
+        joined_user_count=response.joined_user_count,
+        max_user_count=response.max_user_count,
+        version=response.version,
+    )
+    return JoinRoomResult.Ok
 
-            return JoinRoomResult.Ok
-    return JoinRoomResult.OtherError
+
+def join_room(
+    room_id: int, select_difficulty: LiveDifficulty, user: SafeUser
+) -> JoinRoomResult:
+    if room_registry is not None and room_registry.owns(room_id):
+        with suppress(RoomNotOwned):
+            return room_registry.join_room(room_id, select_difficulty, user)
+    with transaction() as conn:
+        return _join_room(conn, room_id, select_difficulty, user)
+
+
+def _rank_rooms(
+    conn, rooms: List, select_difficulty: LiveDifficulty, user: UserRef
+) -> list[int]:
+    """quick_join_room で参加を試す順に room_id を並べる
+
+    人数が多いルームから埋め、同じ人数なら同じ難易度を選んだ人が多いルームを優先する。
+    既に参加しているルームは除く。
+    """
+    rooms = sorted(rooms, key=lambda room: (-room.joined_user_count, room.room_id))
+    rooms = rooms[: config.QUICKJOIN_CANDIDATES]
+    if not rooms:
+        return []
+    response = conn.execute(
+        statements.SELECT_ROOM_AFFINITY,
+        dict(
+            select_difficulty=select_difficulty.value,
+            user_id=user.id,
+            room_ids=[room.room_id for room in rooms],
+        ),
+    ).all()
+    members = {r.room_id: r for r in response}
+    return [
+        room.room_id
+        for room in sorted(
+            (room for room in rooms if room.room_id in members),
+            key=lambda room: (
+                -room.joined_user_count,
+                -members[room.room_id].affinity,
+                room.room_id,
+            ),
+        )
+        if not members[room.room_id].mine
+    ]
+
+
+def _quick_join_room(
+    conn,
+    token: str,
+    live_id: int,
+    select_difficulty: LiveDifficulty,
+    user: UserRef,
+    can_retry: bool = False,
+) -> Optional[tuple[int, bool]]:
+    """入れるルームに参加し、どこにも入れなければ作る。(room_id, 作ったか) を返す
+
+    can_retry なら、他の quickjoin がロックしていて試せなかったルームがあるときは作らずに None を返す。
+    呼び出し側はトランザクションを終えて少し待ち、選び直す。
+    """
+    logger.info("Enter quick_join_room")
+    rooms = room_index.lookup(live_id)
+    if rooms is None:
+        rooms = _list_room(conn, live_id)
+    ranked = _rank_rooms(conn, rooms, select_difficulty, user)
+    skipped = False
+    for room_id in ranked[: config.QUICKJOIN_MAX_ATTEMPTS]:
+        # 外れた UPDATE も行ロックを持ち続け、試す順は人によって違うので、ロックを待つと
+        # 逆の順でロックした2人がデッドロックする。他の人がロックしているルームは待たずに飛ばす
+        if conn.execute(statements.LOCK_ROOM, dict(room_id=room_id)).first() is None:
+            skipped = True
+            continue
+        # 参加は条件付きの UPDATE なので、他の人が先に埋めていたら何も変えずに次を試す
+        if _join_room(conn, room_id, select_difficulty, user) == JoinRoomResult.Ok:
+            return room_id, False
+    if skipped and can_retry:
+        return None
+    return _create_room(conn, token, live_id, select_difficulty), True
+
+
+def quick_join_room(
+    token: str, live_id: int, select_difficulty: LiveDifficulty, user: SafeUser
+) -> tuple[int, bool]:
+    if room_registry is not None:
+        room_id = room_registry.quick_join_room(live_id, select_difficulty, user)
+        if room_id is not None:
+            return room_id, False
+        with transaction() as conn:
+            return _create_room(conn, token, live_id, select_difficulty), True
+    for retries in range(config.QUICKJOIN_LOCK_RETRIES, -1, -1):
+        with transaction() as conn:
+            joined = _quick_join_room(
+                conn, token, live_id, select_difficulty, user, retries > 0
+            )
+        if joined is not None:
+            return joined
+        sleep(config.QUICKJOIN_LOCK_RETRY_INTERVAL)
 
 
 # 戻り値が複数の時のアノテーション
-def wait_room(room_id: int, user: SafeUser):
+def _wait_room_snapshot(conn, room_id: int):
+    """wait_room のうち DB から読む部分。(version, is_start, 参加者の行) を返す
+
+    同じルームを待っている人の間で使い回せるように、is_me は入れない (_room_users で入れる)。
+    """
     logger.info("Enter wait_room")
-    with engine.begin() as conn:
-        start = perf_counter()
-        response = conn.execute(
-            text("SELECT `is_start` FROM `room` where `room_id`=:room_id"),
-            dict(room_id=room_id),
-        )
-        end = perf_counter()
-        logger.debug("SQL(SELECT `is_start`): Time={}".format(end - start))
+    response = conn.execute(
+        statements.SELECT_ROOM,
+        dict(room_id=room_id),
+    )
 
-        start = perf_counter()
-        result = conn.execute(
-            text(
-                "SELECT `room_member`.user_id, `user`.name, `user`.leader_card_id, `room_member`.select_difficulty, `room_member`.is_host FROM `room_member` INNER JOIN `room` ON `room`.room_id = `room_member`.room_id INNER JOIN `user` ON `room_member`.user_id = `user`.id WHERE `room`.room_id=:room_id"
-            ),
-            dict(room_id=room_id),
-        ).all()
-        end = perf_counter()
-        logger.debug("SQL(SELECT): Time={}".format(end - start))
-        if result is None:
-            logger.warn('No user in this room, but wait_room is called.')
-        resultList = []
-        for r in result:
-            resultList.append(
-                RoomUser(
-                    user_id=r.user_id,
-                    name=r.name,
-                    leader_card_id=r.leader_card_id,
-                    select_difficulty=r.select_difficulty,
-                    is_me=user.id == r.user_id,
-                    is_host=r.is_host,
-                )
+    result = conn.execute(
+        statements.SELECT_ROOM_USERS,
+        dict(room_id=room_id),
+    ).all()
+    if result is None:
+        logger.warn('No user in this room, but wait_room is called.')
+    try:
+        room = response.one()
+    except (NoResultFound, MultipleResultsFound):
+        logger.exception("`is_start` Not Found.")
+        raise HTTPException(status_code=500)
+    return room.version, room.is_start, result
+
+
+def _room_users(rows, user: UserRef) -> list[RoomUser]:
+    resultList = []
+    for r in rows:
+        resultList.append(
+            RoomUser(
+                user_id=r.user_id,
+                name=r.name,
+                leader_card_id=r.leader_card_id,
+                select_difficulty=r.select_difficulty,
+                is_me=user.id == r.user_id,
+                is_host=r.is_host,
             )
-        try:
-            is_start = response.one().is_start
-        except (NoResultFound, MultipleResultsFound):
-            logger.exception("`is_start` Not Found.")
-            raise HTTPException(status_code=500)
-        return is_start, resultList
+        )
+    return resultList
 
 
-def start_room(room_id: int, user: SafeUser) -> None:
-    logger.info("Enter start_room")
-    with engine.begin() as conn:
-        try:
-            start = perf_counter()
-            response = conn.execute(
-                text(
-                    "SELECT `is_host` FROM `room_member` WHERE `room_id`=:room_id AND `user_id`=:user_id"
-                ),
-                dict(room_id=room_id, user_id=user.id),
-            ).one()[0]
-            end = perf_counter()
-            logger.debug("SQL(SELECT): Time={}".format(end - start))
-        except (NoResultFound, MultipleResultsFound):
-            raise HTTPException(status_code=500)
-        if response:
-            start = perf_counter()
-            _ = conn.execute(
-                text("UPDATE `room` SET `is_start`=:is_start WHERE `room_id`=:room_id"),
-                dict(is_start=WaitRoomStatus.LiveStart.value, room_id=room_id),
-            )
-            end = perf_counter()
-            logger.debug("SQL(UPDATE): Time={}".format(end - start))
-        else:
-            logger.info("User is not a host.")
-            raise HTTPException(status_code=403)
+def _wait_room(conn, room_id: int, user: UserRef):
+    _, is_start, rows = _wait_room_snapshot(conn, room_id)
+    return is_start, _room_users(rows, user)
 
 
-def end_room(
-    room_id: int, score: int, user: SafeUser, judge_count_list: list[int]
-) -> None:
-    logger.info("Enter end_room")
-    while len(judge_count_list) < 5:
-        judge_count_list.append(0)
-    with engine.begin() as conn:
-        current_time = int(time())
-        start = perf_counter()
-        _ = conn.execute(
-            text(
-                "UPDATE `room_member` SET `judge_perfect`=:judge_perfect, `judge_great`=:judge_great, `judge_good`=:judge_good, `judge_bad`=:judge_bad, `judge_miss`=:judge_miss, `score`=:score WHERE `user_id`=:user_id AND `room_id`=:room_id"
-            ),
-            dict(
-                judge_perfect=judge_count_list[0],
-                judge_great=judge_count_list[1],
-                judge_good=judge_count_list[2],
-                judge_bad=judge_count_list[3],
-                judge_miss=judge_count_list[4],
-                score=score,
-                user_id=user.id,
-                room_id=room_id,
-            ),
-        )
-        end = perf_counter()
-        logger.debug("SQL(UPDATE `room_member`): Time={}".format(end - start))
+def _room_version(conn, room_id: int) -> Optional[int]:
+    """ルームの状態のバージョン。join/leave/start/end と参加者の名前の変更で進む"""
+    row = conn.execute(
+        statements.SELECT_ROOM_VERSION,
+        dict(room_id=room_id),
+    ).first()
+    return row.version if row is not None else None
 
-        start = perf_counter()
+
+def room_version(room_id: int) -> Optional[int]:
+    if room_registry is not None and room_registry.owns(room_id):
+        with suppress(RoomNotOwned):
+            return room_registry.room_version(room_id)
+    with transaction() as conn:
+        return _room_version(conn, room_id)
+
+
+def list_version(live_id: int) -> Optional[int]:
+    """/room/list で返すルームの集合のバージョン。索引が古く突き合わせが必要なら None"""
+    if room_registry is not None:
+        return room_registry.list_version(live_id)
+    return room_index.list_version(live_id)
+
+
+def wait_room(room_id: int, user: SafeUser):
+    if room_registry is not None and room_registry.owns(room_id):
+        with suppress(RoomNotOwned):
+            return room_registry.wait_room(room_id, user)
+    with transaction() as conn:
+        return _wait_room(conn, room_id, user)
+
+
+def _start_room(conn, room_id: int, user: UserRef) -> None:
+    logger.info("Enter start_room")
+    try:
+        response = conn.execute(
+            statements.SELECT_IS_HOST,
+            dict(room_id=room_id, user_id=user.id),
+        ).one()[0]
+    except (NoResultFound, MultipleResultsFound):
+        raise HTTPException(status_code=500)
+    if response:
         _ = conn.execute(
-            text(
-                "UPDATE `room` SET `time`=CASE WHEN 0 then :new_time ELSE `time` END WHERE room_id=:room_id"
-            ),
-            dict(
-                new_time=current_time,
-                room_id=room_id,
-            ),
+            statements.START_ROOM,
+            dict(is_start=WaitRoomStatus.LiveStart.value, room_id=room_id),
         )
-        end = perf_counter()
-        logger.debug("SQL(UPDATE `room`): Time={}".format(end - start))
+        events.defer(conn, room_id, "start")
+    else:
+        logger.info("User is not a host.")
+        raise HTTPException(status_code=403)
+
+
+def start_room(room_id: int, user: SafeUser) -> None:
+    if room_registry is not None and room_registry.owns(room_id):
+        with suppress(RoomNotOwned):
+            return room_registry.start_room(room_id, user)
+    with transaction() as conn:
+        return _start_room(conn, room_id, user)
 
 
 class ResultUser(BaseModel):
@@ -430,160 +755,281 @@ class ResultUser(BaseModel):
     score: int
 
 
-def result_room(room_id: int) -> list[ResultUser]:
-    logger.info("Enter result_room")
-    with engine.begin() as conn:
-        try:
-            start = perf_counter()
-            result = conn.execute(
-                text(
-                    "SELECT `user_id`, `judge_perfect`, `judge_great`, `judge_good`, `judge_bad`, `judge_miss`, `score` FROM `room_member` WHERE `room_id`=:room_id"
-                ),
-                dict(room_id=room_id),
+def results_to_json(results: list[ResultUser]) -> str:
+    return json.dumps([r.dict() for r in results])
+
+
+def results_from_json(value: str) -> list[ResultUser]:
+    return [ResultUser(**r) for r in json.loads(value)]
+
+
+def _finalize_result(conn, room_id: int) -> list[ResultUser]:
+    """リザルトを確定させて room_result に書き込む。確定後は変わらない"""
+    response = conn.execute(
+        statements.SELECT_MEMBER_RESULTS,
+        dict(room_id=room_id),
+    ).all()
+    results = [
+        ResultUser(user_id=r.user_id, judge_count_list=list(r[1:6]), score=r.score)
+        for r in response
+    ]
+    # 同時に確定させようとしたら先に書いた方を残す
+    inserted = conn.execute(
+        statements.INSERT_ROOM_RESULT,
+        dict(room_id=room_id, result=results_to_json(results)),
+    ).rowcount
+    if not inserted:
+        # 締め切りで確定した後の end などで作り直したリザルトは捨て、確定済みのものを返す
+        stored = conn.execute(
+            statements.SELECT_ROOM_RESULT_FOR_SHARE,
+            dict(room_id=room_id),
+        ).one()
+        return results_from_json(stored.result)
+    return results
+
+
+def _end_room(
+    conn, room_id: int, score: int, user: UserRef, judge_count_list: list[int]
+) -> Optional[list[ResultUser]]:
+    """全員が end したらリザルトを確定させて返す。まだなら None"""
+    logger.info("Enter end_room")
+    while len(judge_count_list) < 5:
+        judge_count_list.append(0)
+    current_time = int(time())
+    # 最初に end した時刻を残す。room の行のロックで、同じルームの end_room を1つずつ処理する
+    _ = conn.execute(
+        statements.END_ROOM,
+        dict(
+            new_time=current_time,
+            room_id=room_id,
+        ),
+    )
+    ended = conn.execute(
+        statements.UPDATE_MEMBER_RESULT,
+        dict(
+            judge_perfect=judge_count_list[0],
+            judge_great=judge_count_list[1],
+            judge_good=judge_count_list[2],
+            judge_bad=judge_count_list[3],
+            judge_miss=judge_count_list[4],
+            score=score,
+            user_id=user.id,
+            room_id=room_id,
+        ),
+    ).rowcount
+    if ended:
+        live_id = conn.execute(
+            statements.SELECT_ROOM_LIVE_ID,
+            dict(room_id=room_id),
+        ).scalar_one()
+        events.defer(
+            conn, room_id, "end", live_id=live_id, user_id=user.id, score=score
+        )
+    # 他の人の end をコミット済みの最新の状態で見るためにロックして読む
+    waiting = conn.execute(
+        statements.COUNT_UNFINISHED_MEMBERS,
+        dict(room_id=room_id),
+    ).scalar_one()
+    if waiting:
+        return None
+    return _finalize_result(conn, room_id)
+
+
+def _end_rooms(
+    conn, submissions: list[tuple[int, int, UserRef, list[int]]]
+) -> dict[int, list[ResultUser]]:
+    """複数の end_room (room_id, score, user, judge_count_list) を複数行の UPDATE でまとめて処理する
+
+    _end_room と同じことをする。全員が end したルームのリザルトを確定させて {room_id: リザルト} で返す。
+    """
+    logger.info("Enter end_rooms: {}".format(len(submissions)))
+    room_ids = sorted({room_id for room_id, _, _, _ in submissions})
+    # 同じ人が2回送ってきたら後のものを使う
+    latest = {}
+    for room_id, score, user, judge_count_list in submissions:
+        judge_count_list = (list(judge_count_list) + [0] * 5)[:5]
+        latest[(room_id, user.id)] = (score, judge_count_list)
+    # room の行を room_id の順にロックする。同じルームの end は1つずつ処理される
+    _ = conn.execute(
+        statements.END_ROOMS,
+        dict(new_time=int(time()), room_ids=room_ids),
+    )
+    params = {}
+    for i, ((room_id, user_id), (score, judge_count_list)) in enumerate(latest.items()):
+        params.update(
+            {
+                f"room_id_{i}": room_id,
+                f"user_id_{i}": user_id,
+                f"judge_perfect_{i}": judge_count_list[0],
+                f"judge_great_{i}": judge_count_list[1],
+                f"judge_good_{i}": judge_count_list[2],
+                f"judge_bad_{i}": judge_count_list[3],
+                f"judge_miss_{i}": judge_count_list[4],
+                f"score_{i}": score,
+            }
+        )
+    _ = conn.execute(statements.UPDATE_MEMBER_RESULTS(len(latest)), params)
+    members = conn.execute(
+        statements.SELECT_ENDED_MEMBERS,
+        dict(room_ids=room_ids),
+    ).all()
+    live_ids = {}
+    unfinished = set()
+    for m in members:
+        live_ids[m.room_id] = m.live_id
+        if (m.room_id, m.user_id) in latest:
+            score, _ = latest.pop((m.room_id, m.user_id))
+            events.defer(
+                conn,
+                m.room_id,
+                "end",
+                live_id=m.live_id,
+                user_id=m.user_id,
+                score=score,
             )
-            end = perf_counter()
-            logger.debug("SQL(SELECT FROM `room_member`): Time={}".format(end - start))
+        if m.unfinished:
+            unfinished.add(m.room_id)
+    return {
+        room_id: _finalize_result(conn, room_id)
+        for room_id in room_ids
+        if room_id in live_ids and room_id not in unfinished
+    }
 
-            start = perf_counter()
-            room_result = conn.execute(
-                text("SELECT `is_start`, `time` FROM `room` WHERE `room_id`=:room_id"),
-                dict(room_id=room_id),
-            ).one()
-            end = perf_counter()
-            logger.debug("SQL(SELECT FROM `room`): Time={}".format(end - start))
 
-        except (NoResultFound, MultipleResultsFound):
-            logger.exception("No Room iss found or Multiple Rooms are found.")
-            raise HTTPException(status_code=500)
-        resultList = []
-        if room_result.is_start != WaitRoomStatus.Waiting.value:
-            if result is None:
-                logger.warn("result not found, bad /room/result was called")
-            for i in result.all():
-                if time() - room_result.time < 5 or sum(i[1:6]) == 0:
-                    return []
-                resultList.append(
-                    ResultUser(
-                        user_id=i.user_id, judge_count_list=list(i[1:6]), score=i.score
-                    )
-                )
-    return resultList
+def end_room(
+    room_id: int, score: int, user: SafeUser, judge_count_list: list[int]
+) -> None:
+    if room_registry is not None and room_registry.owns(room_id):
+        with suppress(RoomNotOwned):
+            return room_registry.end_room(room_id, score, user, judge_count_list)
+    if end_buffer is not None:
+        # まとめてコミットされるまで待つ
+        return end_buffer.submit(room_id, score, user, judge_count_list).result()
+    with transaction() as conn:
+        results = _end_room(conn, room_id, score, user, judge_count_list)
+    if results is not None:
+        result_snapshots.set(room_id, results)
+
+
+def _result_room(
+    conn, room_id: int, finalize: bool = True
+) -> Optional[list[ResultUser]]:
+    """確定したリザルトを返す。まだ確定していなければ []
+
+    最初の end から RESULT_DEADLINE 秒たっても全員が揃わなければ、その時点で確定させる。
+    finalize=False (リードレプリカや single-flight で読むとき) は確定させられないので、確定させる代わりに None を返す。
+    """
+    logger.info("Enter result_room")
+    snapshot = conn.execute(
+        statements.SELECT_ROOM_RESULT,
+        dict(room_id=room_id),
+    ).first()
+    if snapshot is not None:
+        return results_from_json(snapshot.result)
+    try:
+        room_result = conn.execute(
+            statements.SELECT_ROOM_START_TIME,
+            dict(room_id=room_id),
+        ).one()
+    except (NoResultFound, MultipleResultsFound):
+        logger.exception("No Room iss found or Multiple Rooms are found.")
+        raise HTTPException(status_code=500)
+    if room_result.is_start != WaitRoomStatus.LiveStart.value or not room_result.time:
+        return []
+    if time() - room_result.time < config.RESULT_DEADLINE:
+        return []
+    if not finalize:
+        return None
+    logger.info("Result deadline expired: room_id={}".format(room_id))
+    return _finalize_result(conn, room_id)
 
 
-def leave_room(room_id: int, user: SafeUser) -> None:
+def result_room(room_id: int) -> list[ResultUser]:
+    if room_registry is not None and room_registry.owns(room_id):
+        with suppress(RoomNotOwned):
+            return room_registry.result_room(room_id)
+    results = result_snapshots.get(room_id)
+    if results is not None:
+        return results
+    with transaction() as conn:
+        results = _result_room(conn, room_id)
+    if results:
+        result_snapshots.set(room_id, results)
+    return results
+
+
+def _load_leaderboard(conn) -> None:
+    """ランキングを MySQL の全ての記録(アーカイブを含む)から作り直す"""
+    logger.info("Enter load_leaderboard")
+    response = conn.execute(statements.SELECT_BEST_SCORES).all()
+    leaderboard.rebuild(response)
+    logger.info("Loaded leaderboard: {} records".format(len(response)))
+
+
+def _leave_room(conn, room_id: int, user: UserRef) -> None:
     logger.info("Enter leave_room")
-    with engine.begin() as conn:
-        try:
-            # ホストか確認
-            start = perf_counter()
-            is_host = conn.execute(
-                text(
-                    "SELECT `is_host` FROM `room_member` WHERE `room_id`=:room_id AND `user_id`=:user_id FOR UPDATE"
-                ),
-                dict(room_id=room_id, user_id=user.id),
-            ).one()[0]
-            end = perf_counter()
-            logger.debug("SQL(SELECT `is_host`): Time={}".format(end - start))
-        except (NoResultFound, MultipleResultsFound):
-            logger.exception("No Room is found or Multiple Rooms are found.")
-            raise HTTPException(status_code=500)
-        if is_host:
-            # 他にメンバーがいるか確認
-            start = perf_counter()
-            result = conn.execute(
-                text("SELECT `user_id` FROM `room_member` WHERE `room_id`=:room_id"),
-                dict(room_id=room_id),
-            )
-            end = perf_counter()
-            logger.debug("SQL(SELECT `is_host`): Time={}".format(end - start))
-            for i in result.all():
-                # 他にメンバーがいる時
-                if i[0] != user.id:
-                    start = perf_counter()
-                    _ = conn.execute(
-                        text(
-                            "UPDATE `room_member` SET `is_host`=:is_host WHERE `user_id`=:user_id AND `room_id`=:room_id"
-                        ),
-                        dict(is_host=True, user_id=i[0], room_id=room_id),
-                    )
-                    end = perf_counter()
-                    logger.debug("SQL(SELECT `is_host`): Time={}".format(end - start))
-                    try:
-                        start = perf_counter()
-                        joined_user_count = conn.execute(
-                            text(
-                                "SELECT `joined_user_count` FROM `room` WHERE `room_id`=:room_id"
-                            ),
-                            dict(room_id=room_id),
-                        ).one()
-                        end = perf_counter()
-                        logger.debug(
-                            "SQL(SELECT `joined_user_count`): Time={}".format(
-                                end - start
-                            )
-                        )
-                    except NoResultFound:
-                        logger.exception("Room Not Found.")
-                        raise HTTPException(status_code=404)
-                    except MultipleResultsFound:
-                        logger.exception("Multiple Room is Found.")
-                        raise HTTPException(status_code=500)
-                    start = perf_counter()
-                    _ = conn.execute(
-                        text(
-                            "UPDATE `room` SET `joined_user_count`=:joined_user_count WHERE `room_id`=:room_id"
-                        ),
-                        dict(
-                            joined_user_count=joined_user_count[0] - 1, room_id=room_id
-                        ),
-                    )
-                    end = perf_counter()
-                    logger.debug("SQL(UPDATE `room`): Time={}".format(end - start))
+    # 先に room の行を更新してロックを取る(join_room と同じ順番)。
+    # MySQL の UPDATE は左から評価するので、is_start は人数を減らす前の値で判定する
+    left = conn.execute(
+        statements.LEAVE_ROOM,
+        dict(
+            dissolution=WaitRoomStatus.Dissolution.value,
+            room_id=room_id,
+            user_id=user.id,
+        ),
+    ).rowcount
+    if not left:
+        logger.error("No Room is found or Multiple Rooms are found.")
+        raise HTTPException(status_code=500)
+    _ = conn.execute(
+        statements.DELETE_ROOM_MEMBER,
+        dict(user_id=user.id, room_id=room_id),
+    )
+    room = conn.execute(
+        statements.SELECT_ROOM_COUNTS,
+        dict(room_id=room_id),
+    ).one()
+    if room.joined_user_count == 0:
+        # 他にメンバーがいない時はルームを解散する
+        events.defer(conn, room_id, "dissolve")
+        return
+    # ホストは常に一番古いメンバーなので、ホストが抜けた時だけ次に古いメンバーに移る
+    _ = conn.execute(
+        statements.TRANSFER_HOST,
+        dict(room_id=room_id),
+    )
+    events.defer(
+        conn,
+        room_id,
+        "leave",
+        live_id=room.live_id,
+        joined_user_count=room.joined_user_count,
+        max_user_count=room.max_user_count,
+        version=room.version,
+    )
 
-                    start = perf_counter()
-                    _ = conn.execute(
-                        text(
-                            "DELETE FROM `room_member` WHERE `user_id`=:user_id AND `room_id`=:room_id"
-                        ),
-                        dict(user_id=user.id, room_id=room_id),
-                    )
-                    end = perf_counter()
-                    logger.debug(
-                        "SQL(DELETE `room_member`): Time={}".format(end - start)
-                    )
-                    return
-            # 他にメンバーがいない時
-            # ルームを解散する
-            start = perf_counter()
-            _ = conn.execute(
-                text(
-                    "UPDATE `room` SET `is_start`=:is_start, `joined_user_count`=:joined_user_count WHERE `room_id`=:room_id"
-                ),
-                dict(
-                    is_start=WaitRoomStatus.Dissolution.value,
-                    joined_user_count=0,
-                    room_id=room_id,
-                ),
-            )
-            end = perf_counter()
-            logger.debug("SQL(UPDATE `room`): Time={}".format(end - start))
-        else:
-            start = perf_counter()
-            _ = conn.execute(
-                text(
-                    "UPDATE `room` SET `joined_user_count`=`joined_user_count`-1 WHERE `room_id`=:room_id"
-                ),
-                dict(room_id=room_id),
-            )
-            end = perf_counter()
-            logger.debug("SQL(UPDATE `room`): Time={}".format(end - start))
-
-            start = perf_counter()
-            _ = conn.execute(
-                text(
-                    "DELETE FROM `room_member` WHERE `user_id`=:user_id AND `room_id`=:room_id"
-                ),
-                dict(user_id=user.id, room_id=room_id),
-            )
-            end = perf_counter()
-            logger.debug("SQL(DELETE `room_member`): Time={}".format(end - start))
+
+def leave_room(room_id: int, user: SafeUser) -> None:
+    if room_registry is not None and room_registry.owns(room_id):
+        with suppress(RoomNotOwned):
+            return room_registry.leave_room(room_id, user)
+    with transaction() as conn:
+        return _leave_room(conn, room_id, user)
+
+
+# ルームの状態をプロセス内で持つモード
+room_registry = None
+if config.ROOM_BACKEND == "memory":
+    from .registry import RoomRegistry, lock_process
+
+    if config.EVENT_BUS:
+        raise RuntimeError("ROOM_BACKEND=memory cannot be used with EVENT_BUS")
+    _registry_lock = lock_process(config.ROOM_REGISTRY_LOCK_FILE)
+    room_registry = RoomRegistry(engine)
+
+# /room/end を数ミリ秒ずつまとめてコミットするモード
+end_buffer = None
+if config.END_ROOM_GROUP_COMMIT:
+    from .group_commit import EndRoomBuffer
+
+    end_buffer = EndRoomBuffer()
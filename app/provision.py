@@ -0,0 +1,35 @@
+"""ユーザーをまとめて作り、トークンを1行に1つ書き出す
+
+負荷試験の準備や事前登録に使う。全員を1トランザクションで作る。
+
+    python -m app.provision --count 5000 --prefix load_ --output tokens.txt
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+from . import model
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, required=True)
+    parser.add_argument("--prefix", default="user_", help="ユーザー名は prefix + 連番")
+    parser.add_argument("--leader-card-id", type=int, default=1000)
+    parser.add_argument("--output", help="トークンを書き出すパス。省略時は標準出力")
+    args = parser.parse_args()
+
+    tokens = model.create_users(
+        [(f"{args.prefix}{i}", args.leader_card_id) for i in range(args.count)]
+    )
+    lines = "".join(token + "\n" for token in tokens)
+    if args.output:
+        Path(args.output).write_text(lines)
+        print(f"created {len(tokens)} users: {args.output}", file=sys.stderr)
+    else:
+        sys.stdout.write(lines)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,461 @@
+import fcntl
+import threading
+from collections import defaultdict
+from time import monotonic, time
+from typing import Optional
+
+from fastapi import HTTPException
+
+from . import config, statements
+from .events import room_events
+from .model import (
+    JoinRoomResult,
+    LiveDifficulty,
+    ResultUser,
+    RoomList,
+    RoomNotOwned,
+    RoomUser,
+    SafeUser,
+    WaitRoomStatus,
+    logger,
+    results_to_json,
+)
+
+
+def lock_process(path: str):
+    """memory バックエンドを動かすプロセスを同じホストで1つに限る
+
+    返したファイルを開いている間ロックを持つ。他のプロセスが持っていたら RuntimeError を投げる。
+    """
+    lock = open(path, "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        raise RuntimeError(
+            "ROOM_BACKEND=memory is already running in another process ({}). "
+            "Run a single worker.".format(path)
+        )
+    return lock
+
+
+class Member:
+    __slots__ = (
+        "user_id",
+        "name",
+        "leader_card_id",
+        "select_difficulty",
+        "is_host",
+        "judge_count_list",
+        "score",
+        "ended",
+    )
+
+    def __init__(self, user: SafeUser, select_difficulty: int, is_host: bool):
+        self.user_id = user.id
+        self.name = user.name
+        self.leader_card_id = user.leader_card_id
+        self.select_difficulty = select_difficulty
+        self.is_host = is_host
+        self.judge_count_list = [0, 0, 0, 0, 0]
+        self.score = 0
+        self.ended = False
+
+
+class Room:
+    __slots__ = (
+        "room_id",
+        "live_id",
+        "max_user_count",
+        "status",
+        "time",
+        "members",
+        "updated_at",
+        "finished_at",
+        "persisted",
+        "result",
+        "version",
+    )
+
+    def __init__(self, room_id: int, live_id: int, max_user_count: int):
+        self.room_id = room_id
+        self.live_id = live_id
+        self.max_user_count = max_user_count
+        self.status = WaitRoomStatus.Waiting.value
+        self.time = 0
+        # 参加順を保つ。user_id -> Member
+        self.members: dict[int, Member] = {}
+        self.updated_at = monotonic()
+        self.finished_at: Optional[float] = None
+        self.persisted = False
+        # 確定したリザルト。確定後は変えない
+        self.result: Optional[list[ResultUser]] = None
+        # 変更のたびに進む。/room/wait の ETag に使う
+        self.version = 0
+
+    def joinable(self) -> bool:
+        return (
+            self.status == WaitRoomStatus.Waiting.value
+            and self.finished_at is None
+            and 0 < len(self.members) < self.max_user_count
+        )
+
+
+class RoomRegistry:
+    """ルームの状態をプロセス内で持つ
+
+    room, room_member テーブルの代わりに create/join/wait/start/end/result/leave を処理する。
+    ルームを知っているのはこのプロセスだけなので、1プロセスで動かす (lock_process)。
+    room_id の採番のために作成時だけ `room` に INSERT し、
+    終わったルーム(全員 end 済みか解散)はバックグラウンドのスレッドがまとめて MySQL に書き込む。
+    書き込む時の状態が最後なので、終わったルーム (finished_at がある) はもう変えない。
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._lock = threading.Lock()
+        self._rooms: dict[int, Room] = {}
+        # live_id -> 入室可能な room_id
+        self._joinable: dict[int, set[int]] = defaultdict(set)
+        # /room/list の ETag に使う。live_id ごとと全体
+        self._list_versions: dict[int, int] = defaultdict(int)
+        self._list_version = 0
+        self._pending: list[Room] = []
+        self._closed = threading.Event()
+        self._writer = threading.Thread(
+            target=self._run_writer, name="room-registry-writer", daemon=True
+        )
+        self._writer.start()
+
+    def owns(self, room_id: int) -> bool:
+        return room_id in self._rooms
+
+    def _room(self, room_id: int) -> Room:
+        """ロックを持った状態で呼ぶ。owns の後に片付けていたら RoomNotOwned を投げる"""
+        room = self._rooms.get(room_id)
+        if room is None:
+            raise RoomNotOwned(room_id)
+        return room
+
+    def _discard_joinable(self, room: Room) -> None:
+        joinable = self._joinable.get(room.live_id)
+        if joinable is not None:
+            joinable.discard(room.room_id)
+            if not joinable:
+                del self._joinable[room.live_id]
+
+    def _touch(self, room: Room) -> None:
+        """ルームの変更後に呼ぶ。ロックを持った状態で呼ぶこと"""
+        room.updated_at = monotonic()
+        room.version += 1
+        self._list_versions[room.live_id] += 1
+        self._list_version += 1
+        if room.joinable():
+            self._joinable[room.live_id].add(room.room_id)
+        else:
+            self._discard_joinable(room)
+        if room.finished_at is None and (
+            room.status == WaitRoomStatus.Dissolution.value or room.result is not None
+        ):
+            room.finished_at = room.updated_at
+            self._pending.append(room)
+
+    def create_room(
+        self,
+        room_id: int,
+        live_id: int,
+        select_difficulty: LiveDifficulty,
+        user: SafeUser,
+    ) -> int:
+        room = Room(room_id, live_id, max_user_count=4)
+        room.members[user.id] = Member(user, select_difficulty.value, is_host=True)
+        with self._lock:
+            self._rooms[room_id] = room
+            self._touch(room)
+        room_events.publish(room_id, "create")
+        return room_id
+
+    def list_room(self, live_id: int) -> list[RoomList]:
+        with self._lock:
+            if live_id == 0:
+                room_ids = [r for ids in self._joinable.values() for r in ids]
+            else:
+                room_ids = list(self._joinable.get(live_id, ()))
+            rooms = [self._rooms[r] for r in room_ids]
+            return [
+                RoomList(
+                    room_id=room.room_id,
+                    live_id=room.live_id,
+                    joined_user_count=len(room.members),
+                    max_user_count=room.max_user_count,
+                )
+                for room in rooms
+            ]
+
+    def join_room(
+        self, room_id: int, select_difficulty: LiveDifficulty, user: SafeUser
+    ) -> JoinRoomResult:
+        with self._lock:
+            room = self._room(room_id)
+            # 放置されて書き込んだルームは Waiting のままだが、もう入れない
+            if (
+                room.status != WaitRoomStatus.Waiting.value
+                or room.finished_at is not None
+                or not room.members
+            ):
+                return JoinRoomResult.Disbanded
+            if user.id in room.members:
+                return JoinRoomResult.OtherError
+            if len(room.members) >= room.max_user_count:
+                return JoinRoomResult.RoomFull
+            room.members[user.id] = Member(user, select_difficulty.value, is_host=False)
+            self._touch(room)
+        room_events.publish(room_id, "join")
+        return JoinRoomResult.Ok
+
+    def quick_join_room(
+        self, live_id: int, select_difficulty: LiveDifficulty, user: SafeUser
+    ) -> Optional[int]:
+        """model._rank_rooms と同じ順で一番よいルームに参加する。なければ None"""
+        with self._lock:
+            rooms = [
+                self._rooms[r]
+                for r in self._joinable.get(live_id, ())
+                if user.id not in self._rooms[r].members
+            ]
+            if not rooms:
+                return None
+            room = min(
+                rooms,
+                key=lambda room: (
+                    -len(room.members),
+                    -sum(
+                        m.select_difficulty == select_difficulty.value
+                        for m in room.members.values()
+                    ),
+                    room.room_id,
+                ),
+            )
+            room.members[user.id] = Member(user, select_difficulty.value, is_host=False)
+            self._touch(room)
+        room_events.publish(room.room_id, "join")
+        return room.room_id
+
+    def wait_room(self, room_id: int, user: SafeUser):
+        with self._lock:
+            room = self._room(room_id)
+            return room.status, [
+                RoomUser(
+                    user_id=m.user_id,
+                    name=m.name,
+                    leader_card_id=m.leader_card_id,
+                    select_difficulty=m.select_difficulty,
+                    is_me=m.user_id == user.id,
+                    is_host=m.is_host,
+                )
+                for m in room.members.values()
+            ]
+
+    def room_version(self, room_id: int) -> int:
+        with self._lock:
+            return self._room(room_id).version
+
+    def list_version(self, live_id: int) -> int:
+        with self._lock:
+            if live_id == 0:
+                return self._list_version
+            return self._list_versions.get(live_id, 0)
+
+    def start_room(self, room_id: int, user: SafeUser) -> None:
+        with self._lock:
+            room = self._room(room_id)
+            member = room.members.get(user.id)
+            if member is None:
+                raise HTTPException(status_code=500)
+            if not member.is_host:
+                logger.info("User is not a host.")
+                raise HTTPException(status_code=403)
+            if room.finished_at is not None:
+                return
+            room.status = WaitRoomStatus.LiveStart.value
+            self._touch(room)
+        room_events.publish(room_id, "start")
+
+    def end_room(
+        self, room_id: int, score: int, user: SafeUser, judge_count_list: list[int]
+    ) -> None:
+        with self._lock:
+            room = self._room(room_id)
+            member = room.members.get(user.id)
+            if member is None or room.finished_at is not None:
+                return
+            member.judge_count_list = (list(judge_count_list) + [0] * 5)[:5]
+            member.score = score
+            member.ended = True
+            if not room.time:
+                room.time = int(time())
+            if room.result is None and all(m.ended for m in room.members.values()):
+                room.result = self._finalize(room)
+            self._touch(room)
+        room_events.publish(
+            room_id, "end", dict(live_id=room.live_id, user_id=user.id, score=score)
+        )
+
+    def _finalize(self, room: Room) -> list[ResultUser]:
+        return [
+            ResultUser(
+                user_id=m.user_id,
+                judge_count_list=list(m.judge_count_list),
+                score=m.score,
+            )
+            for m in room.members.values()
+        ]
+
+    def result_room(self, room_id: int) -> list[ResultUser]:
+        with self._lock:
+            room = self._room(room_id)
+            if room.result is None:
+                # 最初の end から締め切りを過ぎたら、揃っていなくても確定させる
+                if (
+                    room.finished_at is not None
+                    or room.status != WaitRoomStatus.LiveStart.value
+                    or not room.time
+                    or time() - room.time < config.RESULT_DEADLINE
+                ):
+                    return []
+                room.result = self._finalize(room)
+                self._touch(room)
+            return room.result
+
+    def leave_room(self, room_id: int, user: SafeUser) -> None:
+        with self._lock:
+            room = self._room(room_id)
+            if room.finished_at is not None:
+                return
+            member = room.members.pop(user.id, None)
+            if member is None:
+                logger.error("No Room is found or Multiple Rooms are found.")
+                raise HTTPException(status_code=500)
+            if member.is_host:
+                if room.members:
+                    # 次に古いメンバーをホストにする
+                    next(iter(room.members.values())).is_host = True
+                else:
+                    room.status = WaitRoomStatus.Dissolution.value
+            self._touch(room)
+            event = (
+                "dissolve"
+                if room.status == WaitRoomStatus.Dissolution.value
+                else "leave"
+            )
+        room_events.publish(room_id, event)
+
+    def update_profile(self, user: SafeUser) -> None:
+        """ユーザー名などが変わったら、参加中のルームの表示も更新する"""
+        with self._lock:
+            for room in self._rooms.values():
+                member = room.members.get(user.id)
+                if member is not None and room.finished_at is None:
+                    member.name = user.name
+                    member.leader_card_id = user.leader_card_id
+                    room.version += 1
+
+    def flush(self) -> None:
+        """終わったルームを MySQL に書き込み、保持期間を過ぎたものを捨てる"""
+        now = monotonic()
+        with self._lock:
+            # 放置されたルームも書き込んでから片付ける
+            for room in self._rooms.values():
+                if (
+                    room.finished_at is None
+                    and now - room.updated_at > config.ROOM_REGISTRY_IDLE_TIMEOUT
+                ):
+                    room.finished_at = now
+                    self._pending.append(room)
+                    # 書き込んだ後に参加されても MySQL に残らないので、もう入れない
+                    self._discard_joinable(room)
+            batch = self._pending[: config.ROOM_PERSIST_BATCH_SIZE]
+            del self._pending[: len(batch)]
+            rooms = [
+                dict(
+                    room_id=room.room_id,
+                    joined_user_count=len(room.members),
+                    is_start=room.status,
+                    time=room.time,
+                )
+                for room in batch
+            ]
+            results = [
+                dict(room_id=room.room_id, result=results_to_json(room.result))
+                for room in batch
+                if room.result is not None
+            ]
+            members = [
+                dict(
+                    room_id=room.room_id,
+                    user_id=m.user_id,
+                    select_difficulty=m.select_difficulty,
+                    is_host=m.is_host,
+                    judge_perfect=m.judge_count_list[0],
+                    judge_great=m.judge_count_list[1],
+                    judge_good=m.judge_count_list[2],
+                    judge_bad=m.judge_count_list[3],
+                    judge_miss=m.judge_count_list[4],
+                    score=m.score,
+                )
+                for room in batch
+                for m in room.members.values()
+            ]
+        if batch:
+            try:
+                self._persist(rooms, members, results)
+            except Exception:
+                logger.exception("Failed to persist rooms. Retry later.")
+                with self._lock:
+                    self._pending[:0] = batch
+                return
+            for room in batch:
+                room.persisted = True
+        with self._lock:
+            for room_id, room in list(self._rooms.items()):
+                if (
+                    room.persisted
+                    and now - room.finished_at > config.ROOM_REGISTRY_RETENTION
+                ):
+                    del self._rooms[room_id]
+                    self._discard_joinable(room)
+                    room_events.forget(room_id)
+
+    def _persist(
+        self, rooms: list[dict], members: list[dict], results: list[dict]
+    ) -> None:
+        with self._engine.begin() as conn:
+            conn.execute(
+                statements.PERSIST_ROOM,
+                rooms,
+            )
+            if members:
+                conn.execute(
+                    statements.INSERT_ROOM_MEMBERS,
+                    members,
+                )
+            if results:
+                conn.execute(
+                    statements.INSERT_ROOM_RESULT,
+                    results,
+                )
+        logger.info("Persisted {} rooms, {} members".format(len(rooms), len(members)))
+
+    def _run_writer(self) -> None:
+        while not self._closed.wait(config.ROOM_PERSIST_INTERVAL):
+            self.flush()
+
+    def close(self) -> None:
+        """書き込み待ちを全て書き込んでから止める"""
+        self._closed.set()
+        self._writer.join()
+        while self._pending:
+            before = len(self._pending)
+            self.flush()
+            if len(self._pending) >= before:
+                break
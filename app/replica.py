@@ -0,0 +1,169 @@
+"""読み取りだけのリクエストをリードレプリカに振り分ける
+
+/room/list, /room/wait, /room/result とトークンの検索は、レプリカが設定されていて
+遅れが REPLICA_MAX_LAG 秒以下ならレプリカから読む (async_model.RequestConnection.read)。
+
+- 書き込んだユーザー(トークン)の読み込みは REPLICA_STICKY_WINDOW 秒の間 primary から読む。
+  /room/join の直後の /room/wait に自分の join が見えるようにするため。
+  他のワーカーにはイベントバス (app.bus) で伝える
+- 遅れは primary に書いたハートビートがレプリカに届くまでの時間で測る (Heartbeat)。
+  測れていないときはレプリカを使わない
+"""
+
+import threading
+from collections import OrderedDict
+from time import monotonic, time
+from typing import Optional
+
+from . import bus, config, log, metrics, statements
+
+logger = log.get_logger(__name__)
+
+
+class ReplicaRouter:
+    """読み込みを primary とレプリカのどちらに向けるか決める"""
+
+    def __init__(
+        self,
+        enabled: bool,
+        window: float = config.REPLICA_STICKY_WINDOW,
+        max_lag: float = config.REPLICA_MAX_LAG,
+    ):
+        self.enabled = enabled
+        self.window = window
+        self.max_lag = max_lag
+        self._lock = threading.Lock()
+        # 書き込んだユーザーのキー -> primary から読む期限 (monotonic)。期限の順に並ぶ
+        self._sticky: "OrderedDict[str, float]" = OrderedDict()
+        # 最後に測ったレプリカの遅れ(秒)と測った時刻。測れていなければ None
+        self.lag: Optional[float] = None
+        self._measured_at = 0.0
+
+    def stick(self, key: str) -> None:
+        """key のユーザーが書き込んだ。しばらく primary から読む"""
+        now = monotonic()
+        with self._lock:
+            self._sticky[key] = now + self.window
+            self._sticky.move_to_end(key)
+            while self._sticky:
+                oldest, until = next(iter(self._sticky.items()))
+                if until > now:
+                    break
+                del self._sticky[oldest]
+
+    def wrote(self, key: str) -> None:
+        """コミットした後に呼ぶ。他のワーカーにも伝える"""
+        if not self.enabled:
+            return
+        self.stick(key)
+        if bus.current is not None:
+            bus.current.publish("sticky", key=key)
+
+    def sticky(self, key: Optional[str]) -> bool:
+        if key is None:
+            return False
+        with self._lock:
+            until = self._sticky.get(key)
+        return until is not None and until > monotonic()
+
+    def current_lag(self) -> Optional[float]:
+        """遅れの上限の見積もり。測ってから経った時間の分だけ遅れが伸びているかもしれない"""
+        lag = self.lag
+        if lag is None:
+            return None
+        return lag + monotonic() - self._measured_at
+
+    def healthy(self) -> bool:
+        lag = self.current_lag()
+        return self.enabled and lag is not None and lag <= self.max_lag
+
+    def use_replica(self, key: Optional[str]) -> bool:
+        """key のユーザーの読み込みをレプリカから読んでよいか"""
+        return self.healthy() and not self.sticky(key)
+
+    def observe_lag(self, lag: Optional[float]) -> None:
+        was_healthy = self.healthy()
+        self.lag = lag
+        self._measured_at = monotonic()
+        if was_healthy and not self.healthy():
+            logger.warning(
+                "Replica lag {} exceeds {}s. Reading from primary.".format(
+                    lag, self.max_lag
+                )
+            )
+        elif not was_healthy and self.healthy():
+            logger.info("Replica caught up: lag={:.3f}s".format(lag))
+
+    def connect_bus(self, event_bus: "bus.EventBus") -> None:
+        event_bus.subscribe("sticky", lambda m: self.stick(m["key"]))
+
+
+class Heartbeat:
+    """primary にハートビート(時刻)を書き、レプリカから読んで遅れを測る
+
+    遅れは「今の時刻 - レプリカに届いている最新のハートビート」。
+    ワーカーごとに同じ行を上書きするので、他のワーカーのハートビートで測ることもある。
+    """
+
+    def __init__(
+        self,
+        primary,
+        replica,
+        router: ReplicaRouter,
+        interval: float = config.REPLICA_HEARTBEAT_INTERVAL,
+    ):
+        self._primary = primary
+        self._replica = replica
+        self._router = router
+        self.interval = interval
+        self._closed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def beat(self) -> Optional[float]:
+        """1回書いて読み、測った遅れを router に渡して返す"""
+        with self._primary.begin() as conn:
+            conn.execute(statements.WRITE_HEARTBEAT, dict(beat=time()))
+        with self._replica.connect() as conn:
+            beat = conn.execute(statements.SELECT_HEARTBEAT).scalar()
+        lag = max(0.0, time() - beat) if beat is not None else None
+        self._router.observe_lag(lag)
+        return lag
+
+    def run(self) -> None:
+        while not self._closed.wait(self.interval):
+            try:
+                self.beat()
+            except Exception:
+                logger.exception("Failed to measure replica lag.")
+                self._router.observe_lag(None)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self.run, name="replica-heartbeat", daemon=True
+        )
+        self._thread.start()
+
+    def close(self) -> None:
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+router = ReplicaRouter(
+    enabled=bool(config.REPLICA_DATABASE_URI and config.ASYNC_REPLICA_DATABASE_URI)
+)
+
+reads = metrics.registry.register(
+    metrics.Counter(
+        "gameserver_db_reads_total",
+        "読み取りだけのリクエストを primary とレプリカのどちらで読んだか",
+        ("target",),
+    )
+)
+metrics.registry.register(
+    metrics.Gauge(
+        "gameserver_replica_lag_seconds",
+        "最後に測ったリードレプリカの遅れ。測れていなければ出さない",
+        callback=lambda: {} if router.lag is None else {(): router.lag},
+    )
+)
@@ -0,0 +1,66 @@
+"""ポーリングされるエンドポイントの速いレスポンス
+
+/room/list, /room/wait, /room/result は response_model の pydantic オブジェクトを作らず、
+レスポンスと同じ形の dict を orjson でそのまま JSON にする。
+FastAPI は Response を返すと response_model での検証と jsonable_encoder を飛ばすので、
+1リクエストごとの検証と変換がなくなる。response_model はデコレータに残すので OpenAPI は変わらない。
+"""
+
+from typing import Iterable
+
+from fastapi.responses import ORJSONResponse
+
+
+def room_list(rooms: Iterable) -> ORJSONResponse:
+    """RoomListResponse と同じ形"""
+    return ORJSONResponse(
+        {
+            "room_info_list": [
+                {
+                    "room_id": r.room_id,
+                    "live_id": r.live_id,
+                    "joined_user_count": r.joined_user_count,
+                    "max_user_count": r.max_user_count,
+                }
+                for r in rooms
+            ]
+        }
+    )
+
+
+def room_wait(status, room_users: Iterable, poll_interval: float) -> ORJSONResponse:
+    """RoomWaitResponse と同じ形。Enum は orjson が値にする"""
+    return ORJSONResponse(
+        {
+            "status": status,
+            "room_user_list": [
+                {
+                    "user_id": u.user_id,
+                    "name": u.name,
+                    "leader_card_id": u.leader_card_id,
+                    "select_difficulty": u.select_difficulty,
+                    "is_me": u.is_me,
+                    "is_host": u.is_host,
+                }
+                for u in room_users
+            ],
+            "poll_interval": poll_interval,
+        }
+    )
+
+
+def room_result(results: Iterable, poll_interval: float) -> ORJSONResponse:
+    """RoomResultResponse と同じ形"""
+    return ORJSONResponse(
+        {
+            "result_user_list": [
+                {
+                    "user_id": r.user_id,
+                    "judge_count_list": r.judge_count_list,
+                    "score": r.score,
+                }
+                for r in results
+            ],
+            "poll_interval": poll_interval,
+        }
+    )
@@ -0,0 +1,223 @@
+import threading
+from time import monotonic
+from typing import Iterable, NamedTuple, Optional
+
+
+class RoomEntry(NamedTuple):
+    room_id: int
+    live_id: int
+    joined_user_count: int
+    max_user_count: int
+
+
+class JoinableRoomIndex:
+    """/room/list 用の入室可能なルームの索引
+
+    ルームの変更イベントで差分更新し、live_id ごとの集合と全体の集合から SQL なしで答える。
+    他のワーカーでの変更や取りこぼしは max_staleness 秒ごとの突き合わせ(reconcile)で直し、
+    食い違っていたルームの数を divergences に数える。
+    """
+
+    def __init__(self, max_staleness: float):
+        self.max_staleness = max_staleness
+        self._lock = threading.Lock()
+        # Waiting のルーム。満員のルームも人数の増減を追うために持っておく
+        self._rooms: dict[int, RoomEntry] = {}
+        # 入室可能な room_id。dict を挿入順を保つ集合として使う
+        self._joinable: dict[int, None] = {}
+        self._by_live: dict[int, dict[int, None]] = {}
+        self._reconciled_at: Optional[float] = None
+        self._reconcile_started: Optional[float] = None
+        # reconcile 中にイベントで変わったルーム。DBの結果で上書きしない
+        self._touched: Optional[set[int]] = None
+        # 反映したルームのバージョン (room.version)。イベントは他のワーカーからも届き、
+        # 届く順番が前後するので、これより古いものは捨てる
+        self._room_versions: dict[int, int] = {}
+        # 開始・解散したルームと、その時刻。Waiting に戻ることはないので以降のイベントは捨てる
+        self._finished: dict[int, float] = {}
+        # 最近イベントを反映したルームと、その時刻。遅れのあるリードレプリカの結果で上書きしない
+        self._event_at: dict[int, float] = {}
+        # 入室可能なルームの集合が変わるたびに進む
+        self.version = 0
+        self.live_versions: dict[int, int] = {}
+        self.hits = 0
+        self.reconciles = 0
+        self.divergences = 0
+
+    def _put(self, entry: RoomEntry) -> None:
+        self._rooms[entry.room_id] = entry
+        if 0 < entry.joined_user_count < entry.max_user_count:
+            live = self._by_live.setdefault(entry.live_id, {})
+            self._joinable[entry.room_id] = None
+            live[entry.room_id] = None
+        else:
+            self._discard_joinable(entry)
+        self._bump(entry.live_id)
+
+    def _remove(self, room_id: int) -> None:
+        entry = self._rooms.pop(room_id, None)
+        if entry is not None:
+            self._discard_joinable(entry)
+            self._bump(entry.live_id)
+
+    def _discard_joinable(self, entry: RoomEntry) -> None:
+        self._joinable.pop(entry.room_id, None)
+        live = self._by_live.get(entry.live_id)
+        if live is not None:
+            live.pop(entry.room_id, None)
+            if not live:
+                del self._by_live[entry.live_id]
+
+    def _bump(self, live_id: int) -> None:
+        self.version += 1
+        self.live_versions[live_id] = self.live_versions.get(live_id, 0) + 1
+
+    def on_event(self, room_id: int, event: str, version: int, data: dict) -> None:
+        """RoomEventHub の listener"""
+        with self._lock:
+            if self._touched is not None:
+                self._touched.add(room_id)
+            if room_id in self._finished:
+                return
+            self._event_at[room_id] = monotonic()
+            if "version" in data:
+                if data["version"] <= self._room_versions.get(room_id, -1):
+                    return
+                self._room_versions[room_id] = data["version"]
+            if event in ("create", "join", "leave") and "live_id" in data:
+                self._put(
+                    RoomEntry(
+                        room_id,
+                        data["live_id"],
+                        data["joined_user_count"],
+                        data["max_user_count"],
+                    )
+                )
+            elif event == "leave":
+                entry = self._rooms.get(room_id)
+                if entry is not None:
+                    self._put(
+                        entry._replace(joined_user_count=entry.joined_user_count - 1)
+                    )
+            elif event in ("start", "dissolve"):
+                self._finished[room_id] = monotonic()
+                self._room_versions.pop(room_id, None)
+                self._remove(room_id)
+
+    def lookup(self, live_id: int) -> Optional[list[RoomEntry]]:
+        """索引から答える。古くなっていて突き合わせが必要なら None を返す
+
+        None を受け取った呼び出し元が DB から全件を読み、reconcile を呼ぶ。
+        その間に来た他のリクエストには古い索引のまま答える。
+        """
+        now = monotonic()
+        with self._lock:
+            stale = (
+                self._reconciled_at is None
+                or now - self._reconciled_at > self.max_staleness
+            )
+            reconciling = (
+                self._reconcile_started is not None
+                and now - self._reconcile_started <= self.max_staleness
+            )
+            if stale and not reconciling:
+                self._reconcile_started = now
+                self._touched = set()
+                return None
+            if self._reconciled_at is None:
+                return None
+            self.hits += 1
+            return self._list(live_id)
+
+    def list_version(self, live_id: int) -> Optional[int]:
+        """live_id の入室可能なルームのバージョン。突き合わせが必要なほど古ければ None
+
+        None のときは lookup からやり直させ、他のワーカーでの変更を取り込む。
+        """
+        with self._lock:
+            if (
+                self._reconciled_at is None
+                or monotonic() - self._reconciled_at > self.max_staleness
+            ):
+                return None
+            if live_id == 0:
+                return self.version
+            return self.live_versions.get(live_id, 0)
+
+    def rooms(self, live_id: int) -> list[RoomEntry]:
+        with self._lock:
+            return self._list(live_id)
+
+    def _list(self, live_id: int) -> list[RoomEntry]:
+        if live_id == 0:
+            # live_idが0のときは入室できる全てのルーム
+            return [self._rooms[r] for r in self._joinable]
+        return [self._rooms[r] for r in self._by_live.get(live_id, ())]
+
+    def reconcile(self, rows: Iterable, lag: float = 0.0) -> int:
+        """DB から読んだ入室可能なルーム全件で索引を置き換え、食い違いの数を返す
+
+        lag はリードレプリカから読んだときの遅れの上限(秒)。rows はその分だけ古いかもしれないので、
+        読み始める lag 秒前からイベントがあったルームは rows で上書きしない。
+        """
+        rows = list(rows)
+        fresh = {
+            row.room_id: RoomEntry(
+                row.room_id, row.live_id, row.joined_user_count, row.max_user_count
+            )
+            for row in rows
+        }
+        versions = {row.room_id: row.version for row in rows if hasattr(row, "version")}
+        with self._lock:
+            touched = self._touched or set()
+            first = self._reconciled_at is None
+            diverged = 0
+            # 開始・解散から max_staleness 以上たったルームのイベントはもう届かないとみなす
+            now = monotonic()
+            expired = now - self.max_staleness
+            for room_id, finished_at in list(self._finished.items()):
+                if finished_at < expired:
+                    del self._finished[room_id]
+            behind = (self._reconcile_started or now) - lag
+            for room_id, event_at in list(self._event_at.items()):
+                if event_at < min(expired, behind):
+                    del self._event_at[room_id]
+            for room_id in set(self._rooms) | set(fresh):
+                if room_id in touched or room_id in self._finished:
+                    continue
+                if lag and self._event_at.get(room_id, behind) > behind:
+                    continue
+                if room_id in versions:
+                    if versions[room_id] < self._room_versions.get(room_id, -1):
+                        # DB を読んだ後のイベントが反映済み
+                        continue
+                    self._room_versions[room_id] = versions[room_id]
+                current = (
+                    self._rooms.get(room_id) if room_id in self._joinable else None
+                )
+                expected = fresh.get(room_id)
+                if current == expected:
+                    continue
+                diverged += 1
+                if expected is None:
+                    self._room_versions.pop(room_id, None)
+                    self._remove(room_id)
+                else:
+                    self._put(expected)
+            if not first:
+                self.divergences += diverged
+            self.reconciles += 1
+            self._reconciled_at = monotonic()
+            self._reconcile_started = None
+            self._touched = None
+            return diverged
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(
+                rooms=len(self._joinable),
+                version=self.version,
+                hits=self.hits,
+                reconciles=self.reconciles,
+                divergences=self.divergences,
+            )
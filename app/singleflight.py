@@ -0,0 +1,99 @@
+"""同じ読み込みの同時実行をまとめる (single-flight)
+
+ライブ開始前は同じルームの全員が /room/wait を、終了後は /room/result を同時にポーリングする。
+同じキーの読み込みが実行中なら、後から来たリクエストは DB を読まずにその結果を待って使う。
+結果は共有されるので、呼び出し側で is_me など呼び出し元ごとの部分を後から埋める。
+
+キーごとに世代 (generation) を渡す。ルームのバージョンなどを渡し、実行中の読み込みを
+始めた後にルームが変わっていれば (世代が違えば) 相乗りせず新しく読む。
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+from . import metrics
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """キー -> 実行中の読み込み。イベントループの中だけで使う"""
+
+    def __init__(self):
+        self._flights: dict[Hashable, tuple[object, asyncio.Future]] = {}
+        # op -> [DB を読んだ数, 相乗りした数]
+        self.counts: dict[str, list[int]] = {}
+
+    def _count(self, op: str, shared: bool) -> None:
+        self.counts.setdefault(op, [0, 0])[shared] += 1
+        requests.inc(op, "shared" if shared else "executed")
+
+    async def do(
+        self,
+        op: str,
+        key: Hashable,
+        generation: object,
+        fetch: Callable[[], Awaitable[T]],
+    ) -> T:
+        """(op, key) の読み込みが同じ世代で実行中ならその結果を、なければ fetch() を実行して返す
+
+        実行していたリクエストがキャンセルされた(クライアントが切断した)ら、待っていた側は自分で読む。
+        """
+        flight_key = (op, key)
+        flight = self._flights.get(flight_key)
+        if flight is not None and flight[0] == generation:
+            future = flight[1]
+            await asyncio.wait({future})
+            if not future.cancelled():
+                self._count(op, True)
+                return future.result()
+            self._count(op, False)
+            return await fetch()
+
+        future = asyncio.get_running_loop().create_future()
+        self._flights[flight_key] = (generation, future)
+        self._count(op, False)
+        try:
+            result = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # 待っている人がいなくても "never retrieved" の警告を出さない
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self._flights.get(flight_key, (None, None))[1] is future:
+                del self._flights[flight_key]
+
+    def collapse_ratio(self) -> dict:
+        """op ごとの、DB を読まずに済んだリクエストの割合"""
+        return {
+            (op,): shared / (executed + shared)
+            for op, (executed, shared) in self.counts.items()
+            if executed + shared
+        }
+
+
+requests = metrics.registry.register(
+    metrics.Counter(
+        "gameserver_singleflight_requests_total",
+        "single-flight を通った読み込みの数。result=executed は DB を読んだ, shared は相乗りした",
+        ("op", "result"),
+    )
+)
+
+flights = SingleFlight()
+
+metrics.registry.register(
+    metrics.Gauge(
+        "gameserver_singleflight_collapse_ratio",
+        "single-flight で DB を読まずに済んだリクエストの割合",
+        ("op",),
+        callback=flights.collapse_ratio,
+    )
+)
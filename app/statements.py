@@ -0,0 +1,341 @@
+"""room / user / room_member の SQL をまとめた名前つきのステートメント
+
+SQL はここで1回だけ text() にして、モジュールの定数として使い回す。
+呼び出しのたびに text() を作るとバインド変数の解析とキャッシュキーの計算が毎回かかるが、
+同じオブジェクトを渡せば SQLAlchemy のコンパイル済みキャッシュに同じキーで当たる。
+
+instrument_engine したエンジンでは、名前ごとの実行回数を
+gameserver_sql_statement_executions_total に数える。ここにない SQL は "inline" になる。
+"""
+
+from typing import Callable
+
+from sqlalchemy import bindparam, event, text
+from sqlalchemy.sql.elements import TextClause
+
+from . import metrics
+
+
+class StatementRegistry:
+    def __init__(self):
+        self.statements: dict[str, TextClause] = {}
+        self.families: dict[str, Callable[[int], TextClause]] = {}
+        self._names: dict[int, str] = {}
+
+    def _check(self, name: str) -> None:
+        if name in self.statements or name in self.families:
+            raise ValueError("Duplicate statement: {}".format(name))
+
+    def add(self, name: str, sql: str, *bindparams) -> TextClause:
+        self._check(name)
+        statement = text(sql)
+        if bindparams:
+            statement = statement.bindparams(*bindparams)
+        self.statements[name] = statement
+        self._names[id(statement)] = name
+        return statement
+
+    def add_family(
+        self, name: str, build: Callable[[int], str]
+    ) -> Callable[[int], TextClause]:
+        """行数で SQL が変わるステートメント。build(n) の SQL を n ごとに1回だけ text() にする"""
+        self._check(name)
+        cache: dict[int, TextClause] = {}
+
+        def get(n: int) -> TextClause:
+            statement = cache.get(n)
+            if statement is None:
+                statement = cache.setdefault(n, text(build(n)))
+                self._names[id(statement)] = name
+            return statement
+
+        self.families[name] = get
+        return get
+
+    def name_of(self, statement) -> str:
+        return self._names.get(id(statement), "inline")
+
+
+registry = StatementRegistry()
+add = registry.add
+
+executions = metrics.registry.register(
+    metrics.Counter(
+        "gameserver_sql_statement_executions_total",
+        "名前つきのステートメントごとの実行回数。登録していない SQL は inline",
+        ("statement",),
+    )
+)
+
+
+def instrument_engine(engine) -> None:
+    """AsyncEngine は sync_engine を渡す"""
+
+    @event.listens_for(engine, "before_execute")
+    def before_execute(conn, clauseelement, multiparams, params, execution_options):
+        executions.inc(registry.name_of(clauseelement))
+
+
+# user
+
+INSERT_USER = add(
+    "insert_user",
+    "INSERT INTO `user` (name, hashed_token, leader_card_id) VALUES (:name, :hashed_token, :leader_card_id)",
+)
+SELECT_USER_BY_TOKEN = add(
+    "select_user_by_token",
+    "SELECT * FROM `user` WHERE `hashed_token`=:hashed_token",
+)
+SELECT_USER_BY_ID = add(
+    "select_user_by_id",
+    "SELECT `id`, `name`, `leader_card_id` FROM `user` WHERE `id`=:user_id",
+)
+# 署名つきトークンのユーザーを作ったときに、仮の hashed_token から id を引く
+SELECT_USER_IDS_BY_TOKENS = add(
+    "select_user_ids_by_tokens",
+    "SELECT `id`, `hashed_token` FROM `user` WHERE `hashed_token` IN :hashed_tokens",
+    bindparam("hashed_tokens", expanding=True),
+)
+UPDATE_USER = add(
+    "update_user",
+    "UPDATE `user` SET `name`=:name, `leader_card_id`=:leader_card_id WHERE `hashed_token`=:hashed_token",
+)
+# 待機中のルームの roster にプロフィールが出るので、そのルームのバージョンも進める
+BUMP_WAITING_ROOMS_OF_USER = add(
+    "bump_waiting_rooms_of_user",
+    "UPDATE `room` INNER JOIN `room_member` ON `room_member`.room_id = `room`.room_id INNER JOIN `user` ON `user`.id = `room_member`.user_id SET `room`.`version`=`room`.`version`+1 WHERE `user`.hashed_token=:hashed_token AND `room`.is_start=:is_start",
+)
+UPDATE_USER_BY_ID = add(
+    "update_user_by_id",
+    "UPDATE `user` SET `name`=:name, `leader_card_id`=:leader_card_id WHERE `id`=:user_id",
+)
+BUMP_WAITING_ROOMS_OF_USER_ID = add(
+    "bump_waiting_rooms_of_user_id",
+    "UPDATE `room` INNER JOIN `room_member` ON `room_member`.room_id = `room`.room_id SET `room`.`version`=`room`.`version`+1 WHERE `room_member`.user_id=:user_id AND `room`.is_start=:is_start",
+)
+
+# room
+
+INSERT_ROOM = add(
+    "insert_room",
+    "INSERT INTO `room` SET `live_id`=:live_id, `joined_user_count`=:joined_user_count, `max_user_count`=:max_user_count, `is_start`=:is_start, `time`=:time",
+)
+SELECT_JOINABLE_ROOMS = add(
+    "select_joinable_rooms",
+    "SELECT `room_id`, `live_id`, `joined_user_count`, `max_user_count`, `version` FROM `room` WHERE `is_start`=:is_start AND `joined_user_count` > 0 AND `joined_user_count` < `max_user_count`",
+)
+JOIN_ROOM = add(
+    "join_room",
+    "UPDATE `room` SET `joined_user_count`=`joined_user_count`+1, `version`=`version`+1"
+    " WHERE `room_id`=:room_id AND `is_start`=:is_start AND `joined_user_count` > 0 AND `joined_user_count` < `max_user_count`"
+    " AND NOT EXISTS (SELECT 1 FROM `room_member` WHERE `room_member`.`room_id`=:room_id AND `room_member`.`user_id`=:user_id)",
+)
+SELECT_ROOM = add(
+    "select_room",
+    "SELECT `live_id`, `joined_user_count`, `max_user_count`, `is_start`, `version` FROM `room` WHERE `room_id`=:room_id",
+)
+SELECT_ROOM_COUNTS = add(
+    "select_room_counts",
+    "SELECT `live_id`, `joined_user_count`, `max_user_count`, `version` FROM `room` WHERE `room_id`=:room_id",
+)
+SELECT_ROOM_VERSION = add(
+    "select_room_version",
+    "SELECT `version` FROM `room` WHERE `room_id`=:room_id",
+)
+SELECT_ROOM_LIVE_ID = add(
+    "select_room_live_id",
+    "SELECT `live_id` FROM `room` WHERE `room_id`=:room_id",
+)
+SELECT_ROOM_START_TIME = add(
+    "select_room_start_time",
+    "SELECT `is_start`, `time` FROM `room` WHERE `room_id`=:room_id",
+)
+START_ROOM = add(
+    "start_room",
+    "UPDATE `room` SET `is_start`=:is_start, `version`=`version`+1 WHERE `room_id`=:room_id",
+)
+END_ROOM = add(
+    "end_room",
+    "UPDATE `room` SET `time`=CASE WHEN `time`=0 THEN :new_time ELSE `time` END, `version`=`version`+1 WHERE `room_id`=:room_id",
+)
+END_ROOMS = add(
+    "end_rooms",
+    "UPDATE `room` SET `time`=CASE WHEN `time`=0 THEN :new_time ELSE `time` END, `version`=`version`+1 WHERE `room_id` IN :room_ids",
+    bindparam("room_ids", expanding=True),
+)
+LEAVE_ROOM = add(
+    "leave_room",
+    "UPDATE `room` SET `is_start`=CASE WHEN `joined_user_count` <= 1 THEN :dissolution ELSE `is_start` END, `joined_user_count`=`joined_user_count`-1, `version`=`version`+1 WHERE `room_id`=:room_id AND EXISTS (SELECT 1 FROM `room_member` WHERE `room_member`.`room_id`=:room_id AND `room_member`.`user_id`=:user_id)",
+)
+PERSIST_ROOM = add(
+    "persist_room",
+    "UPDATE `room` SET `joined_user_count`=:joined_user_count, `is_start`=:is_start, `time`=:time WHERE `room_id`=:room_id",
+)
+
+# room_member
+
+INSERT_ROOM_MEMBER = add(
+    "insert_room_member",
+    "INSERT INTO `room_member` SET `room_id`=:room_id, `user_id`=:user_id, `select_difficulty`=:select_difficulty, `is_host`=:is_host, `judge_miss`=:judge_miss, `judge_bad`=:judge_bad, `judge_good`=:judge_good, `judge_great`=:judge_great, `judge_perfect`=:judge_perfect, `score`=:score",
+)
+# executemany 用。INSERT ... SET は複数行をまとめられないので VALUES で書く
+INSERT_ROOM_MEMBERS = add(
+    "insert_room_members",
+    "INSERT INTO `room_member` (`room_id`, `user_id`, `select_difficulty`, `is_host`, `judge_miss`, `judge_bad`, `judge_good`, `judge_great`, `judge_perfect`, `score`) VALUES (:room_id, :user_id, :select_difficulty, :is_host, :judge_miss, :judge_bad, :judge_good, :judge_great, :judge_perfect, :score)",
+)
+# quickjoin で試すルームをロックする。他の人がロックしていれば待たずに何も返さない
+LOCK_ROOM = add(
+    "lock_room",
+    "SELECT `room_id` FROM `room` WHERE `room_id`=:room_id FOR UPDATE SKIP LOCKED",
+)
+SELECT_ROOM_AFFINITY = add(
+    "select_room_affinity",
+    "SELECT `room_id`, SUM(`select_difficulty`=:select_difficulty) AS `affinity`, SUM(`user_id`=:user_id) AS `mine` FROM `room_member` WHERE `room_id` IN :room_ids GROUP BY `room_id`",
+    bindparam("room_ids", expanding=True),
+)
+SELECT_ROOM_USERS = add(
+    "select_room_users",
+    "SELECT `room_member`.user_id, `user`.name, `user`.leader_card_id, `room_member`.select_difficulty, `room_member`.is_host FROM `room_member` INNER JOIN `room` ON `room`.room_id = `room_member`.room_id INNER JOIN `user` ON `room_member`.user_id = `user`.id WHERE `room`.room_id=:room_id",
+)
+SELECT_IS_HOST = add(
+    "select_is_host",
+    "SELECT `is_host` FROM `room_member` WHERE `room_id`=:room_id AND `user_id`=:user_id",
+)
+SELECT_MEMBER_RESULTS = add(
+    "select_member_results",
+    "SELECT `user_id`, `judge_perfect`, `judge_great`, `judge_good`, `judge_bad`, `judge_miss`, `score` FROM `room_member` WHERE `room_id`=:room_id ORDER BY `room_member_id` FOR SHARE",
+)
+UPDATE_MEMBER_RESULT = add(
+    "update_member_result",
+    "UPDATE `room_member` SET `judge_perfect`=:judge_perfect, `judge_great`=:judge_great, `judge_good`=:judge_good, `judge_bad`=:judge_bad, `judge_miss`=:judge_miss, `score`=:score WHERE `user_id`=:user_id AND `room_id`=:room_id",
+)
+
+
+def _update_member_results(n: int) -> str:
+    rows = " UNION ALL ".join(
+        (
+            "SELECT :room_id_{0} AS `room_id`, :user_id_{0} AS `user_id`,"
+            " :judge_perfect_{0} AS `judge_perfect`, :judge_great_{0} AS `judge_great`,"
+            " :judge_good_{0} AS `judge_good`, :judge_bad_{0} AS `judge_bad`,"
+            " :judge_miss_{0} AS `judge_miss`, :score_{0} AS `score`"
+        ).format(i)
+        for i in range(n)
+    )
+    return (
+        "UPDATE `room_member` INNER JOIN ("
+        + rows
+        + ") AS `ended` ON `ended`.room_id = `room_member`.room_id AND `ended`.user_id = `room_member`.user_id"
+        " SET `room_member`.judge_perfect=`ended`.judge_perfect, `room_member`.judge_great=`ended`.judge_great,"
+        " `room_member`.judge_good=`ended`.judge_good, `room_member`.judge_bad=`ended`.judge_bad,"
+        " `room_member`.judge_miss=`ended`.judge_miss, `room_member`.score=`ended`.score"
+    )
+
+
+# UPDATE_MEMBER_RESULT の n 行版。パラメータは :room_id_0, :user_id_0, ... :score_{n-1}
+UPDATE_MEMBER_RESULTS = registry.add_family(
+    "update_member_results", _update_member_results
+)
+# 複数のルームの参加者と、まだ end していないか。ロックして他の人のコミット済みの end を見る
+SELECT_ENDED_MEMBERS = add(
+    "select_ended_members",
+    "SELECT `room_member`.room_id, `room_member`.user_id, `room`.live_id,"
+    " `room_member`.judge_perfect+`room_member`.judge_great+`room_member`.judge_good"
+    "+`room_member`.judge_bad+`room_member`.judge_miss=0 AS `unfinished`"
+    " FROM `room_member` INNER JOIN `room` ON `room`.room_id = `room_member`.room_id"
+    " WHERE `room_member`.room_id IN :room_ids FOR SHARE",
+    bindparam("room_ids", expanding=True),
+)
+COUNT_UNFINISHED_MEMBERS = add(
+    "count_unfinished_members",
+    "SELECT COUNT(*) FROM `room_member` WHERE `room_id`=:room_id AND `judge_perfect`+`judge_great`+`judge_good`+`judge_bad`+`judge_miss`=0 FOR SHARE",
+)
+DELETE_ROOM_MEMBER = add(
+    "delete_room_member",
+    "DELETE FROM `room_member` WHERE `user_id`=:user_id AND `room_id`=:room_id",
+)
+TRANSFER_HOST = add(
+    "transfer_host",
+    "UPDATE `room_member` SET `is_host`=TRUE WHERE `room_id`=:room_id ORDER BY `room_member_id` LIMIT 1",
+)
+SELECT_BEST_SCORES = add(
+    "select_best_scores",
+    "SELECT `live_id`, `user_id`, MAX(`score`) AS `score` FROM ("
+    "SELECT `room`.live_id, `room_member`.user_id, `room_member`.score FROM `room_member`"
+    " INNER JOIN `room` ON `room`.room_id = `room_member`.room_id WHERE `room_member`.score > 0"
+    " UNION ALL"
+    " SELECT `room_archive`.live_id, `room_member_archive`.user_id, `room_member_archive`.score FROM `room_member_archive`"
+    " INNER JOIN `room_archive` ON `room_archive`.room_id = `room_member_archive`.room_id WHERE `room_member_archive`.score > 0"
+    ") AS `scores` GROUP BY `live_id`, `user_id`",
+)
+
+# room_result
+
+INSERT_ROOM_RESULT = add(
+    "insert_room_result",
+    "INSERT IGNORE INTO `room_result` (`room_id`, `result`) VALUES (:room_id, :result)",
+)
+SELECT_ROOM_RESULT = add(
+    "select_room_result",
+    "SELECT `result` FROM `room_result` WHERE `room_id`=:room_id",
+)
+# 他のトランザクションが先に確定させていたときに、スナップショットではなく最新の行を読む
+SELECT_ROOM_RESULT_FOR_SHARE = add(
+    "select_room_result_for_share",
+    "SELECT `result` FROM `room_result` WHERE `room_id`=:room_id FOR SHARE",
+)
+
+# アーカイブ (app.sweeper)
+
+SELECT_SWEEPABLE_ROOMS = add(
+    "select_sweepable_rooms",
+    "SELECT `room_id` FROM `room` WHERE `updated_at` < NOW() - INTERVAL :min_age SECOND"
+    " AND (`is_start`=:dissolution OR (`is_start`=:live_start"
+    " AND EXISTS (SELECT 1 FROM `room_result` WHERE `room_result`.`room_id`=`room`.`room_id`)))"
+    " ORDER BY `room_id` LIMIT :batch_size FOR UPDATE SKIP LOCKED",
+)
+ARCHIVE_ROOMS = add(
+    "archive_rooms",
+    "INSERT INTO `room_archive` (`room_id`, `live_id`, `joined_user_count`, `max_user_count`, `is_start`, `time`, `updated_at`) SELECT `room_id`, `live_id`, `joined_user_count`, `max_user_count`, `is_start`, `time`, `updated_at` FROM `room` WHERE `room_id` IN :room_ids",
+    bindparam("room_ids", expanding=True),
+)
+ARCHIVE_ROOM_MEMBERS = add(
+    "archive_room_members",
+    "INSERT INTO `room_member_archive` (`room_member_id`, `room_id`, `user_id`, `select_difficulty`, `is_host`,"
+    " `judge_miss`, `judge_bad`, `judge_good`, `judge_great`, `judge_perfect`, `score`)"
+    " SELECT `room_member_id`, `room_id`, `user_id`, `select_difficulty`, `is_host`,"
+    " `judge_miss`, `judge_bad`, `judge_good`, `judge_great`, `judge_perfect`, `score`"
+    " FROM `room_member` WHERE `room_id` IN :room_ids",
+    bindparam("room_ids", expanding=True),
+)
+ARCHIVE_ROOM_RESULTS = add(
+    "archive_room_results",
+    "INSERT INTO `room_result_archive` (`room_id`, `result`, `finalized_at`)"
+    " SELECT `room_id`, `result`, `finalized_at` FROM `room_result` WHERE `room_id` IN :room_ids",
+    bindparam("room_ids", expanding=True),
+)
+DELETE_ROOM_RESULTS = add(
+    "delete_room_results",
+    "DELETE FROM `room_result` WHERE `room_id` IN :room_ids",
+    bindparam("room_ids", expanding=True),
+)
+DELETE_ROOM_MEMBERS = add(
+    "delete_room_members",
+    "DELETE FROM `room_member` WHERE `room_id` IN :room_ids",
+    bindparam("room_ids", expanding=True),
+)
+DELETE_ROOMS = add(
+    "delete_rooms",
+    "DELETE FROM `room` WHERE `room_id` IN :room_ids",
+    bindparam("room_ids", expanding=True),
+)
+
+# リードレプリカの遅れの計測 (app.replica)
+
+WRITE_HEARTBEAT = add(
+    "write_heartbeat",
+    "REPLACE INTO `replica_heartbeat` (`id`, `beat`) VALUES (1, :beat)",
+)
+SELECT_HEARTBEAT = add(
+    "select_heartbeat",
+    "SELECT `beat` FROM `replica_heartbeat` WHERE `id`=1",
+)
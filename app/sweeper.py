@@ -0,0 +1,171 @@
+"""終わったルームを archive テーブルに移して、room, room_member を小さく保つ
+
+解散したルームと、リザルトが確定したライブ開始済みのルームのうち、最後の変更から
+SWEEPER_MIN_AGE 秒たったものを、SWEEPER_BATCH_SIZE 件ずつ
+room_archive, room_member_archive, room_result_archive にコピーしてから消す。
+リザルトが確定していないルームは /room/result のポーリングが続くかもしれないので残す。
+バッチの後は処理にかかった時間に応じて休み、通常のリクエストとコネクションやロックを取り合わないようにする。
+
+    python -m app.sweeper --once
+"""
+
+import argparse
+import threading
+from time import perf_counter, sleep
+from typing import Callable, Optional
+
+from . import config, log, metrics, statements
+from .db import engine
+from .model import WaitRoomStatus
+
+logger = log.get_logger(__name__)
+
+rows_moved = metrics.registry.register(
+    metrics.Counter(
+        "gameserver_sweeper_rows_total",
+        "スイーパーが archive テーブルに移した行数",
+        ("table",),
+    )
+)
+batch_duration = metrics.registry.register(
+    metrics.Histogram(
+        "gameserver_sweeper_batch_seconds",
+        "スイーパーの1バッチ(1トランザクション)にかかった時間",
+    )
+)
+
+
+class Sweeper:
+    def __init__(
+        self,
+        engine,
+        min_age: float = config.SWEEPER_MIN_AGE,
+        batch_size: int = config.SWEEPER_BATCH_SIZE,
+        max_duty: float = config.SWEEPER_MAX_DUTY,
+    ):
+        self._engine = engine
+        self.min_age = min_age
+        self.batch_size = batch_size
+        self.max_duty = max_duty
+        self._closed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def sweep_batch(self) -> int:
+        """1バッチ分を移して、移したルーム数を返す"""
+        start = perf_counter()
+        with self._engine.begin() as conn:
+            room_ids = (
+                conn.execute(
+                    statements.SELECT_SWEEPABLE_ROOMS,
+                    dict(
+                        live_start=WaitRoomStatus.LiveStart.value,
+                        dissolution=WaitRoomStatus.Dissolution.value,
+                        min_age=int(self.min_age),
+                        batch_size=self.batch_size,
+                    ),
+                )
+                .scalars()
+                .all()
+            )
+            if not room_ids:
+                return 0
+            params = dict(room_ids=room_ids)
+            conn.execute(
+                statements.ARCHIVE_ROOMS,
+                params,
+            )
+            members = conn.execute(
+                statements.ARCHIVE_ROOM_MEMBERS,
+                params,
+            ).rowcount
+            results = conn.execute(
+                statements.ARCHIVE_ROOM_RESULTS,
+                params,
+            ).rowcount
+            conn.execute(
+                statements.DELETE_ROOM_RESULTS,
+                params,
+            )
+            conn.execute(
+                statements.DELETE_ROOM_MEMBERS,
+                params,
+            )
+            conn.execute(
+                statements.DELETE_ROOMS,
+                params,
+            )
+        batch_duration.observe(perf_counter() - start)
+        rows_moved.inc("room", amount=len(room_ids))
+        rows_moved.inc("room_member", amount=members)
+        rows_moved.inc("room_result", amount=results)
+        logger.info(
+            "Archived {} rooms, {} members, {} results".format(
+                len(room_ids), members, results
+            )
+        )
+        return len(room_ids)
+
+    def sweep(self, wait: Callable[[float], object] = sleep) -> int:
+        """移すものが無くなるまでバッチを繰り返し、移したルーム数を返す
+
+        バッチにかかった時間の (1 / max_duty - 1) 倍だけ wait してから次のバッチに進む。
+        """
+        total = 0
+        while not self._closed.is_set():
+            start = perf_counter()
+            moved = self.sweep_batch()
+            total += moved
+            if moved < self.batch_size:
+                break
+            wait((perf_counter() - start) * (1 / self.max_duty - 1))
+        return total
+
+    def run(self, interval: float = config.SWEEPER_INTERVAL) -> None:
+        """close されるまで interval 秒ごとに sweep する"""
+        while True:
+            try:
+                self.sweep(wait=self._closed.wait)
+            except Exception:
+                logger.exception("Failed to sweep rooms. Retry later.")
+            if self._closed.wait(interval):
+                return
+
+    def start(self, interval: float = config.SWEEPER_INTERVAL) -> None:
+        """run をバックグラウンドのスレッドで動かす"""
+        self._thread = threading.Thread(
+            target=self.run, args=(interval,), name="room-sweeper", daemon=True
+        )
+        self._thread.start()
+
+    def close(self) -> None:
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--once", action="store_true", help="1回 sweep して終わる")
+    parser.add_argument("--min-age", type=float, default=config.SWEEPER_MIN_AGE)
+    parser.add_argument("--batch-size", type=int, default=config.SWEEPER_BATCH_SIZE)
+    parser.add_argument("--max-duty", type=float, default=config.SWEEPER_MAX_DUTY)
+    parser.add_argument("--interval", type=float, default=config.SWEEPER_INTERVAL)
+    args = parser.parse_args()
+
+    sweeper = Sweeper(
+        engine,
+        min_age=args.min_age,
+        batch_size=args.batch_size,
+        max_duty=args.max_duty,
+    )
+    if args.once:
+        print("archived rooms: {}".format(sweeper.sweep()))
+        return
+    try:
+        sweeper.run(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""署名つきのユーザートークン
+
+UUID のトークンはハッシュして user テーブルを引かないと誰のものか分からない。
+TOKEN_SIGNING_KEYS を設定すると、/user/create はユーザー id と鍵の版を HMAC-SHA256 で
+署名したトークンを発行し、検証は DB を読まずに済む。
+
+    s1.<鍵の版>.<user_id>.<署名>
+
+鍵は「版:鍵」をカンマで区切って並べ、先頭の鍵で署名し、残りは検証だけに使う。
+鍵を替えるときは、新しい鍵を末尾に足して全てのワーカーに配ってから先頭に移す。
+古い鍵を外すと、その鍵で署名したトークンは使えなくなる
+(gameserver_token_verifications_total{key} が 0 のままになってから外す)。
+
+UUID のトークンは設定に関係なくそのまま使える。
+"""
+
+import base64
+import hashlib
+import hmac
+from typing import Optional
+
+from . import config, metrics
+
+PREFIX = "s1."
+# user.id (bigint) の最大の桁数
+MAX_USER_ID_DIGITS = 20
+
+
+def parse_keys(spec: str) -> list[tuple[str, bytes]]:
+    """ "版:鍵,版:鍵" を [(版, 鍵)] にする"""
+    keys = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        version, sep, secret = item.partition(":")
+        if not sep or not version or not secret or "." in version:
+            raise ValueError("Invalid token signing key: {!r}".format(version))
+        keys.append((version, secret.encode()))
+    return keys
+
+
+def is_signed(token: str) -> bool:
+    return token.startswith(PREFIX)
+
+
+class TokenSigner:
+    def __init__(self, keys: list[tuple[str, bytes]]):
+        self._keys = dict(keys)
+        # 署名に使う鍵の版。鍵がなければ署名つきトークンを発行しない
+        self.current: Optional[str] = keys[0][0] if keys else None
+
+    def _mac(self, version: str, user_id: int) -> str:
+        digest = hmac.new(
+            self._keys[version],
+            "{}.{}".format(version, user_id).encode(),
+            hashlib.sha256,
+        ).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+    def sign(self, user_id: int) -> str:
+        assert self.current is not None
+        return "{}{}.{}.{}".format(
+            PREFIX, self.current, user_id, self._mac(self.current, user_id)
+        )
+
+    def verify(self, token: str) -> Optional[int]:
+        """署名が正しければ user_id を返す。形式が違う・知らない鍵・署名が違うなら None"""
+        version, _, rest = token[len(PREFIX) :].partition(".")
+        user_id, _, mac = rest.partition(".")
+        # isdigit だけだと "²" などの ASCII 以外の数字も通り、int() で ValueError になる
+        if (
+            version not in self._keys
+            or not (user_id.isascii() and user_id.isdigit())
+            or len(user_id) > MAX_USER_ID_DIGITS
+        ):
+            verifications.inc("unknown", "invalid")
+            return None
+        # str どうしの compare_digest は ASCII 以外の文字で TypeError になるので bytes で比べる
+        if not hmac.compare_digest(
+            mac.encode(), self._mac(version, int(user_id)).encode()
+        ):
+            verifications.inc(version, "invalid")
+            return None
+        verifications.inc(version, "ok")
+        return int(user_id)
+
+
+verifications = metrics.registry.register(
+    metrics.Counter(
+        "gameserver_token_verifications_total",
+        "署名つきトークンの検証の数。key は鍵の版 (知らない鍵なら unknown)",
+        ("key", "result"),
+    )
+)
+
+signer = TokenSigner(parse_keys(config.TOKEN_SIGNING_KEYS))
@@ -0,0 +1,79 @@
+"""同期経路(スレッドプール)と async 経路の比較
+
+/room/wait 相当の処理 (token からユーザー取得 + wait_room) を同時に投げ、
+requests/sec と p99 レイテンシを比べる。ローカルの MySQL に対して実行する。
+
+    python -m benchmarks.bench_async --requests 5000 --concurrency 200
+"""
+import argparse
+import asyncio
+from time import perf_counter
+
+import anyio
+import anyio.to_thread
+
+from app import async_model, model
+
+from .common import print_table, summarize
+
+
+def _setup():
+    token = model.create_user("bench_async", 1000)
+    room_id = model.create_room(token, 1001, model.LiveDifficulty.normal)
+    return token, room_id
+
+
+async def _run(call, requests: int, concurrency: int) -> tuple[list[float], float]:
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            start = perf_counter()
+            await call()
+            latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return latencies, perf_counter() - start
+
+
+async def bench_sync_path(token: str, room_id: int, requests: int, concurrency: int):
+    # FastAPI が def エンドポイントを実行するのと同じく、既定のスレッドプールで回す
+    def handler():
+        user = model.get_user_by_token(token)
+        model.wait_room(room_id, user)
+
+    async def call():
+        await anyio.to_thread.run_sync(handler)
+
+    return await _run(call, requests, concurrency)
+
+
+async def bench_async_path(token: str, room_id: int, requests: int, concurrency: int):
+    async def call():
+        async with async_model.connection() as db:
+            user = await async_model.get_user_by_token(db, token)
+            await async_model.wait_room(db, room_id, user)
+
+    return await _run(call, requests, concurrency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    args = parser.parse_args()
+
+    token, room_id = _setup()
+    rows = []
+    for name, bench in (("sync", bench_sync_path), ("async", bench_async_path)):
+        latencies, elapsed = anyio.run(
+            bench, token, room_id, args.requests, args.concurrency
+        )
+        rows.append(summarize(name, latencies, elapsed))
+    print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""/room/end のグループコミットの比較
+
+N 人が同時に曲を終えて end_room を呼ぶ。ルームは room_size 人ずつで、全員がライブ開始済み。
+
+* per_request: 従来どおり1リクエスト1トランザクション
+* group_commit: app.group_commit.EndRoomBuffer で window 秒ずつまとめる
+
+全員が応答を受け取るまでの時間、1秒あたりの end 数、レイテンシ、コミットの数を出す。
+DB は config.DATABASE_URI のものを使い、--schema を渡すとテーブルを作り直す。
+
+    python -m benchmarks.bench_group_commit --schema schema.sql --finishers 1000
+"""
+
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from sqlalchemy import event
+
+from app import config, model, statements
+from app.db import engine
+from app.group_commit import EndRoomBuffer
+
+from .common import print_table, summarize
+from .load_room import load_schema
+
+
+def prepare(finishers: int, room_size: int, name: str) -> list[tuple]:
+    """ライブ開始済みのルームを作り、(room_id, user) を返す"""
+    tokens = model.create_users([(f"{name}_{i}", 1000) for i in range(finishers)])
+    users = [model.get_user_by_token(token) for token in tokens]
+    players = []
+    with model.transaction() as conn:
+        for start in range(0, finishers, room_size):
+            members = users[start : start + room_size]
+            room_id = conn.execute(
+                statements.INSERT_ROOM,
+                dict(
+                    live_id=1,
+                    joined_user_count=len(members),
+                    max_user_count=room_size,
+                    is_start=model.WaitRoomStatus.LiveStart.value,
+                    time=0,
+                ),
+            ).lastrowid
+            conn.execute(
+                statements.INSERT_ROOM_MEMBERS,
+                [
+                    dict(
+                        room_id=room_id,
+                        user_id=user.id,
+                        select_difficulty=model.LiveDifficulty.normal.value,
+                        is_host=i == 0,
+                        judge_miss=0,
+                        judge_bad=0,
+                        judge_good=0,
+                        judge_great=0,
+                        judge_perfect=0,
+                        score=0,
+                    )
+                    for i, user in enumerate(members)
+                ],
+            )
+            players.extend((room_id, user) for user in members)
+    return players
+
+
+def run(name: str, players: list[tuple]) -> dict:
+    """全員が同時に end_room を呼ぶ"""
+    commits = 0
+
+    def on_commit(conn):
+        nonlocal commits
+        commits += 1
+
+    ready = threading.Barrier(len(players))
+    latencies = []
+
+    def finish(i: int) -> None:
+        room_id, user = players[i]
+        ready.wait()
+        start = perf_counter()
+        model.end_room(room_id, 1000 + i, user, [i % 10, 1, 1, 0, 0])
+        latencies.append(perf_counter() - start)
+
+    event.listen(engine, "commit", on_commit)
+    try:
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=len(players)) as executor:
+            for future in [executor.submit(finish, i) for i in range(len(players))]:
+                future.result()
+        elapsed = perf_counter() - start
+    finally:
+        event.remove(engine, "commit", on_commit)
+    return dict(
+        summarize(name, latencies, elapsed),
+        elapsed_s=elapsed,
+        commits=commits,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--schema", help="流し込んでテーブルを作り直すスキーマファイル")
+    parser.add_argument("--finishers", type=int, default=1000)
+    parser.add_argument("--room-size", type=int, default=4)
+    parser.add_argument(
+        "--window", type=float, default=config.END_ROOM_GROUP_COMMIT_WINDOW
+    )
+    args = parser.parse_args()
+    if args.schema:
+        load_schema(args.schema)
+
+    rows = []
+    model.end_buffer = None
+    players = prepare(args.finishers, args.room_size, "per_request")
+    rows.append(run("per_request", players))
+
+    model.end_buffer = EndRoomBuffer(window=args.window)
+    try:
+        players = prepare(args.finishers, args.room_size, "group_commit")
+        rows.append(run("group_commit", players))
+    finally:
+        model.end_buffer.close()
+        model.end_buffer = None
+    print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
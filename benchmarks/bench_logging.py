@@ -0,0 +1,106 @@
+"""ログ出力がリクエストに足すレイテンシの比較
+
+1リクエスト分のログ ("Called /..." "Enter ..." と SQL のエコー数行) を複数スレッドから出し、
+ハンドラを直接つけた同期の書き込みと、app.log のキュー経由の書き込みで
+1リクエストあたりのレイテンシを比べる。DB は不要。
+
+    python -m benchmarks.bench_logging --threads 40 --requests 2000
+"""
+
+import argparse
+import logging
+import tempfile
+import threading
+from logging import FileHandler, Formatter, StreamHandler
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+from queue import Queue
+from time import perf_counter
+
+from app.log import FILE_FORMAT, STREAM_FORMAT
+
+from .common import print_table, summarize
+
+SQL = "SELECT `room_member`.user_id, `user`.name, `user`.leader_card_id, `room_member`.select_difficulty, `room_member`.is_host FROM `room_member` INNER JOIN `room` ON `room`.room_id = `room_member`.room_id INNER JOIN `user` ON `room_member`.user_id = `user`.id WHERE `room`.room_id=%s"
+
+
+def _handlers(directory: Path, stream) -> list[logging.Handler]:
+    fh = FileHandler(directory / "debug.log")
+    fh.setLevel(logging.DEBUG)
+    fh.setFormatter(Formatter(FILE_FORMAT))
+    fh2 = FileHandler(directory / "warn.log")
+    fh2.setLevel(logging.WARN)
+    fh2.setFormatter(Formatter(FILE_FORMAT))
+    sh = StreamHandler(stream)
+    sh.setLevel(logging.DEBUG)
+    sh.setFormatter(Formatter(STREAM_FORMAT))
+    return [fh, fh2, sh]
+
+
+def _request(logger: logging.Logger, i: int) -> None:
+    logger.info("Called /room/wait")
+    logger.info("Enter wait_room")
+    for _ in range(2):
+        logger.debug("BEGIN (implicit)")
+        logger.debug(SQL)
+        logger.debug("[generated in 0.00012s] (%d,)", i)
+    logger.debug("COMMIT")
+
+
+def bench(name: str, logger: logging.Logger, threads: int, requests: int) -> dict:
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        local = []
+        for i in range(requests):
+            start = perf_counter()
+            _request(logger, i)
+            local.append(perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return summarize(name, latencies, perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, default=40)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        with open(directory / "stream.log", "w") as stream:
+            # 今までの構成: ハンドラをロガーに直接つける
+            sync_logger = logging.getLogger("bench.sync")
+            sync_logger.propagate = False
+            sync_logger.setLevel(logging.DEBUG)
+            for handler in _handlers(directory, stream):
+                sync_logger.addHandler(handler)
+            rows.append(bench("sync", sync_logger, args.threads, args.requests))
+
+            # キュー経由: 呼び出し側は積むだけ
+            queue_logger = logging.getLogger("bench.queue")
+            queue_logger.propagate = False
+            queue_logger.setLevel(logging.DEBUG)
+            q = Queue()
+            queue_logger.addHandler(QueueHandler(q))
+            listener = QueueListener(
+                q, *_handlers(directory, stream), respect_handler_level=True
+            )
+            listener.start()
+            rows.append(bench("queue", queue_logger, args.threads, args.requests))
+            listener.stop()
+    print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""マッチングの比較: /room/list + /room/join と /room/quickjoin
+
+N 人のプレイヤーが同時に同じ数曲のどれかで遊ぼうとする。
+
+* listjoin: /room/list の先頭のルームに /room/join し、入れなければ list からやり直す。
+  入れるルームがないか max_attempts 回失敗したら /room/create
+* quickjoin: /room/quickjoin を1回
+
+1秒あたりのマッチ数と、1マッチあたりのリクエスト数・SQL数を出す。
+
+    python -m benchmarks.bench_quickjoin --players 400 --lives 4
+"""
+
+import argparse
+import asyncio
+import random
+from time import perf_counter
+
+import httpx
+
+from app.api import app
+from app.db import async_engine, engine
+
+from .common import Recorder, current_endpoint, print_table
+from .load_room import load_schema
+
+JOIN_OK = 1
+
+
+class Client:
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, flow: str):
+        self.client = client
+        self.recorder = recorder
+        self.flow = flow
+        self.headers = {}
+        self.requests = 0
+
+    async def post(self, path: str, body: dict) -> dict:
+        token = current_endpoint.set(self.flow)
+        start = perf_counter()
+        try:
+            response = await self.client.post(path, json=body, headers=self.headers)
+        finally:
+            current_endpoint.reset(token)
+        self.requests += 1
+        self.recorder.record(path, perf_counter() - start, response.is_success)
+        response.raise_for_status()
+        return response.json()
+
+    async def signup(self, i: int) -> None:
+        body = await self.post(
+            "/user/create", {"user_name": f"quick_{i}", "leader_card_id": 1000}
+        )
+        self.headers = {"Authorization": f"bearer {body['user_token']}"}
+        self.requests = 0
+
+    async def list_join(self, live_id: int, difficulty: int, attempts: int) -> None:
+        for _ in range(attempts):
+            rooms = (await self.post("/room/list", {"live_id": live_id}))[
+                "room_info_list"
+            ]
+            if not rooms:
+                break
+            body = await self.post(
+                "/room/join",
+                {"room_id": rooms[0]["room_id"], "select_difficulty": difficulty},
+            )
+            if body["join_room_result"] == JOIN_OK:
+                return
+        await self.post(
+            "/room/create", {"live_id": live_id, "select_difficulty": difficulty}
+        )
+
+    async def quick_join(self, live_id: int, difficulty: int) -> None:
+        await self.post(
+            "/room/quickjoin", {"live_id": live_id, "select_difficulty": difficulty}
+        )
+
+
+async def run(flow: str, args, live_base: int) -> dict:
+    recorder = Recorder()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=60
+    ) as http:
+        clients = [Client(http, recorder, flow) for _ in range(args.players)]
+        await asyncio.gather(*(c.signup(i) for i, c in enumerate(clients)))
+        recorder.count_queries(engine, async_engine.sync_engine)
+
+        async def match(client: Client) -> None:
+            live_id = live_base + random.randrange(args.lives)
+            difficulty = random.choice((1, 2))
+            # 同時に押し寄せる様子を作るため、少しだけずらして始める
+            await asyncio.sleep(random.random() * args.spread)
+            if flow == "quickjoin":
+                await client.quick_join(live_id, difficulty)
+            else:
+                await client.list_join(live_id, difficulty, args.max_attempts)
+
+        start = perf_counter()
+        results = await asyncio.gather(
+            *(match(c) for c in clients), return_exceptions=True
+        )
+        elapsed = perf_counter() - start
+    # プールのコネクションはイベントループに紐づくので、次の asyncio.run の前に捨てる
+    await async_engine.dispose()
+    matches = sum(not isinstance(r, Exception) for r in results)
+    requests = sum(c.requests for c in clients)
+    return dict(
+        name=flow,
+        matches=matches,
+        matches_per_sec=matches / elapsed,
+        requests_per_match=requests / matches if matches else 0.0,
+        queries_per_match=recorder.queries[flow] / matches if matches else 0.0,
+        errors=sum(recorder.errors.values()),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--schema", default="schema.sql")
+    parser.add_argument(
+        "--no-load", action="store_true", help="スキーマを流し込まずに実行する"
+    )
+    parser.add_argument("--players", type=int, default=400)
+    parser.add_argument("--lives", type=int, default=4)
+    parser.add_argument("--spread", type=float, default=0.5)
+    parser.add_argument("--max-attempts", type=int, default=5)
+    args = parser.parse_args()
+
+    if not args.no_load:
+        load_schema(args.schema)
+    rows = []
+    # フローごとに別の live_id を使い、前のフローのルームに入らないようにする
+    for i, flow in enumerate(("listjoin", "quickjoin")):
+        rows.append(asyncio.run(run(flow, args, live_base=10000 * (i + 1))))
+    print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
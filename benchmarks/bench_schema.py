@@ -0,0 +1,243 @@
+"""スキーマ・インデックスの比較
+
+スキーマごとに、ローカルの MySQL に合成データ(ユーザー・ルーム・メンバー)を流し込み、
+app/model.py の各関数が発行する SQL を1回ずつ記録してから、その SQL を EXPLAIN し、
+runs 回ずつ実行して時間を測る(書き込みは毎回ロールバックする)。
+スキーマは `schema.sql` のようなファイルか、`schema.sql+追加の.sql` で足したものを指定する。
+
+    python -m benchmarks.bench_schema --schema schema.sql --schema schema_noindex.sql \\
+        --schema schema.sql+benchmarks/indexes_composite.sql --users 1000000 --rooms 1000000
+"""
+
+import argparse
+import json
+from pathlib import Path
+from time import perf_counter
+
+from sqlalchemy import event, text
+
+from app import metrics, model
+from app.db import engine
+from app.model import LiveDifficulty
+
+from .common import current_endpoint, percentile, print_table
+from .load_room import load_schema
+
+# 合成データを1文で入れる行数
+CHUNK = 100_000
+
+
+def load_variant(spec: str) -> None:
+    """schema.sql+extra.sql なら schema.sql を流してから extra.sql を流す"""
+    for path in spec.split("+"):
+        load_schema(path)
+
+
+def _fill(conn, sql: str, count: int, **params) -> None:
+    """seq(n) を 1..count まで CHUNK 件ずつ作って sql で INSERT する"""
+    for start in range(1, count + 1, CHUNK):
+        end = min(start + CHUNK - 1, count)
+        conn.execute(
+            text(
+                "INSERT "
+                + sql.replace(
+                    "{seq}",
+                    "(WITH RECURSIVE seq (n) AS (SELECT :start UNION ALL SELECT n + 1 FROM seq WHERE n < :end) SELECT n FROM seq) AS seq",
+                )
+            ),
+            dict(params, start=start, end=end),
+        )
+
+
+def load_data(args) -> None:
+    """合成データを入れる。ルームは waiting_ratio が待機中、残りはライブ開始と解散が半分ずつ"""
+    with engine.begin() as conn:
+        conn.execute(
+            text("SET SESSION cte_max_recursion_depth = :depth"), dict(depth=CHUNK + 1)
+        )
+        _fill(
+            conn,
+            "INTO `user` (`name`, `hashed_token`, `leader_card_id`) SELECT CONCAT('bench_', n), SHA2(CONCAT('bench_token_', n), 256), 1000 FROM {seq}",
+            args.users,
+        )
+        _fill(
+            conn,
+            "INTO `room` (`live_id`, `joined_user_count`, `max_user_count`, `is_start`, `time`) SELECT 1 + n % :lives, 1 + n % 4, 4, CASE WHEN n % 1000 < :waiting THEN 1 WHEN n % 2 = 0 THEN 2 ELSE 3 END, 0 FROM {seq}",
+            args.rooms,
+            lives=args.lives,
+            waiting=int(args.waiting_ratio * 1000),
+        )
+        # 1ルームあたり joined_user_count 人。先頭がホスト
+        conn.execute(
+            text(
+                "INSERT INTO `room_member` (`room_id`, `user_id`, `select_difficulty`, `is_host`, `judge_miss`, `judge_bad`, `judge_good`, `judge_great`, `judge_perfect`, `score`) SELECT `room`.room_id, 1 + (`room`.room_id * 7919 + k.k * 104729) % :users, 1 + k.k % 2, k.k = 1, 0, 0, 0, 0, IF(`room`.is_start = 2, 1 + k.k, 0), IF(`room`.is_start = 2, (`room`.room_id * k.k * 31) % 1000000, 0) FROM `room` INNER JOIN (SELECT 1 AS k UNION ALL SELECT 2 UNION ALL SELECT 3 UNION ALL SELECT 4) AS k ON k.k <= `room`.joined_user_count"
+            ),
+            dict(users=args.users),
+        )
+        for table in ("user", "room", "room_member"):
+            conn.execute(text(f"ANALYZE TABLE `{table}`"))
+
+
+def capture() -> dict:
+    """model の各関数を1回ずつ呼び、発行された SQL を (関数名, SQL) ごとに1つずつ記録する"""
+    captured: dict = {}
+
+    def before_cursor_execute(conn, cursor, statement, params, context, many):
+        key = (current_endpoint.get(), statement)
+        if key not in captured and not statement.startswith("SET "):
+            captured[key] = params[0] if many else params
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+
+    def step(name, fn, *args):
+        token = current_endpoint.set(name)
+        try:
+            return fn(*args)
+        finally:
+            current_endpoint.reset(token)
+
+    try:
+        tokens = [
+            step("create_user", model.create_user, f"capture_{i}", 1000)
+            for i in range(4)
+        ]
+        model.user_cache.clear()
+        users = [step("get_user_by_token", model.get_user_by_token, t) for t in tokens]
+        step("create_users", model.create_users, [("capture_bulk", 1000)] * 3)
+        room_id = step(
+            "create_room", model.create_room, tokens[0], 1, LiveDifficulty.normal
+        )
+        with model.transaction() as conn:
+            step("list_room", model._list_room, conn, 1)
+        step("join_room", model.join_room, room_id, LiveDifficulty.hard, users[1])
+        step(
+            "quick_join_room",
+            model.quick_join_room,
+            tokens[2],
+            1,
+            LiveDifficulty.hard,
+            users[2],
+        )
+        step("wait_room", model.wait_room, room_id, users[0])
+        step("leave_room", model.leave_room, room_id, users[2])
+        step("start_room", model.start_room, room_id, users[0])
+        step("end_room", model.end_room, room_id, 1000, users[0], [1, 1, 1, 1, 1])
+        step("end_room", model.end_room, room_id, 2000, users[1], [2, 2, 2, 2, 2])
+        model.result_snapshots.clear()
+        step("result_room", model.result_room, room_id)
+        step("update_user", model.update_user, tokens[3], "capture_renamed", 1001)
+        with model.transaction() as conn:
+            step("load_leaderboard", model._load_leaderboard, conn)
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return captured
+
+
+def _plan(cursor, statement: str, params) -> tuple[str, int]:
+    """EXPLAIN を "テーブル:アクセス方法(インデックス)" の列と、見積もり行数の合計にまとめる"""
+    cursor.execute("EXPLAIN " + statement, params)
+    columns = [c[0] for c in cursor.description]
+    steps, rows = [], 0
+    for row in cursor.fetchall():
+        row = dict(zip(columns, row))
+        if row.get("table") is None:
+            continue
+        steps.append("{}:{}({})".format(row["table"], row["type"], row["key"] or "-"))
+        rows += int(row["rows"] or 0)
+    return " ".join(steps), rows
+
+
+def replay(captured: dict, runs: int) -> list[dict]:
+    results = []
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        for (name, statement), params in captured.items():
+            result = dict(query=f"{name}: {metrics.query_label(statement)}")
+            try:
+                result["plan"], result["rows"] = _plan(cursor, statement, params)
+                timings = []
+                for _ in range(runs):
+                    start = perf_counter()
+                    cursor.execute(statement, params)
+                    cursor.fetchall()
+                    timings.append(perf_counter() - start)
+                    raw.rollback()
+                result["p50_ms"] = percentile(timings, 50) * 1000
+                result["p95_ms"] = percentile(timings, 95) * 1000
+            except Exception as e:
+                # 記録時の INSERT をもう一度流すと UNIQUE KEY に当たるものなど
+                raw.rollback()
+                result["error"] = str(e.args[0] if e.args else e)
+            results.append(result)
+    finally:
+        raw.close()
+    return results
+
+
+def report(variants: dict[str, list[dict]]) -> str:
+    """クエリごとにスキーマを並べた Markdown の表"""
+    names = list(variants)
+    lines = ["| query | " + " | ".join(names) + " |", "|---" * (len(names) + 1) + "|"]
+    queries = list(dict.fromkeys(r["query"] for rs in variants.values() for r in rs))
+    by_variant = {n: {r["query"]: r for r in rs} for n, rs in variants.items()}
+    for query in queries:
+        cells = []
+        for name in names:
+            r = by_variant[name].get(query)
+            if r is None:
+                cells.append("-")
+            elif "error" in r:
+                cells.append("error: " + r["error"])
+            else:
+                cells.append(
+                    "{:.3f} ms / {} rows<br>{}".format(
+                        r["p50_ms"], r["rows"], r["plan"]
+                    )
+                )
+        lines.append("| " + query + " | " + " | ".join(cells) + " |")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--schema",
+        action="append",
+        help="比べるスキーマ。複数指定できる (既定: schema.sql と schema_noindex.sql)",
+    )
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--rooms", type=int, default=100_000)
+    parser.add_argument("--lives", type=int, default=100)
+    parser.add_argument("--waiting-ratio", type=float, default=0.05)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--output", default="bench_output/schema_report.md")
+    args = parser.parse_args()
+
+    variants = {}
+    for spec in args.schema or ["schema.sql", "schema_noindex.sql"]:
+        load_variant(spec)
+        start = perf_counter()
+        load_data(args)
+        print(f"{spec}: loaded in {perf_counter() - start:.1f}s")
+        variants[spec] = replay(capture(), args.runs)
+        print_table(
+            [
+                dict(
+                    query=r["query"], p50_ms=r.get("p50_ms", 0.0), rows=r.get("rows", 0)
+                )
+                for r in variants[spec]
+            ]
+        )
+
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(report(variants))
+    output.with_suffix(".json").write_text(
+        json.dumps(dict(args=vars(args), variants=variants), indent=2)
+    )
+    print(f"report: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""/room/list, /room/wait, /room/result のレスポンスを作る CPU 時間の比較
+
+model の戻り値からレスポンスのバイト列を作るまでを、
+pydantic のレスポンスを作って FastAPI が response_model で検証・変換する従来の経路と、
+app.responses で dict を orjson にする経路で比べる。両者の JSON が同じことも確かめる。DB は不要。
+
+    python -m benchmarks.bench_serialize --rooms 50 --iterations 20000
+"""
+
+import argparse
+import asyncio
+import json
+from time import process_time
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+
+from app import api, responses
+from app.model import LiveDifficulty, ResultUser, RoomUser, WaitRoomStatus
+from app.room_index import RoomEntry
+
+from .common import print_table
+
+
+def _response_field(path: str):
+    for route in api.app.routes:
+        if getattr(route, "path", None) == path:
+            return route.response_field
+    raise KeyError(path)
+
+
+def cases(rooms: int, members: int) -> dict:
+    """エンドポイントごとに (従来のレスポンスを作る関数, 速い経路の関数)"""
+    room_list = [RoomEntry(i, 1000 + i % 3, 1 + i % 3, 4) for i in range(1, rooms + 1)]
+    room_users = [
+        RoomUser(
+            user_id=i,
+            name=f"user_{i}",
+            leader_card_id=1000 + i,
+            select_difficulty=LiveDifficulty.hard,
+            is_me=i == 1,
+            is_host=i == 1,
+        )
+        for i in range(1, members + 1)
+    ]
+    results = [
+        ResultUser(user_id=i, judge_count_list=[i, 2, 3, 4, 5], score=1000 * i)
+        for i in range(1, members + 1)
+    ]
+    return {
+        "/room/list": (
+            lambda: api.RoomListResponse(
+                room_info_list=[
+                    api.RoomInfo(
+                        room_id=r.room_id,
+                        live_id=r.live_id,
+                        joined_user_count=r.joined_user_count,
+                        max_user_count=r.max_user_count,
+                    )
+                    for r in room_list
+                ]
+            ),
+            lambda: responses.room_list(room_list),
+        ),
+        "/room/wait": (
+            lambda: api.RoomWaitResponse(
+                status=WaitRoomStatus.Waiting.value,
+                room_user_list=room_users,
+                poll_interval=0.5,
+            ),
+            lambda: responses.room_wait(WaitRoomStatus.Waiting.value, room_users, 0.5),
+        ),
+        "/room/result": (
+            lambda: api.RoomResultResponse(result_user_list=results, poll_interval=0.5),
+            lambda: responses.room_result(results, 0.5),
+        ),
+    }
+
+
+async def pydantic_body(field, build) -> bytes:
+    """エンドポイントが pydantic のレスポンスを返したときに FastAPI がすること"""
+    content = await serialize_response(
+        field=field, response_content=build(), is_coroutine=True
+    )
+    return JSONResponse(content).body
+
+
+async def bench(path: str, build, fast, iterations: int) -> dict:
+    field = _response_field(path)
+    expected = json.loads(await pydantic_body(field, build))
+    assert json.loads(fast().body) == expected, path
+
+    start = process_time()
+    for _ in range(iterations):
+        await pydantic_body(field, build)
+    before = (process_time() - start) / iterations
+
+    start = process_time()
+    for _ in range(iterations):
+        fast().body
+    after = (process_time() - start) / iterations
+
+    return dict(
+        endpoint=path,
+        bytes=len(fast().body),
+        pydantic_us=before * 1e6,
+        orjson_us=after * 1e6,
+        speedup=before / after,
+    )
+
+
+async def main_async(args) -> None:
+    rows = []
+    for path, (build, fast) in cases(args.rooms, args.members).items():
+        rows.append(await bench(path, build, fast, args.iterations))
+    print_table(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rooms", type=int, default=50, help="/room/list の件数")
+    parser.add_argument("--members", type=int, default=4)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""名前つきのステートメント (app.statements) と、呼び出しごとに text() を作る書き方の比較
+
+ポーリングで多く流れる SELECT を、それぞれの書き方で同じパラメータで繰り返し実行し、
+1回あたりの CPU 時間 (process_time) とレイテンシ (perf_counter) を出す。
+inline は以前の model と同じく、実行のたびに text(...) (と bindparams) を作る。
+
+DB は config.DATABASE_URI のものを使い、--schema を渡すとテーブルを作り直す。
+
+    python -m benchmarks.bench_statements --schema schema.sql --iterations 5000
+"""
+
+import argparse
+from time import perf_counter, process_time
+
+from sqlalchemy import text
+
+from app import model, statements
+from app.db import engine
+
+from .common import print_table
+from .load_room import load_schema
+
+
+def cases(room_id: int, user: model.SafeUser) -> list[tuple]:
+    """(ステートメント, パラメータ)"""
+    return [
+        (statements.SELECT_USER_BY_TOKEN, dict(hashed_token="0" * 64)),
+        (statements.SELECT_ROOM_VERSION, dict(room_id=room_id)),
+        (
+            statements.SELECT_JOINABLE_ROOMS,
+            dict(is_start=model.WaitRoomStatus.Waiting.value),
+        ),
+        (statements.SELECT_ROOM_USERS, dict(room_id=room_id)),
+        (
+            statements.SELECT_ROOM_AFFINITY,
+            dict(
+                room_ids=[room_id],
+                select_difficulty=model.LiveDifficulty.normal.value,
+                user_id=user.id,
+            ),
+        ),
+    ]
+
+
+def _rebuild(statement):
+    """statement と同じ SQL を、毎回新しく text() で作る"""
+    clause = text(statement.text)
+    expanding = [p for p in statement._bindparams.values() if p.expanding]
+    if expanding:
+        clause = clause.bindparams(*expanding)
+    return clause
+
+
+def measure(conn, build, params: dict, iterations: int) -> tuple[float, float]:
+    """1回あたりの (CPU 秒, 経過秒)"""
+    # 1回目はコンパイル済みキャッシュに入れるだけ
+    conn.execute(build(), params).all()
+    cpu = process_time()
+    start = perf_counter()
+    for _ in range(iterations):
+        conn.execute(build(), params).all()
+    return (
+        (process_time() - cpu) / iterations,
+        (perf_counter() - start) / iterations,
+    )
+
+
+def bench(iterations: int) -> list[dict]:
+    token = model.create_user("bench_statements", 1000)
+    user = model.get_user_by_token(token)
+    room_id = model.create_room(token, 1, model.LiveDifficulty.normal.value)
+    rows = []
+    with engine.connect() as conn:
+        for statement, params in cases(room_id, user):
+            inline_cpu, inline_wall = measure(
+                conn, lambda: _rebuild(statement), params, iterations
+            )
+            named_cpu, named_wall = measure(conn, lambda: statement, params, iterations)
+            rows.append(
+                dict(
+                    statement=statements.registry.name_of(statement),
+                    inline_cpu_us=inline_cpu * 1e6,
+                    named_cpu_us=named_cpu * 1e6,
+                    inline_ms=inline_wall * 1000,
+                    named_ms=named_wall * 1000,
+                    cpu_saved=1 - named_cpu / inline_cpu,
+                )
+            )
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--schema", help="流し込んでテーブルを作り直すスキーマファイル")
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args()
+    if args.schema:
+        load_schema(args.schema)
+    print_table(bench(args.iterations))
+
+
+if __name__ == "__main__":
+    main()
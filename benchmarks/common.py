@@ -0,0 +1,77 @@
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from typing import Sequence
+
+from sqlalchemy import event
+
+
+def percentile(samples: Sequence[float], p: float) -> float:
+    """p (0-100) パーセンタイルを返す"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    k = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[k]
+
+
+def summarize(name: str, latencies: Sequence[float], elapsed: float) -> dict:
+    """レイテンシ(秒)の列と経過時間からスループットとパーセンタイルをまとめる"""
+    return dict(
+        name=name,
+        requests=len(latencies),
+        rps=len(latencies) / elapsed if elapsed else 0.0,
+        p50_ms=percentile(latencies, 50) * 1000,
+        p95_ms=percentile(latencies, 95) * 1000,
+        p99_ms=percentile(latencies, 99) * 1000,
+    )
+
+
+def print_table(rows: list[dict]) -> None:
+    if not rows:
+        return
+    keys = list(rows[0].keys())
+    print(" | ".join(keys))
+    print(" | ".join("---" for _ in keys))
+    for row in rows:
+        print(
+            " | ".join(
+                f"{row[k]:.2f}" if isinstance(row[k], float) else str(row[k])
+                for k in keys
+            )
+        )
+
+
+class Recorder:
+    """エンドポイントごとのレイテンシ・エラー数・発行したクエリ数を集める"""
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.queries: Counter = Counter()
+
+    def record(self, endpoint: str, latency: float, ok: bool) -> None:
+        self.latencies[endpoint].append(latency)
+        if not ok:
+            self.errors[endpoint] += 1
+
+    def count_queries(self, *engines) -> None:
+        """各エンジンで発行された SQL を、その時の current_endpoint ごとに数える"""
+
+        def before_cursor_execute(conn, cursor, statement, params, context, many):
+            self.queries[current_endpoint.get()] += 1
+
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", before_cursor_execute)
+
+    def rows(self, elapsed: float) -> list[dict]:
+        rows = []
+        for endpoint in sorted(self.latencies):
+            row = summarize(endpoint, self.latencies[endpoint], elapsed)
+            row["errors"] = self.errors[endpoint]
+            row["queries_per_req"] = self.queries[endpoint] / row["requests"]
+            rows.append(row)
+        return rows
+
+
+# 今処理しているエンドポイント。Recorder.count_queries がクエリの集計に使う
+current_endpoint: ContextVar[str] = ContextVar("current_endpoint", default="-")
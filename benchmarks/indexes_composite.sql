@@ -0,0 +1,9 @@
+-- schema.sql に足して比べる複合・カバリングインデックスの案
+--
+--     python -m benchmarks.bench_schema --schema schema.sql --schema schema.sql+benchmarks/indexes_composite.sql
+
+-- list_room: is_start で絞り、live_id と人数はインデックスだけで読む
+ALTER TABLE `room` ADD INDEX `is_start_live_id_count` (`is_start`, `live_id`, `joined_user_count`, `max_user_count`);
+
+-- wait_room / start_room / end_room / leave_room: (room_id, user_id) で1行に絞る
+ALTER TABLE `room_member` ADD INDEX `room_id_user_id` (`room_id`, `user_id`);
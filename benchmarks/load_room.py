@@ -0,0 +1,194 @@
+"""ルームのライフサイクル全体の負荷試験
+
+N 人のプレイヤーが M 個のルームに分かれて、実際のクライアントに近い動きをする。
+
+* ホストは /room/create のあと 1Hz で /room/wait し、人が揃うか時間切れで /room/start
+* 参加者は /room/list → /room/join を繰り返し(満員なら list からやり直す)、1Hz で /room/wait
+* ライブ後は全員ほぼ同時に /room/end し、結果が出るまで 1Hz で /room/result
+
+エンドポイントごとのスループット、p50/p95/p99、1リクエストあたりの SQL 数を出す。
+ローカルの MySQL (devcontainer の db) に対して、指定したスキーマを流し込んでから実行する。
+
+    python -m benchmarks.load_room --schema schema.sql --players 200 --rooms 50
+"""
+
+import argparse
+import asyncio
+import json
+import random
+from pathlib import Path
+from time import perf_counter
+
+import httpx
+from sqlalchemy import text
+
+from app.api import app
+from app.db import async_engine, engine
+
+from .common import Recorder, current_endpoint, print_table
+
+WAITING, LIVE_START, DISSOLUTION = 1, 2, 3
+JOIN_OK = 1
+
+
+def load_schema(path: str) -> None:
+    """スキーマファイルを流し込んでテーブルを作り直す"""
+    sql = Path(path).read_text()
+    with engine.begin() as conn:
+        for statement in sql.split(";"):
+            if statement.strip():
+                conn.execute(text(statement))
+
+
+class Player:
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, args):
+        self.client = client
+        self.recorder = recorder
+        self.args = args
+        self.headers = {}
+
+    async def post(self, path: str, body: dict) -> dict:
+        token = current_endpoint.set(path)
+        start = perf_counter()
+        try:
+            response = await self.client.post(path, json=body, headers=self.headers)
+        finally:
+            current_endpoint.reset(token)
+        self.recorder.record(path, perf_counter() - start, response.is_success)
+        response.raise_for_status()
+        return response.json()
+
+    async def signup(self, i: int) -> None:
+        body = await self.post(
+            "/user/create", {"user_name": f"bench_{i}", "leader_card_id": 1000}
+        )
+        self.headers = {"Authorization": f"bearer {body['user_token']}"}
+
+    async def host(self, live_id: int) -> None:
+        body = await self.post(
+            "/room/create", {"live_id": live_id, "select_difficulty": 1}
+        )
+        room_id = body["room_id"]
+        deadline = perf_counter() + self.args.lobby_seconds
+        while True:
+            body = await self.post("/room/wait", {"room_id": room_id})
+            if len(body["room_user_list"]) >= 4 or perf_counter() > deadline:
+                break
+            await asyncio.sleep(self.args.poll_interval)
+        await self.post("/room/start", {"room_id": room_id})
+        await self.play(room_id)
+
+    async def join(self, live_id: int) -> None:
+        for _ in range(self.args.join_attempts):
+            body = await self.post("/room/list", {"live_id": live_id})
+            rooms = body["room_info_list"]
+            if not rooms:
+                await asyncio.sleep(self.args.poll_interval)
+                continue
+            room_id = random.choice(rooms)["room_id"]
+            body = await self.post(
+                "/room/join", {"room_id": room_id, "select_difficulty": 2}
+            )
+            if body["join_room_result"] != JOIN_OK:
+                # 満員・解散済み。一覧からやり直す
+                continue
+            while True:
+                await asyncio.sleep(self.args.poll_interval)
+                body = await self.post("/room/wait", {"room_id": room_id})
+                if body["status"] == LIVE_START:
+                    await self.play(room_id)
+                    return
+                if body["status"] == DISSOLUTION:
+                    break
+
+    async def play(self, room_id: int) -> None:
+        await asyncio.sleep(self.args.live_seconds)
+        await self.post(
+            "/room/end",
+            {
+                "room_id": room_id,
+                "score": random.randrange(1_000_000),
+                "judge_count_list": [random.randrange(1, 500) for _ in range(5)],
+            },
+        )
+        deadline = perf_counter() + self.args.result_timeout
+        while perf_counter() < deadline:
+            body = await self.post("/room/result", {"room_id": room_id})
+            if body["result_user_list"]:
+                return
+            await asyncio.sleep(self.args.poll_interval)
+
+
+async def run(args) -> tuple[Recorder, float]:
+    recorder = Recorder()
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=60)
+    else:
+        recorder.count_queries(engine, async_engine.sync_engine)
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=60
+        )
+    async with client:
+        players = [Player(client, recorder, args) for _ in range(args.players)]
+        await asyncio.gather(*(p.signup(i) for i, p in enumerate(players)))
+
+        start = perf_counter()
+        for _ in range(args.rounds):
+            tasks = []
+            for i, player in enumerate(players):
+                live_id = 1000 + i % args.lives
+                if i < args.rooms:
+                    tasks.append(player.host(live_id))
+                else:
+                    # 少し遅れて参加し、一部は live_id=0 で全ルームから探す
+                    live_id = 0 if random.random() < 0.2 else live_id
+                    tasks.append(_delayed(player.join(live_id), args.poll_interval))
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            recorder.errors["aborted_players"] += sum(
+                isinstance(r, Exception) for r in results
+            )
+        elapsed = perf_counter() - start
+    return recorder, elapsed
+
+
+async def _delayed(coro, delay: float):
+    await asyncio.sleep(random.random() * delay)
+    await coro
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--schema", default="schema.sql")
+    parser.add_argument(
+        "--no-load", action="store_true", help="スキーマを流し込まずに実行する"
+    )
+    parser.add_argument("--url", help="起動済みのサーバーに投げる (SQL数は数えない)")
+    parser.add_argument("--players", type=int, default=200)
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--lives", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--lobby-seconds", type=float, default=5.0)
+    parser.add_argument("--live-seconds", type=float, default=3.0)
+    parser.add_argument("--result-timeout", type=float, default=15.0)
+    parser.add_argument("--join-attempts", type=int, default=5)
+    parser.add_argument("--output", help="結果を JSON で書き出すパス")
+    args = parser.parse_args()
+
+    if not args.no_load:
+        load_schema(args.schema)
+    recorder, elapsed = asyncio.run(run(args))
+    rows = recorder.rows(elapsed)
+    print(f"schema={args.schema} players={args.players} rooms={args.rooms}")
+    print_table(rows)
+    if recorder.errors["aborted_players"]:
+        print(f"aborted players: {recorder.errors['aborted_players']}")
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.output).write_text(
+            json.dumps(dict(schema=args.schema, args=vars(args), rows=rows), indent=2)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,11 @@ SET FOREIGN_KEY_CHECKS=0;
 DROP TABLE IF EXISTS `user`;
 DROP TABLE IF EXISTS `room`;
 DROP TABLE IF EXISTS `room_member`;
+DROP TABLE IF EXISTS `room_result`;
+DROP TABLE IF EXISTS `room_archive`;
+DROP TABLE IF EXISTS `room_member_archive`;
+DROP TABLE IF EXISTS `room_result_archive`;
+DROP TABLE IF EXISTS `replica_heartbeat`;
 
 CREATE TABLE `user` (
   `id` bigint NOT NULL AUTO_INCREMENT,
@@ -19,6 +24,8 @@ CREATE TABLE `room` (
   `max_user_count` SMALLINT NOT NULL,
   `is_start` BOOLEAN NOT NULL,
   `time` bigint NOT NULL,
+  `version` INT NOT NULL DEFAULT 0,
+  `updated_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
   PRIMARY KEY (`room_id`)
 );
 
@@ -39,11 +46,64 @@ CREATE TABLE `room_member` (
  FOREIGN KEY (`user_id`) REFERENCES `user` (`id`) ON DELETE CASCADE
 );
 
+-- 確定したリザルト。ResultUser のリストの JSON
+CREATE TABLE `room_result` (
+  `room_id` bigint NOT NULL,
+  `result` text NOT NULL,
+  `finalized_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`room_id`)
+);
+
+-- 終わったルームの移動先。app/sweeper.py が room, room_member から移す
+CREATE TABLE `room_archive` (
+  `room_id` bigint NOT NULL,
+  `live_id` INT NOT NULL,
+  `joined_user_count` SMALLINT NOT NULL,
+  `max_user_count` SMALLINT NOT NULL,
+  `is_start` BOOLEAN NOT NULL,
+  `time` bigint NOT NULL,
+  `updated_at` timestamp NOT NULL,
+  `archived_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`room_id`)
+);
+
+CREATE TABLE `room_member_archive` (
+ `room_member_id` bigint NOT NULL,
+ `room_id` bigint NOT NULL,
+ `user_id` bigint NOT NULL,
+ `select_difficulty` SMALLINT NOT NULL,
+ `is_host` BOOLEAN NOT NULL,
+ `judge_miss` INT NOT NULL,
+ `judge_bad` INT NOT NULL,
+ `judge_good` INT NOT NULL,
+ `judge_great` INT NOT NULL,
+ `judge_perfect` INT NOT NULL,
+ `score` INT NOT NULL,
+ PRIMARY KEY (`room_member_id`)
+);
+
+CREATE TABLE `room_result_archive` (
+ `room_id` bigint NOT NULL,
+ `result` text NOT NULL,
+ `finalized_at` timestamp NOT NULL,
+ `archived_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+ PRIMARY KEY (`room_id`)
+);
+
+CREATE TABLE `replica_heartbeat` (
+ `id` TINYINT NOT NULL,
+ `beat` DOUBLE NOT NULL,
+ PRIMARY KEY (`id`)
+);
+
 ALTER TABLE `user` ADD UNIQUE KEY `hashed_token` (`hashed_token`);
 
 ALTER TABLE `room` ADD INDEX `live_id` (`live_id`);
 ALTER TABLE `room` ADD INDEX `is_start` (`is_start`);
+ALTER TABLE `room` ADD INDEX `is_start_updated_at` (`is_start`, `updated_at`);
 
 ALTER TABLE `room_member` ADD INDEX `room_id` (`room_id`);
 ALTER TABLE `room_member` ADD INDEX `user_id` (`user_id`);
-ALTER TABLE `room_member` ADD INDEX `score` (`score`);
\ No newline at end of file
+ALTER TABLE `room_member` ADD INDEX `score` (`score`);
+
+ALTER TABLE `room_member_archive` ADD INDEX `room_id` (`room_id`);
\ No newline at end of file
@@ -0,0 +1,15 @@
+import pytest
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture(scope="session")
+def client():
+    """API を呼ぶテストで共有するクライアント
+
+    async エンジンのコネクションはイベントループに紐づくので、全リクエストを1つのループで処理し、
+    最後に shutdown (エンジンの dispose) まで動かす。
+    """
+    from app.api import app
+
+    with TestClient(app) as client:
+        yield client
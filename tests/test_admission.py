@@ -0,0 +1,50 @@
+import pytest
+from fastapi import HTTPException
+
+from app import admission, config
+from app.model import WaitRoomStatus
+
+
+class FakePool:
+    _max_overflow = 2
+
+    def __init__(self, checkedout):
+        self._checkedout = checkedout
+
+    def size(self):
+        return 3
+
+    def checkedout(self):
+        return self._checkedout
+
+
+def test_wait_interval_slows_down_when_idle_or_loaded(monkeypatch):
+    monitor = admission.LoadMonitor(FakePool(0))
+    monkeypatch.setattr(admission, "monitor", monitor)
+    waiting = WaitRoomStatus.Waiting.value
+
+    assert admission.wait_interval(waiting, 1.0) == config.POLL_INTERVAL_MIN
+    assert admission.wait_interval(waiting, 60.0) == config.POLL_INTERVAL_IDLE
+
+    # プールの待ち時間が POLL_HIGH_POOL_WAIT に達したら上限まで延ばす
+    for _ in range(100):
+        monitor.observe_pool_wait(config.POLL_HIGH_POOL_WAIT * 2)
+    assert admission.wait_interval(waiting, 1.0) == config.POLL_INTERVAL_MAX
+    assert admission.retry_after(0.5) == "1"
+
+
+def test_polls_are_shed_only_when_pool_is_saturated(monkeypatch):
+    monitor = admission.LoadMonitor(FakePool(5))
+    monkeypatch.setattr(admission, "monitor", monitor)
+    admission.admit_poll("/room/wait")
+
+    for _ in range(100):
+        monitor.observe_pool_wait(config.POLL_SHED_POOL_WAIT * 2)
+    with pytest.raises(HTTPException) as e:
+        admission.admit_poll("/room/wait")
+    assert e.value.status_code == 503
+    assert e.value.headers["Retry-After"] == "2"
+
+    # 空きが出たら受け付ける
+    monitor._pool = FakePool(4)
+    admission.admit_poll("/room/wait")
@@ -0,0 +1,33 @@
+from app.cache import TTLCache
+
+
+def test_lru_eviction():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    # b が最も古く使われたので捨てられる
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["size"] == 2
+
+
+def test_ttl_expire():
+    cache = TTLCache(maxsize=10, ttl=0)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_invalidate_discards_inflight_set():
+    cache = TTLCache(maxsize=10, ttl=60)
+    stamp = cache.stamp()
+    # 読み込み中に別の処理が無効化した
+    cache.invalidate("a")
+    cache.set("a", "stale", stamp)
+    assert cache.get("a") is None
+    cache.set("a", "fresh", cache.stamp())
+    assert cache.get("a") == "fresh"
+    assert cache.stats()["hits"] == 1
@@ -0,0 +1,142 @@
+import random
+import threading
+import time
+
+import pytest
+
+from app.bus import LocalBroker, QueuedBus, UnixSocketBus, relay_room_events
+from app.events import RoomEventHub
+from app.room_index import JoinableRoomIndex, RoomEntry
+
+ROOMS = 20
+MAX_USER_COUNT = 4
+
+
+class Worker:
+    """1つの uvicorn ワーカーにあるイベントとルームの索引"""
+
+    def __init__(self, bus):
+        self.hub = RoomEventHub()
+        self.index = JoinableRoomIndex(max_staleness=60)
+        self.hub.subscribe(self.index.on_event)
+        self.index.reconcile([])
+        relay_room_events(bus, self.hub)
+
+
+class Rooms:
+    """room テーブルの代わり。行ロックを取って人数とバージョンを変える"""
+
+    def __init__(self):
+        self.rooms = {room_id: [1, 0, False] for room_id in range(1, ROOMS + 1)}
+        self.locks = {room_id: threading.Lock() for room_id in self.rooms}
+
+    def join(self, room_id):
+        with self.locks[room_id]:
+            room = self.rooms[room_id]
+            if room[2] or not 0 < room[0] < MAX_USER_COUNT:
+                return None
+            room[0] += 1
+            room[1] += 1
+            return "join", self._data(room_id)
+
+    def leave(self, room_id):
+        with self.locks[room_id]:
+            room = self.rooms[room_id]
+            if room[2] or room[0] == 0:
+                return None
+            room[0] -= 1
+            room[1] += 1
+            if room[0] == 0:
+                room[2] = True
+                return "dissolve", {}
+            return "leave", self._data(room_id)
+
+    def _data(self, room_id):
+        count, version, _ = self.rooms[room_id]
+        return dict(
+            live_id=1000 + room_id % 3,
+            joined_user_count=count,
+            max_user_count=MAX_USER_COUNT,
+            version=version,
+        )
+
+    def joinable(self):
+        return {
+            RoomEntry(room_id, 1000 + room_id % 3, count, MAX_USER_COUNT)
+            for room_id, (count, _, dissolved) in self.rooms.items()
+            if not dissolved and 0 < count < MAX_USER_COUNT
+        }
+
+
+def _unix_buses(tmp_path, count):
+    buses = [UnixSocketBus(str(tmp_path)) for _ in range(count)]
+    for bus in buses:
+        bus.start()
+    return buses
+
+
+@pytest.mark.parametrize("backend", ["local", "unix"])
+def test_room_index_is_coherent_across_workers(backend, tmp_path):
+    if backend == "local":
+        broker = LocalBroker()
+        buses = [broker.connect() for _ in range(3)]
+    else:
+        buses = _unix_buses(tmp_path, 3)
+    workers = [Worker(bus) for bus in buses]
+    rooms = Rooms()
+    for room_id in rooms.rooms:
+        workers[0].hub.publish(room_id, "create", rooms._data(room_id))
+
+    def run(seed):
+        rng = random.Random(seed)
+        for _ in range(300):
+            room_id = rng.randint(1, ROOMS)
+            change = rooms.join(room_id) if rng.random() < 0.6 else rooms.leave(room_id)
+            if change is None:
+                continue
+            # コミットしてから publish するまでの間に、他のスレッドの変更が先に届くことがある
+            time.sleep(rng.random() / 2000)
+            rng.choice(workers).hub.publish(room_id, *change)
+
+    threads = [threading.Thread(target=run, args=(seed,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # unix はバックグラウンドのスレッドで受け取るので、全て届くまで待つ
+    sent = sum(bus.sent for bus in buses) * (len(buses) - 1)
+    deadline = time.monotonic() + 5
+    while sum(bus.received for bus in buses) < sent and time.monotonic() < deadline:
+        time.sleep(0.01)
+    for bus in buses:
+        bus.close()
+
+    assert sum(bus.dropped for bus in buses) == 0
+    expected = rooms.joinable()
+    for worker in workers:
+        assert set(worker.index.lookup(0)) == expected
+    # 全てのワーカーのイベントのバージョンが、全てのイベントの数だけ進んでいる
+    versions = [[w.hub.version(r) for r in rooms.rooms] for w in workers]
+    assert versions[0] == versions[1] == versions[2]
+
+
+def test_publish_does_not_wait_for_slow_send():
+    release = threading.Event()
+
+    class SlowBus(QueuedBus):
+        QUEUE_SIZE = 2
+
+        def _write(self, data):
+            release.wait()
+
+    bus = SlowBus()
+    bus.start()
+    started = time.monotonic()
+    for _ in range(10):
+        bus.publish("room", room_id=1)
+    assert time.monotonic() - started < 0.05
+    # 1件は送信中、2件はキューの中、残りは捨てる
+    assert bus.dropped >= 7
+    release.set()
+    bus._stop_sender()
@@ -0,0 +1,57 @@
+import asyncio
+import math
+import threading
+import time
+
+from app.events import RoomEventHub
+
+
+def test_wait_wakes_on_publish():
+    hub = RoomEventHub()
+
+    async def main():
+        waiter = asyncio.ensure_future(hub.wait(1, 0, timeout=5))
+        await asyncio.sleep(0)
+        hub.publish(1, "join")
+        return await waiter
+
+    assert asyncio.run(main()) == 1
+
+
+def test_wait_timeout_returns_same_version():
+    hub = RoomEventHub()
+    hub.publish(1, "create")
+    assert asyncio.run(hub.wait(1, 1, timeout=0.01)) == 1
+    # 既に進んでいれば待たない
+    assert asyncio.run(hub.wait(1, 0, timeout=5)) == 1
+
+
+def test_publish_from_other_thread():
+    hub = RoomEventHub()
+    received = []
+    hub.subscribe(
+        lambda room_id, event, version, data: received.append((room_id, event))
+    )
+
+    async def main():
+        waiter = asyncio.ensure_future(hub.wait(2, 0, timeout=5))
+        await asyncio.sleep(0)
+        thread = threading.Thread(target=hub.publish, args=(2, "leave"))
+        thread.start()
+        version = await waiter
+        thread.join()
+        return version
+
+    assert asyncio.run(main()) == 1
+    assert received == [(2, "leave")]
+
+
+def test_idle_rooms_are_forgotten():
+    hub = RoomEventHub(retention=0.01)
+    hub.publish(1, "create")
+    hub.publish(1, "join")
+    time.sleep(0.02)
+    hub.publish(2, "create")
+    assert hub.version(1) == 0
+    assert hub.version(2) == 1
+    assert hub.idle(1) == math.inf
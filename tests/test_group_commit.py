@@ -0,0 +1,55 @@
+from contextlib import contextmanager
+
+import pytest
+
+from app import group_commit, model
+
+USER = model.SafeUser(id=1, name="user", leader_card_id=1000)
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """トランザクションの数と、書いた end を記録する"""
+    written = dict(commits=0, batches=[], single=[])
+
+    @contextmanager
+    def transaction():
+        yield None
+        written["commits"] += 1
+
+    def end_rooms(conn, submissions):
+        if any(score < 0 for _, score, _, _ in submissions):
+            raise RuntimeError("deadlock")
+        written["batches"].append(submissions)
+        return {}
+
+    def end_room(conn, room_id, score, user, judge_count_list):
+        if score < 0:
+            raise RuntimeError("broken")
+        written["single"].append(room_id)
+
+    monkeypatch.setattr(model, "transaction", transaction)
+    monkeypatch.setattr(model, "_end_rooms", end_rooms)
+    monkeypatch.setattr(model, "_end_room", end_room)
+    return written
+
+
+def test_submissions_are_committed_together(database):
+    buffer = group_commit.EndRoomBuffer(window=0.2)
+    futures = [buffer.submit(room_id, 100, USER, [1, 2, 3]) for room_id in range(10)]
+    for future in futures:
+        assert future.result(timeout=5) is None
+    buffer.close()
+    assert database["commits"] == 1
+    assert len(database["batches"][0]) == 10
+
+
+def test_failed_batch_is_retried_one_by_one(database):
+    buffer = group_commit.EndRoomBuffer(window=0.2)
+    ok = buffer.submit(1, 100, USER, [])
+    broken = buffer.submit(2, -1, USER, [])
+    assert ok.result(timeout=5) is None
+    with pytest.raises(RuntimeError):
+        broken.result(timeout=5)
+    buffer.close()
+    assert database["single"] == [1]
@@ -0,0 +1,56 @@
+import random
+
+from app.leaderboard import GLOBAL, Leaderboard, RankedEntry, RankedScores
+
+
+def test_ranked_scores_matches_sorted_list():
+    rng = random.Random(0)
+    scores = RankedScores()
+    expected = {}
+    for _ in range(3000):
+        user_id = rng.randrange(300)
+        if user_id in expected and rng.random() < 0.4:
+            assert scores.remove(expected.pop(user_id), user_id)
+        elif user_id not in expected:
+            expected[user_id] = rng.randrange(1000)
+            scores.add(expected[user_id], user_id)
+    ordered = sorted(expected.items(), key=lambda e: (-e[1], e[0]))
+    assert len(scores) == len(ordered)
+    assert scores.from_rank(1, len(ordered)) == [
+        RankedEntry(i + 1, user_id, score) for i, (user_id, score) in enumerate(ordered)
+    ]
+    for i, (user_id, score) in enumerate(ordered):
+        assert scores.rank(score, user_id) == i + 1
+    assert scores.rank(-1, 1) is None
+    assert not scores.remove(-1, 1)
+    assert scores.from_rank(len(ordered) + 1, 10) == []
+
+
+def test_leaderboard_keeps_personal_best():
+    board = Leaderboard()
+    board.record(1001, 1, 500)
+    board.record(1001, 2, 700)
+    board.record(1002, 1, 900)
+    board.record(1001, 1, 300)
+    board.record(1001, 3, 0)
+
+    assert board.top(1001, 10) == [RankedEntry(1, 2, 700), RankedEntry(2, 1, 500)]
+    assert board.top(GLOBAL, 10) == [RankedEntry(1, 1, 900), RankedEntry(2, 2, 700)]
+    assert board.around(1001, 1, 1) == (
+        RankedEntry(2, 1, 500),
+        [RankedEntry(1, 2, 700), RankedEntry(2, 1, 500)],
+    )
+    assert board.around(1001, 3, 1) == (None, [])
+
+
+def test_leaderboard_rebuild_and_events():
+    class Row:
+        def __init__(self, live_id, user_id, score):
+            self.live_id, self.user_id, self.score = live_id, user_id, score
+
+    board = Leaderboard()
+    board.record(1001, 9, 100)
+    board.rebuild([Row(1001, 1, 300), Row(1001, 2, 200)])
+    board.on_event(1, "end", 1, dict(live_id=1001, user_id=2, score=400))
+    board.on_event(1, "join", 2, dict(live_id=1001, joined_user_count=2))
+    assert board.top(1001, 10) == [RankedEntry(1, 2, 400), RankedEntry(2, 1, 300)]
@@ -0,0 +1,25 @@
+import logging
+import queue
+
+from app.log import DroppingQueueHandler, SamplingFilter, dropped_records
+
+
+def _record(level):
+    return logging.LogRecord("test", level, __file__, 1, "Enter wait_room", None, None)
+
+
+def test_sampling_keeps_warnings():
+    sampling = SamplingFilter(rate=0.0)
+    assert not sampling.filter(_record(logging.INFO))
+    assert not sampling.filter(_record(logging.DEBUG))
+    assert sampling.filter(_record(logging.WARN))
+    assert SamplingFilter(rate=1.0).filter(_record(logging.DEBUG))
+
+
+def test_full_queue_drops_without_blocking():
+    before = dropped_records.value("queue_full")
+    handler = DroppingQueueHandler(queue.Queue(maxsize=1))
+    handler.handle(_record(logging.INFO))
+    handler.handle(_record(logging.INFO))
+    assert handler.queue.qsize() == 1
+    assert dropped_records.value("queue_full") == before + 1
@@ -0,0 +1,29 @@
+from app.metrics import Counter, Histogram, query_label
+
+
+def test_histogram_render():
+    histogram = Histogram("test_seconds", "help", ("endpoint",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, "/room/wait")
+    histogram.observe(0.1, "/room/wait")
+    histogram.observe(3.0, "/room/wait")
+    lines = histogram.render()
+    assert lines[:2] == ["# HELP test_seconds help", "# TYPE test_seconds histogram"]
+    assert 'test_seconds_bucket{endpoint="/room/wait",le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{endpoint="/room/wait",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{endpoint="/room/wait",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{endpoint="/room/wait"} 3' in lines
+
+
+def test_counter_callback():
+    counter = Counter("test_total", "help", ("result",), callback=lambda: {("hit",): 3})
+    assert counter.render()[-1] == 'test_total{result="hit"} 3'
+
+
+def test_query_label():
+    assert (
+        query_label("SELECT `is_start` FROM `room` WHERE `room_id`=%s") == "SELECT room"
+    )
+    assert query_label("INSERT INTO `room_member` SET `room_id`=%s") == (
+        "INSERT room_member"
+    )
+    assert query_label("UPDATE `room` SET `time`=%s") == "UPDATE room"
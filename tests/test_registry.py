@@ -0,0 +1,170 @@
+import pytest
+from sqlalchemy import text
+
+from app import config, model
+from app.db import engine
+from app.model import JoinRoomResult, LiveDifficulty, RoomNotOwned, WaitRoomStatus
+from app.registry import RoomRegistry, lock_process
+
+
+def _user(i):
+    token = model.create_user(f"registry_user_{i}", 1000)
+    return token, model.get_user_by_token(token)
+
+
+def _new_room(registry, token, user, live_id=2001):
+    with engine.begin() as conn:
+        room_id = conn.execute(
+            text(
+                "INSERT INTO `room` (`live_id`, `joined_user_count`, `max_user_count`, `is_start`, `time`) VALUES (:live_id, 1, 4, 1, 0)"
+            ),
+            dict(live_id=live_id),
+        ).lastrowid
+    return registry.create_room(room_id, live_id, LiveDifficulty.normal, user)
+
+
+def test_registry_lifecycle_and_persist():
+    registry = RoomRegistry(engine)
+    users = [_user(i) for i in range(5)]
+    room_id = _new_room(registry, *users[0])
+
+    assert [r.room_id for r in registry.list_room(2001)] == [room_id]
+    for _, user in users[1:4]:
+        assert (
+            registry.join_room(room_id, LiveDifficulty.hard, user) == JoinRoomResult.Ok
+        )
+    assert (
+        registry.join_room(room_id, LiveDifficulty.hard, users[4][1])
+        == JoinRoomResult.RoomFull
+    )
+    assert registry.list_room(2001) == []
+
+    # ホストが抜けたら次に入ったメンバーがホストになる
+    registry.leave_room(room_id, users[0][1])
+    status, room_users = registry.wait_room(room_id, users[1][1])
+    assert status == WaitRoomStatus.Waiting.value
+    assert [(u.user_id, u.is_host, u.is_me) for u in room_users] == [
+        (users[1][1].id, True, True),
+        (users[2][1].id, False, False),
+        (users[3][1].id, False, False),
+    ]
+
+    registry.start_room(room_id, users[1][1])
+    for i, (_, user) in enumerate(users[1:4]):
+        assert registry.result_room(room_id) == []
+        registry.end_room(room_id, 100 * i, user, [1, 2, 3])
+    assert [r.score for r in registry.result_room(room_id)] == [0, 100, 200]
+
+    registry.close()
+    with engine.begin() as conn:
+        room = conn.execute(
+            text("SELECT `is_start` FROM `room` WHERE `room_id`=:room_id"),
+            dict(room_id=room_id),
+        ).one()
+        scores = conn.execute(
+            text("SELECT `score` FROM `room_member` WHERE `room_id`=:room_id"),
+            dict(room_id=room_id),
+        ).all()
+    assert room.is_start == WaitRoomStatus.LiveStart.value
+    assert sorted(s.score for s in scores) == [0, 100, 200]
+
+
+def test_registry_quick_join_prefers_fuller_rooms():
+    registry = RoomRegistry(engine)
+    users = [_user(i) for i in range(10, 15)]
+    small = _new_room(registry, *users[0], live_id=2002)
+    large = _new_room(registry, *users[1], live_id=2002)
+    registry.join_room(large, LiveDifficulty.hard, users[2][1])
+
+    assert registry.quick_join_room(2002, LiveDifficulty.normal, users[3][1]) == large
+    assert registry.quick_join_room(2002, LiveDifficulty.normal, users[4][1]) == large
+    assert registry.quick_join_room(2002, LiveDifficulty.normal, users[0][1]) is None
+    assert [r.room_id for r in registry.list_room(2002)] == [small]
+    registry.close()
+
+
+def test_registry_result_is_finalized_at_deadline(monkeypatch):
+    registry = RoomRegistry(engine)
+    users = [_user(i) for i in range(20, 22)]
+    room_id = _new_room(registry, *users[0], live_id=2003)
+    registry.join_room(room_id, LiveDifficulty.hard, users[1][1])
+    registry.start_room(room_id, users[0][1])
+    registry.end_room(room_id, 500, users[0][1], [1, 2, 3, 4, 5])
+    assert registry.result_room(room_id) == []
+
+    monkeypatch.setattr(config, "RESULT_DEADLINE", 0)
+    result = registry.result_room(room_id)
+    assert [(r.user_id, r.score) for r in result] == [
+        (users[0][1].id, 500),
+        (users[1][1].id, 0),
+    ]
+    # 確定したあとの end はリザルトを変えない
+    registry.end_room(room_id, 900, users[1][1], [5, 4, 3, 2, 1])
+    assert registry.result_room(room_id) == result
+    registry.close()
+
+
+def test_registry_evicts_idle_rooms(monkeypatch):
+    registry = RoomRegistry(engine)
+    token, user = _user(30)
+    room_id = _new_room(registry, token, user, live_id=2004)
+
+    monkeypatch.setattr(config, "ROOM_REGISTRY_IDLE_TIMEOUT", 0)
+    monkeypatch.setattr(config, "ROOM_REGISTRY_RETENTION", 0)
+    registry.flush()
+    registry.flush()
+    assert not registry.owns(room_id)
+    assert registry.list_room(2004) == []
+    assert registry.quick_join_room(2004, LiveDifficulty.normal, _user(31)[1]) is None
+    # owns を見た後に片付けられたら、呼び出し側は DB で処理し直す
+    with pytest.raises(RoomNotOwned):
+        registry.wait_room(room_id, user)
+    registry.close()
+
+
+def test_registry_rejects_changes_to_idle_rooms(monkeypatch):
+    registry = RoomRegistry(engine)
+    users = [_user(i) for i in range(40, 42)]
+    room_id = _new_room(registry, *users[0], live_id=2005)
+
+    # 放置されたルームは書き込んだ時の状態のまま変えない
+    monkeypatch.setattr(config, "ROOM_REGISTRY_IDLE_TIMEOUT", 0)
+    registry.flush()
+    assert (
+        registry.join_room(room_id, LiveDifficulty.hard, users[1][1])
+        == JoinRoomResult.Disbanded
+    )
+    registry.leave_room(room_id, users[0][1])
+    assert registry.list_room(2005) == []
+    status, room_users = registry.wait_room(room_id, users[0][1])
+    assert status == WaitRoomStatus.Waiting.value
+    assert [u.user_id for u in room_users] == [users[0][1].id]
+    registry.close()
+
+
+def test_registry_registers_rooms_after_commit(monkeypatch):
+    registry = RoomRegistry(engine)
+    monkeypatch.setattr(model, "room_registry", registry)
+    token, _ = _user(50)
+
+    # コミットできなかったルームは登録しない
+    with pytest.raises(RuntimeError):
+        with model.transaction() as conn:
+            room_id = model._create_room(conn, token, 2006, LiveDifficulty.normal)
+            assert not registry.owns(room_id)
+            raise RuntimeError
+    assert not registry.owns(room_id)
+
+    room_id = model.create_room(token, 2006, LiveDifficulty.normal)
+    assert registry.owns(room_id)
+    registry.close()
+
+
+def test_registry_runs_in_one_process(tmp_path):
+    path = str(tmp_path / "registry.lock")
+    lock = lock_process(path)
+    # 2つ目のワーカーは起動しない
+    with pytest.raises(RuntimeError):
+        lock_process(path)
+    lock.close()
+    lock_process(path).close()
@@ -0,0 +1,55 @@
+import time
+
+from sqlalchemy import create_engine, text
+
+from app import statements
+from app.replica import Heartbeat, ReplicaRouter
+
+
+def _database():
+    engine = create_engine("sqlite://", future=True)
+    with engine.begin() as conn:
+        conn.execute(
+            text("CREATE TABLE replica_heartbeat (id INTEGER PRIMARY KEY, beat REAL)")
+        )
+    return engine
+
+
+def test_writers_read_from_primary_for_a_while():
+    router = ReplicaRouter(enabled=True, window=0.2, max_lag=1.0)
+    # 遅れを測るまではレプリカを使わない
+    assert not router.use_replica("alice")
+    router.observe_lag(0.01)
+    assert router.use_replica("alice")
+
+    router.wrote("alice")
+    assert not router.use_replica("alice")
+    assert router.use_replica("bob")
+    time.sleep(0.25)
+    assert router.use_replica("alice")
+
+    router.observe_lag(2.0)
+    assert not router.use_replica("bob")
+
+
+def test_heartbeat_measures_lag_of_stand_in_replica():
+    """2つ目の DB をレプリカの代わりにし、レプリケーションを手で行う"""
+    primary, standin = _database(), _database()
+    router = ReplicaRouter(enabled=True, max_lag=1.0)
+    heartbeat = Heartbeat(primary, standin, router)
+
+    # ハートビートがまだ届いていない
+    assert heartbeat.beat() is None
+    assert not router.healthy()
+
+    with primary.connect() as conn:
+        beat = conn.execute(statements.SELECT_HEARTBEAT).scalar()
+    with standin.begin() as conn:
+        conn.execute(statements.WRITE_HEARTBEAT, dict(beat=beat - 5.0))
+    assert heartbeat.beat() > 5.0
+    assert not router.healthy()
+
+    with standin.begin() as conn:
+        conn.execute(statements.WRITE_HEARTBEAT, dict(beat=time.time()))
+    assert heartbeat.beat() < 1.0
+    assert router.healthy()
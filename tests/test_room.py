@@ -1,12 +1,16 @@
-from fastapi.testclient import TestClient
+import threading
 
-from app.api import app
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+from app import config, model
+from app.group_commit import EndRoomBuffer
 
-client = TestClient(app)
 user_tokens = []
 
 
-def _create_users():
+@pytest.fixture(scope="module", autouse=True)
+def _create_users(client):
     for i in range(10):
         response = client.post(
             "/user/create",
@@ -15,15 +19,12 @@ def _create_users():
         user_tokens.append(response.json()["user_token"])
 
 
-_create_users()
-
-
 def _auth_header(i=0):
     token = user_tokens[i]
     return {"Authorization": f"bearer {token}"}
 
 
-def test_room_1():
+def test_room_1(client):
     response = client.post(
         "/room/create",
         headers=_auth_header(),
@@ -64,3 +65,220 @@ def test_room_1():
     )
     assert response.status_code == 200
     print("room/end response:", response.json())
+
+
+def test_room_quickjoin(client):
+    # 入れるルームがなければ作る
+    response = client.post(
+        "/room/quickjoin",
+        headers=_auth_header(5),
+        json={"live_id": 1005, "select_difficulty": 1},
+    )
+    assert response.status_code == 200
+    room_id = response.json()["room_id"]
+    assert response.json()["created"]
+
+    for i in range(6, 9):
+        response = client.post(
+            "/room/quickjoin",
+            headers=_auth_header(i),
+            json={"live_id": 1005, "select_difficulty": 2},
+        )
+        assert response.status_code == 200
+        assert response.json() == {"room_id": room_id, "created": False}
+
+    # 満員なので新しいルームを作る
+    response = client.post(
+        "/room/quickjoin",
+        headers=_auth_header(9),
+        json={"live_id": 1005, "select_difficulty": 1},
+    )
+    assert response.status_code == 200
+    assert response.json()["room_id"] != room_id
+    assert response.json()["created"]
+
+
+def test_leaderboard(client):
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(1),
+        json={"live_id": 1006, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    client.post("/room/start", headers=_auth_header(1), json={"room_id": room_id})
+    response = client.post(
+        "/room/end",
+        headers=_auth_header(1),
+        json={"room_id": room_id, "score": 98765, "judge_count_list": [1, 1, 1]},
+    )
+    assert response.status_code == 200
+
+    response = client.post(
+        "/leaderboard/me",
+        headers=_auth_header(1),
+        json={"live_id": 1006, "neighbours": 2},
+    )
+    assert response.status_code == 200
+    me = response.json()["me"]
+    assert me["score"] == 98765
+    assert me in response.json()["ranking"]
+
+    response = client.post("/leaderboard/top", json={"live_id": 1006, "limit": 100})
+    assert response.status_code == 200
+    assert me in response.json()["ranking"]
+
+
+def test_room_wait_etag(client):
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(6),
+        json={"live_id": 1006, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+
+    response = client.post(
+        "/room/wait", headers=_auth_header(6), json={"room_id": room_id}
+    )
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = client.post(
+        "/room/wait",
+        headers={**_auth_header(6), "If-None-Match": etag},
+        json={"room_id": room_id},
+    )
+    assert response.status_code == 304
+
+    response = client.post(
+        "/room/list", headers={"If-None-Match": "x"}, json={"live_id": 1006}
+    )
+    list_etag = response.headers.get("ETag")
+
+    # 誰かが入ったらバージョンが進み、中身を返す
+    response = client.post(
+        "/room/join",
+        headers=_auth_header(7),
+        json={"room_id": room_id, "select_difficulty": 2},
+    )
+    assert response.json()["join_room_result"] == 1
+    response = client.post(
+        "/room/wait",
+        headers={**_auth_header(6), "If-None-Match": etag},
+        json={"room_id": room_id},
+    )
+    assert response.status_code == 200
+    assert len(response.json()["room_user_list"]) == 2
+    assert response.headers["ETag"] != etag
+
+    # 同じユーザーがもう一度 join しても人数は増えない
+    response = client.post(
+        "/room/join",
+        headers=_auth_header(7),
+        json={"room_id": room_id, "select_difficulty": 2},
+    )
+    assert response.json()["join_room_result"] == 4
+
+    if list_etag is not None:
+        response = client.post(
+            "/room/list", headers={"If-None-Match": list_etag}, json={"live_id": 1006}
+        )
+        assert response.status_code == 200
+
+
+def test_room_wait_ws(client):
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(8),
+        json={"live_id": 1005, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+
+    with client.websocket_connect(f"/room/wait/ws?room_id={room_id}") as ws:
+        ws.send_text(user_tokens[8])
+        data = ws.receive_json()
+    assert data["status"] == 1
+    assert [u["is_me"] for u in data["room_user_list"]] == [True]
+
+    # トークンが正しくなければ切断する
+    with client.websocket_connect(f"/room/wait/ws?room_id={room_id}") as ws:
+        ws.send_text("invalid")
+        with pytest.raises(WebSocketDisconnect) as e:
+            ws.receive_json()
+    assert e.value.code == 1008
+
+
+def test_room_end_group_commit(client, monkeypatch):
+    buffer = EndRoomBuffer(window=0.5)
+    monkeypatch.setattr(model, "end_buffer", buffer)
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(2),
+        json={"live_id": 1007, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    client.post(
+        "/room/join",
+        headers=_auth_header(3),
+        json={"room_id": room_id, "select_difficulty": 2},
+    )
+    client.post("/room/start", headers=_auth_header(2), json={"room_id": room_id})
+
+    # 同時に end した2人を1つのトランザクションで書く
+    def end(i, score):
+        response = client.post(
+            "/room/end",
+            headers=_auth_header(i),
+            json={"room_id": room_id, "score": score, "judge_count_list": [i, 1, 1]},
+        )
+        assert response.status_code == 200
+
+    threads = [threading.Thread(target=end, args=(i, 1000 * i)) for i in (2, 3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    buffer.close()
+    assert buffer.batches == 1
+
+    response = client.post("/room/result", json={"room_id": room_id})
+    results = response.json()["result_user_list"]
+    assert sorted(r["score"] for r in results) == [2000, 3000]
+    assert sorted(r["judge_count_list"][0] for r in results) == [2, 3]
+
+
+def test_room_result_is_not_rewritten_by_late_end(client, monkeypatch):
+    response = client.post(
+        "/room/create",
+        headers=_auth_header(4),
+        json={"live_id": 1008, "select_difficulty": 1},
+    )
+    room_id = response.json()["room_id"]
+    client.post(
+        "/room/join",
+        headers=_auth_header(5),
+        json={"room_id": room_id, "select_difficulty": 1},
+    )
+    client.post("/room/start", headers=_auth_header(4), json={"room_id": room_id})
+    client.post(
+        "/room/end",
+        headers=_auth_header(4),
+        json={"room_id": room_id, "score": 100, "judge_count_list": [1, 0, 0]},
+    )
+    # 締め切りで確定させる
+    monkeypatch.setattr(config, "RESULT_DEADLINE", 0)
+    response = client.post("/room/result", json={"room_id": room_id})
+    finalized = response.json()["result_user_list"]
+    assert sorted(r["score"] for r in finalized) == [0, 100]
+
+    # 確定した後の end はリザルトを変えず、キャッシュにも確定したものが入る
+    model.result_snapshots.invalidate(room_id)
+    client.post(
+        "/room/end",
+        headers=_auth_header(5),
+        json={"room_id": room_id, "score": 900, "judge_count_list": [9, 0, 0]},
+    )
+    assert [r.score for r in model.result_snapshots.get(room_id)] == [
+        r["score"] for r in finalized
+    ]
+    response = client.post("/room/result", json={"room_id": room_id})
+    assert response.json()["result_user_list"] == finalized
@@ -0,0 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+
+from app import model
+from app.db import engine
+from app.model import JoinRoomResult, LiveDifficulty, WaitRoomStatus
+
+JOINS = 300
+
+
+def _users(n):
+    users = []
+    for i in range(n):
+        token = model.create_user(f"concurrency_user_{i}", 1000)
+        users.append(model.get_user_by_token(token))
+    return users
+
+
+users = _users(JOINS + 1)
+
+
+def _room(max_user_count):
+    """users[0] がホストのルームを作る"""
+    with engine.begin() as conn:
+        room_id = conn.execute(
+            text(
+                "INSERT INTO `room` (`live_id`, `joined_user_count`, `max_user_count`, `is_start`, `time`) VALUES (3001, 1, :max_user_count, 1, 0)"
+            ),
+            dict(max_user_count=max_user_count),
+        ).lastrowid
+        conn.execute(
+            text(
+                "INSERT INTO `room_member` (`room_id`, `user_id`, `select_difficulty`, `is_host`, `judge_miss`, `judge_bad`, `judge_good`, `judge_great`, `judge_perfect`, `score`) VALUES (:room_id, :user_id, 1, TRUE, 0, 0, 0, 0, 0, 0)"
+            ),
+            dict(room_id=room_id, user_id=users[0].id),
+        )
+    return room_id
+
+
+def _counts(room_id):
+    with engine.begin() as conn:
+        joined_user_count = conn.execute(
+            text("SELECT `joined_user_count` FROM `room` WHERE `room_id`=:room_id"),
+            dict(room_id=room_id),
+        ).scalar_one()
+        members, hosts = conn.execute(
+            text(
+                "SELECT COUNT(*), COALESCE(SUM(`is_host`), 0) FROM `room_member` WHERE `room_id`=:room_id"
+            ),
+            dict(room_id=room_id),
+        ).one()
+    return joined_user_count, members, hosts
+
+
+def _join_all(room_id, joiners):
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        return list(
+            executor.map(
+                lambda user: model.join_room(room_id, LiveDifficulty.hard, user),
+                joiners,
+            )
+        )
+
+
+def test_concurrent_joins_fill_room_exactly():
+    room_id = _room(max_user_count=4)
+    results = _join_all(room_id, users[1:])
+    assert results.count(JoinRoomResult.Ok) == 3
+    assert results.count(JoinRoomResult.RoomFull) == JOINS - 3
+    assert _counts(room_id) == (4, 4, 1)
+
+
+def test_concurrent_joins_and_leaves_keep_counts():
+    room_id = _room(max_user_count=JOINS + 1)
+    results = _join_all(room_id, users[1:])
+    assert results == [JoinRoomResult.Ok] * JOINS
+    assert _counts(room_id) == (JOINS + 1, JOINS + 1, 1)
+
+    # ホストを含む半分が同時に抜けても、ホストはちょうど1人残る
+    leavers = users[: (JOINS + 1) // 2]
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        list(executor.map(lambda user: model.leave_room(room_id, user), leavers))
+    remaining = JOINS + 1 - len(leavers)
+    assert _counts(room_id) == (remaining, remaining, 1)
+    status, _ = model.wait_room(room_id, users[-1])
+    assert status == WaitRoomStatus.Waiting.value
+    with engine.begin() as conn:
+        # ホストは残ったメンバーの中で一番先に入った人
+        host, first = conn.execute(
+            text(
+                "SELECT MAX(CASE WHEN `is_host` THEN `room_member_id` END), MIN(`room_member_id`) FROM `room_member` WHERE `room_id`=:room_id"
+            ),
+            dict(room_id=room_id),
+        ).one()
+    assert host == first
+
+
+def test_concurrent_quickjoins_do_not_deadlock():
+    # 難易度が違うと試す順が変わる。ロックの順が逆になってもデッドロックしない
+    # 他の人がロックしているルームを飛ばしても、選び直すので新しいルームを作りすぎない
+    rooms = [_room(max_user_count=4) for _ in range(10)]
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "UPDATE `room` SET `live_id`=3002 WHERE `room_id` IN ({})".format(
+                    ",".join(str(room_id) for room_id in rooms)
+                )
+            )
+        )
+    tokens = [model.create_user(f"quickjoin_user_{i}", 1000) for i in range(40)]
+    joiners = [(token, model.get_user_by_token(token)) for token in tokens]
+    difficulties = [LiveDifficulty.normal, LiveDifficulty.hard]
+    with ThreadPoolExecutor(max_workers=40) as executor:
+        results = list(
+            executor.map(
+                lambda i: model.quick_join_room(
+                    joiners[i][0], 3002, difficulties[i % 2], joiners[i][1]
+                ),
+                range(len(joiners)),
+            )
+        )
+    assert len(results) == len(joiners)
+    for room_id in {room_id for room_id, _ in results}:
+        joined_user_count, members, hosts = _counts(room_id)
+        assert joined_user_count == members <= 4
+        assert hosts == 1
+    # 既にあるルームの空き (30人分) を先に埋め、入りきらない 10 人の分だけ作る
+    assert all(_counts(room_id)[0] == 4 for room_id in rooms)
+    assert sum(created for _, created in results) <= len(joiners) - 3 * len(rooms)
@@ -0,0 +1,79 @@
+from app.room_index import JoinableRoomIndex, RoomEntry
+
+
+def _index():
+    index = JoinableRoomIndex(max_staleness=60)
+    assert index.lookup(0) is None
+    index.reconcile([RoomEntry(1, 1001, 1, 4), RoomEntry(2, 1002, 3, 4)])
+    return index
+
+
+def test_events_update_index():
+    index = _index()
+    index.on_event(
+        3, "create", 1, dict(live_id=1001, joined_user_count=1, max_user_count=4)
+    )
+    assert [r.room_id for r in index.lookup(1001)] == [1, 3]
+    assert [r.room_id for r in index.lookup(0)] == [1, 2, 3]
+
+    # 満員になったら一覧から消え、誰かが抜けたら戻る
+    index.on_event(
+        2, "join", 1, dict(live_id=1002, joined_user_count=4, max_user_count=4)
+    )
+    assert index.lookup(1002) == []
+    index.on_event(2, "leave", 2, {})
+    assert index.lookup(1002) == [RoomEntry(2, 1002, 3, 4)]
+
+    index.on_event(1, "start", 1, {})
+    index.on_event(3, "dissolve", 2, {})
+    assert index.lookup(1001) == []
+
+
+def test_reconcile_counts_divergence():
+    index = _index()
+    index._reconciled_at -= 120
+    # 古くなったら1人だけが DB を読みに行き、他は古い索引で答える
+    assert index.lookup(0) is None
+    assert len(index.lookup(0)) == 2
+    # reconcile 中にイベントで変わったルームは上書きしない
+    index.on_event(
+        1, "join", 1, dict(live_id=1001, joined_user_count=2, max_user_count=4)
+    )
+    diverged = index.reconcile([RoomEntry(1, 1001, 1, 4), RoomEntry(4, 1003, 2, 4)])
+    assert diverged == 2
+    assert index.lookup(0) == [RoomEntry(1, 1001, 2, 4), RoomEntry(4, 1003, 2, 4)]
+    assert index.stats()["divergences"] == 2
+
+
+def test_list_version():
+    index = _index()
+    version, live_version = index.list_version(0), index.list_version(1001)
+    index.on_event(
+        3, "create", 1, dict(live_id=1002, joined_user_count=1, max_user_count=4)
+    )
+    # 他の live_id の変更では進まない
+    assert index.list_version(0) > version
+    assert index.list_version(1001) == live_version
+    # 古くなったら None を返して lookup からやり直させる
+    index._reconciled_at -= 120
+    assert index.list_version(1001) is None
+
+
+def test_reconcile_from_lagging_replica_keeps_recent_events():
+    index = _index()
+    index.on_event(
+        3, "create", 1, dict(live_id=1001, joined_user_count=1, max_user_count=4)
+    )
+    index._reconciled_at -= 120
+    assert index.lookup(0) is None
+    # レプリカにはまだルーム3がない。直前に作られたので消さない
+    assert (
+        index.reconcile([RoomEntry(1, 1001, 1, 4), RoomEntry(2, 1002, 3, 4)], 1.0) == 0
+    )
+    assert [r.room_id for r in index.lookup(1001)] == [1, 3]
+
+    # primary から読んだ結果なら消す
+    index._reconciled_at -= 120
+    assert index.lookup(0) is None
+    assert index.reconcile([RoomEntry(1, 1001, 1, 4), RoomEntry(2, 1002, 3, 4)]) == 1
+    assert [r.room_id for r in index.lookup(1001)] == [1]
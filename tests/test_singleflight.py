@@ -0,0 +1,64 @@
+import asyncio
+
+from app.singleflight import SingleFlight
+
+
+def test_concurrent_reads_share_one_fetch():
+    flights = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return ["row"]
+
+    async def main():
+        return await asyncio.gather(
+            *[flights.do("wait", 1, 0, fetch) for _ in range(10)]
+        )
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(r == ["row"] for r in results)
+    assert flights.collapse_ratio() == {("wait",): 0.9}
+
+
+def test_new_generation_does_not_join():
+    flights = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    async def main():
+        first = asyncio.ensure_future(flights.do("wait", 1, 0, fetch))
+        await asyncio.sleep(0)
+        # 読み始めた後にルームが変わった
+        second = await flights.do("wait", 1, 1, fetch)
+        return await first, second
+
+    assert asyncio.run(main()) == (2, 2)
+    assert len(calls) == 2
+
+
+def test_cancelled_leader_lets_followers_fetch():
+    flights = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "ok"
+
+    async def main():
+        leader = asyncio.ensure_future(flights.do("result", 1, 0, fetch))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.do("result", 1, 0, fetch))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(main()) == "ok"
+    assert len(calls) == 2
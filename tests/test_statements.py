@@ -0,0 +1,30 @@
+import pytest
+from sqlalchemy import create_engine, text
+
+from app import statements
+
+
+def test_registry_names_statements():
+    registry = statements.StatementRegistry()
+    select_one = registry.add("select_one", "SELECT :value")
+    with pytest.raises(ValueError):
+        registry.add("select_one", "SELECT 2")
+
+    assert registry.name_of(select_one) == "select_one"
+    # 同じ SQL でも、その場で作ったものは登録したものではない
+    assert registry.name_of(text("SELECT :value")) == "inline"
+
+
+def test_executions_are_counted_by_name():
+    engine = create_engine("sqlite://", future=True)
+    statements.instrument_engine(engine)
+    named = statements.executions.value("select_room_version")
+    inline = statements.executions.value("inline")
+
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE room (room_id INTEGER, version INTEGER)"))
+        for _ in range(3):
+            conn.execute(statements.SELECT_ROOM_VERSION, dict(room_id=1))
+
+    assert statements.executions.value("select_room_version") == named + 3
+    assert statements.executions.value("inline") == inline + 1
@@ -0,0 +1,62 @@
+from sqlalchemy import text
+
+from app import model
+from app.db import engine
+from app.model import LiveDifficulty
+from app.sweeper import Sweeper, rows_moved
+
+
+def _count(conn, table, room_id):
+    return conn.execute(
+        text(f"SELECT COUNT(*) FROM `{table}` WHERE `room_id`=:room_id"),
+        dict(room_id=room_id),
+    ).scalar_one()
+
+
+def test_sweeper_archives_old_finished_rooms():
+    token = model.create_user("sweeper_user", 1000)
+    user = model.get_user_by_token(token)
+    dissolved = model.create_room(token, 4001, LiveDifficulty.normal)
+    model.leave_room(dissolved, user)
+    waiting = model.create_room(token, 4001, LiveDifficulty.normal)
+    # ライブ開始済みのルームは、リザルトが確定していれば移す
+    finished = model.create_room(token, 4001, LiveDifficulty.normal)
+    playing = model.create_room(token, 4001, LiveDifficulty.normal)
+    for room_id in (finished, playing):
+        model.start_room(room_id, user)
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO `room_result` (`room_id`, `result`) VALUES (:room_id, '[]')"
+            ),
+            dict(room_id=finished),
+        )
+        conn.execute(
+            text(
+                "UPDATE `room` SET `updated_at`=NOW() - INTERVAL 2 HOUR WHERE `room_id` IN (:dissolved, :waiting, :finished, :playing)"
+            ),
+            dict(
+                dissolved=dissolved, waiting=waiting, finished=finished, playing=playing
+            ),
+        )
+
+    before = rows_moved.value("room")
+    sweeper = Sweeper(engine, min_age=3600, batch_size=1)
+    waits = []
+    assert sweeper.sweep(wait=waits.append) >= 2
+    assert rows_moved.value("room") - before >= 2
+    # 1件ずつなので、バッチの間で休んでいる
+    assert waits
+
+    with engine.begin() as conn:
+        assert _count(conn, "room", dissolved) == 0
+        assert _count(conn, "room_member", dissolved) == 0
+        assert _count(conn, "room_archive", dissolved) == 1
+        # 待機中のルームは古くても残す
+        assert _count(conn, "room", waiting) == 1
+        assert _count(conn, "room_archive", waiting) == 0
+        assert _count(conn, "room_archive", finished) == 1
+        assert _count(conn, "room_result", finished) == 0
+        assert _count(conn, "room_result_archive", finished) == 1
+        # リザルトが確定していないルームは残す
+        assert _count(conn, "room", playing) == 1
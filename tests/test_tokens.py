@@ -0,0 +1,50 @@
+import pytest
+
+from app.tokens import TokenSigner, is_signed, parse_keys
+
+
+def test_sign_and_verify():
+    signer = TokenSigner(parse_keys("k1:secret"))
+    token = signer.sign(42)
+    assert is_signed(token)
+    assert signer.verify(token) == 42
+    # 署名を変えたり、他のユーザーの id にしたりしたトークンは通さない
+    assert signer.verify(token[:-1] + ("A" if token[-1] != "A" else "B")) is None
+    assert signer.verify(token.replace(".42.", ".43.")) is None
+    assert signer.verify("s1.k1.x.y") is None
+    assert not is_signed("0c4c3e0e-6a3b-4c6e-9a8d-1b2f3a4b5c6d")
+
+
+def test_malformed_tokens():
+    signer = TokenSigner(parse_keys("k1:" + "x" * 40))
+    for token in [
+        "s1.",
+        "s1.k1",
+        "s1.k1.",
+        "s1.k1..",
+        "s1.k1.².abc",
+        "s1.k1.٤٢.abc",
+        "s1.k1.-1.abc",
+        "s1.k1." + "9" * 5000 + ".abc",
+        "s1.k2.1.abc",
+        "s1.k1.1.é",
+    ]:
+        assert signer.verify(token) is None
+
+
+def test_key_rotation():
+    old = TokenSigner(parse_keys("k1:old"))
+    token = old.sign(1)
+    # 新しい鍵で署名し、古い鍵は検証だけに使う
+    rotating = TokenSigner(parse_keys("k2:new,k1:old"))
+    assert rotating.verify(token) == 1
+    assert rotating.sign(1).startswith("s1.k2.")
+    # 古い鍵を外したら古いトークンは使えない
+    assert TokenSigner(parse_keys("k2:new")).verify(token) is None
+
+
+def test_parse_keys():
+    assert parse_keys("") == []
+    assert parse_keys("a:x, b:y") == [("a", b"x"), ("b", b"y")]
+    with pytest.raises(ValueError):
+        parse_keys("no-secret")
@@ -1,11 +1,7 @@
-from fastapi.testclient import TestClient
+from app import config, model, tokens
 
-from app.api import app
 
-client = TestClient(app)
-
-
-def test_create_user():
+def test_create_user(client):
     response = client.post(
         "/user/create", json={"user_name": "test1", "leader_card_id": 1000}
     )
@@ -23,3 +19,75 @@ def test_create_user():
     assert response_data.keys() == {"id", "name", "leader_card_id"}
     assert response_data["name"] == "test1"
     assert response_data["leader_card_id"] == 1000
+
+
+def test_create_user_retries_on_token_collision(client, monkeypatch):
+    taken = model._new_token()
+    with model.transaction() as conn:
+        conn.execute(
+            model.text(
+                "INSERT INTO `user` (name, hashed_token, leader_card_id) VALUES ('taken', :hashed_token, 1000)"
+            ),
+            dict(hashed_token=taken[1]),
+        )
+    issued = iter([taken, model._new_token()])
+    monkeypatch.setattr(model, "_new_token", lambda: next(issued))
+
+    token = model.create_user("test2", 1000)
+    assert token != taken[0]
+    assert model.get_user_by_token(token).name == "test2"
+
+
+def test_bulk_create_users(client, monkeypatch):
+    users = [{"user_name": f"bulk_{i}", "leader_card_id": 1000} for i in range(2500)]
+    response = client.post("/admin/user/bulk_create", json={"users": users})
+    assert response.status_code == 403
+
+    monkeypatch.setattr(config, "ADMIN_TOKEN", "admin-secret")
+    monkeypatch.setattr(config, "BULK_INSERT_SIZE", 1000)
+    response = client.post(
+        "/admin/user/bulk_create",
+        headers={"Authorization": "bearer admin-secret"},
+        json={"users": users},
+    )
+    assert response.status_code == 200
+    tokens = response.json()["user_tokens"]
+    assert len(set(tokens)) == 2500
+
+    response = client.get("/user/me", headers={"Authorization": f"bearer {tokens[-1]}"})
+    assert response.json()["name"] == "bulk_2499"
+
+
+def test_signed_tokens(client, monkeypatch):
+    response = client.post(
+        "/user/create", json={"user_name": "uuid_user", "leader_card_id": 1000}
+    )
+    uuid_token = response.json()["user_token"]
+
+    monkeypatch.setattr(tokens, "signer", tokens.TokenSigner([("k1", b"secret")]))
+    response = client.post(
+        "/user/create", json={"user_name": "signed_user", "leader_card_id": 1000}
+    )
+    token = response.json()["user_token"]
+    assert tokens.is_signed(token)
+    headers = {"Authorization": f"bearer {token}"}
+
+    response = client.post(
+        "/user/update",
+        headers=headers,
+        json={"user_name": "signed_user2", "leader_card_id": 2000},
+    )
+    assert response.status_code == 200
+    response = client.get("/user/me", headers=headers)
+    assert response.json()["name"] == "signed_user2"
+    assert response.json()["leader_card_id"] == 2000
+
+    # 移行中の UUID のトークンもそのまま使える
+    response = client.get("/user/me", headers={"Authorization": f"bearer {uuid_token}"})
+    assert response.json()["name"] == "uuid_user"
+
+    response = client.get("/user/me", headers={"Authorization": f"bearer {token}x"})
+    assert response.status_code == 404
+
+    (bulk,) = model.create_users([("signed_bulk", 1000)])
+    assert model.get_user_by_token(bulk).name == "signed_bulk"